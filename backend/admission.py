@@ -0,0 +1,410 @@
+import asyncio
+import contextvars
+import hashlib
+import ipaddress
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+from backend import log, metrics, pool
+
+logger = log.getLogger(__name__)
+
+API_KEY_HEADER = "x-api-key"
+QUOTA_WINDOW_S = 3600
+
+# The ticket of the request being handled; carried into the conversion pool with the context
+_current: contextvars.ContextVar[Optional["Ticket"]] = contextvars.ContextVar("admission_ticket", default=None)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def _key_identity(key: str) -> str:
+    # Keys are never logged or shown, only a hash of them
+    return "key:" + hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _identity(value: str) -> str:
+    # A configured client: an address, or else an API key
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return _key_identity(value)
+
+
+def client_of(request: Request) -> str:
+    """Who is asking: their API key if it is a configured one, else their address.
+
+    Unknown keys are ignored, or sending a new one with every request would
+    get around every per-client limit.
+    """
+    key = request.headers.get(API_KEY_HEADER, "").strip()
+    if key and _key_identity(key) in get_controller().api_keys:
+        return _key_identity(key)
+    return request.client.host if request.client else "unknown"
+
+
+def _rejected(status_code: int, reason: str, detail: str, retry_after_s: Optional[float]) -> HTTPException:
+    metrics.ADMISSION_REJECTIONS.inc(reason=reason)
+    headers = {"Retry-After": str(max(1, int(retry_after_s + 0.999)))} if retry_after_s is not None else None
+    return HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+
+class _Client:
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.running = 0
+        self.waiting: deque = deque()
+        # Virtual time by which the client's conversions so far would be served at its share
+        self.finish = 0.0
+        self.last_cost = 0.0
+        # (time, seconds of audio) charged within the quota window
+        self.usage: deque = deque()
+
+    def used(self, now: float) -> float:
+        while self.usage and self.usage[0][0] <= now - QUOTA_WINDOW_S:
+            self.usage.popleft()
+        return sum(seconds for _, seconds in self.usage)
+
+    def retry_after(self, now: float, limit: float, needed: float) -> Optional[float]:
+        """Seconds until `needed` more fits under `limit`, None if it never will."""
+        if needed > limit:
+            return None
+        used = self.used(now)
+        for charged_at, seconds in self.usage:
+            used -= seconds
+            if used + needed <= limit:
+                return charged_at + QUOTA_WINDOW_S - now
+        return 0
+
+    @property
+    def idle(self) -> bool:
+        return not self.running and not self.waiting and not self.usage
+
+
+class _Waiter:
+    def __init__(self, seq: int, future: asyncio.Future):
+        self.seq = seq
+        self.future = future
+        self.granted = False
+        self.estimate = 0.0
+
+
+class Ticket:
+    """A conversion slot held by one client's request; release() it when the request is done."""
+
+    def __init__(self, controller: "AdmissionController", client: str):
+        self.controller = controller
+        self.client = client
+        # Cost assumed when the slot was granted, corrected by the first charge
+        self.estimate = 0.0
+        self.charged = 0.0
+        self.held = False
+
+    def charge(self, seconds: float, enforce: bool = True) -> None:
+        self.controller.charge(self.client, seconds, enforce, ticket=self)
+
+    def release(self) -> None:
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """Shares the conversion slots between clients by the audio they send.
+
+    Requests wait for one of `slots` before any of their body is read. Free
+    slots go to the waiting client whose conversions so far add up to the
+    least audio per unit of weight (start-time fair queuing), so a client
+    with a dozen long files gets its share and no more. The cost of a
+    conversion is the probed duration of its input, charged once it is known;
+    until then the client's previous one stands in for it.
+
+    Requests are refused with 429 + Retry-After when a client already has
+    `client_concurrency` conversions running and `client_queue_depth`
+    waiting, or has used up `minutes_per_hour` of audio, and with 503 when
+    `queue_depth` requests are waiting in total or one waited `max_wait_s`.
+    Zero turns the respective limit off. `api_keys` are the identities of
+    the API keys clients may identify themselves with.
+    """
+
+    def __init__(
+        self,
+        slots: int,
+        queue_depth: int,
+        *,
+        client_concurrency: int = 0,
+        client_queue_depth: int = 0,
+        minutes_per_hour: int = 0,
+        max_wait_s: float = 120,
+        retry_after_s: int = 5,
+        weights: Optional[dict] = None,
+        api_keys: frozenset = frozenset(),
+    ):
+        self.slots = max(1, slots)
+        self.queue_depth = queue_depth
+        self.client_concurrency = client_concurrency
+        self.client_queue_depth = client_queue_depth
+        self.minutes_per_hour = minutes_per_hour
+        self.max_wait_s = max_wait_s
+        self.retry_after_s = retry_after_s
+        self.weights = weights or {}
+        self.api_keys = api_keys
+        self._lock = threading.Lock()
+        self._clients: dict[str, _Client] = {}
+        self._seq = itertools.count()
+        self._running = 0
+        self._waiting = 0
+        self._virtual = 0.0
+
+    def _client(self, client: str) -> _Client:
+        # Called with the lock held
+        state = self._clients.get(client)
+        if state is None:
+            state = self._clients[client] = _Client(self.weights.get(client, 1.0))
+        if not state.running and not state.waiting:
+            # A client coming back doesn't get credit for the time it was away
+            state.finish = max(state.finish, self._virtual)
+        return state
+
+    def _forget(self, client: str, state: _Client) -> None:
+        # Called with the lock held
+        if state.idle:
+            self._clients.pop(client, None)
+
+    def _check_quota(self, state: _Client, now: float, needed: float) -> None:
+        limit = self.minutes_per_hour * 60
+        if not limit:
+            return
+        used = state.used(now)
+        if (used + needed <= limit) if needed else used < limit:
+            return
+        retry_after_s = state.retry_after(now, limit, needed)
+        if retry_after_s is None:
+            detail = f"The audio is longer than the {self.minutes_per_hour} minutes per hour a client may convert"
+        else:
+            detail = f"Conversion quota of {self.minutes_per_hour} audio minutes per hour used up"
+        raise _rejected(429, "quota", detail, retry_after_s)
+
+    def check(self, client: str) -> None:
+        """Raise 429 if `client` has no quota left; for work that is queued rather than given a slot."""
+        with self._lock:
+            state = self._client(client)
+            try:
+                self._check_quota(state, time.time(), 0)
+            finally:
+                self._forget(client, state)
+
+    def _grant(self, state: _Client, waiter: _Waiter) -> None:
+        # Called with the lock held
+        try:
+            waiter.future.get_loop().call_soon_threadsafe(_resolve, waiter.future)
+        except RuntimeError:
+            # Its event loop is gone, and the request with it
+            return
+        waiter.granted = True
+        waiter.estimate = state.last_cost
+        state.running += 1
+        self._running += 1
+        self._virtual = state.finish
+        state.finish += state.last_cost / state.weight
+
+    def _dispatch(self) -> None:
+        # Called with the lock held: hand free slots to the clients furthest behind their share
+        while self._running < self.slots:
+            ready = [
+                (state.finish, state.waiting[0].seq, client)
+                for client, state in self._clients.items()
+                if state.waiting and not (self.client_concurrency and state.running >= self.client_concurrency)
+            ]
+            if not ready:
+                return
+            _, _, client = min(ready)
+            state = self._clients[client]
+            waiter = state.waiting.popleft()
+            self._waiting -= 1
+            metrics.ADMISSION_WAITING.dec()
+            self._grant(state, waiter)
+
+    async def admit(self, client: str) -> Ticket:
+        """Wait for a conversion slot for `client`, or raise 429/503 without waiting where it can't be had."""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(next(self._seq), loop.create_future())
+        with self._lock:
+            state = self._client(client)
+            try:
+                self._check_quota(state, time.time(), 0)
+                busy = self.client_concurrency and state.running >= self.client_concurrency
+                if busy and len(state.waiting) >= self.client_queue_depth:
+                    raise _rejected(
+                        429, "concurrency", f"At most {self.client_concurrency} conversions per client at a time",
+                        self.retry_after_s,
+                    )
+                if self._running >= self.slots and self._waiting >= self.queue_depth:
+                    logger.warning(f"Admission queue full ({self._waiting} waiting), rejecting request from {client}")
+                    raise _rejected(503, "busy", "Server is busy, please retry later", self.retry_after_s)
+            except HTTPException:
+                self._forget(client, state)
+                raise
+            state.waiting.append(waiter)
+            self._waiting += 1
+            metrics.ADMISSION_WAITING.inc()
+            self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter.future, self.max_wait_s or None)
+        except BaseException as e:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    state.waiting.remove(waiter)
+                    self._waiting -= 1
+                    metrics.ADMISSION_WAITING.dec()
+                    self._forget(client, state)
+            if granted:
+                # The slot came just as the request gave up
+                self._release(client)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning(f"Request from {client} waited {self.max_wait_s}s for a conversion slot, rejecting it")
+                raise _rejected(503, "timeout", "Server is busy, please retry later", self.retry_after_s)
+            raise
+
+        waited = time.perf_counter() - started
+        metrics.observe_stage("queue", waited)
+        logger.debug("Admitted %s after %.3fs", client, waited)
+        ticket = Ticket(self, client)
+        ticket.estimate = waiter.estimate
+        ticket.held = True
+        return ticket
+
+    def charge(self, client: str, seconds: float, enforce: bool = True, ticket: Optional[Ticket] = None) -> None:
+        """Count `seconds` of audio against `client`'s share and quota.
+
+        With `enforce`, a conversion that doesn't fit the quota any more is
+        refused with 429 instead; without, the audio was already converted.
+        """
+        with self._lock:
+            state = self._client(client)
+            try:
+                if enforce:
+                    self._check_quota(state, time.time(), seconds)
+                # The first charge replaces the cost assumed when the slot was granted
+                estimate = ticket.estimate if ticket is not None and not ticket.charged else 0.0
+                state.finish += (seconds - estimate) / state.weight
+                state.last_cost = seconds
+                if self.minutes_per_hour:
+                    state.usage.append((time.time(), seconds))
+                if ticket is not None:
+                    ticket.charged += seconds
+            finally:
+                self._forget(client, state)
+
+    def _release(self, client: str) -> None:
+        with self._lock:
+            state = self._clients.get(client)
+            if state is not None:
+                state.running -= 1
+                self._running -= 1
+                self._forget(client, state)
+            self._dispatch()
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket.held:
+            ticket.held = False
+            self._release(ticket.client)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.time()
+            return {
+                "slots": self.slots,
+                "running": self._running,
+                "waiting": self._waiting,
+                "clients": [
+                    {
+                        "client": client,
+                        "weight": state.weight,
+                        "running": state.running,
+                        "waiting": len(state.waiting),
+                        "minutes_last_hour": round(state.used(now) / 60, 1),
+                    }
+                    for client, state in sorted(self._clients.items())
+                ],
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _parse_weights(value: str) -> dict:
+    # "key-or-address=weight,..."
+    weights = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        name, _, weight = entry.rpartition("=")
+        if not name or float(weight) <= 0:
+            raise ValueError(f"Invalid CLIENT_WEIGHTS entry: {entry!r}")
+        weights[_identity(name.strip())] = float(weight)
+    return weights
+
+
+async def admit(request: Request) -> Ticket:
+    """A conversion slot for the client behind `request`; its charges go to the ticket from here on."""
+    ticket = await get_controller().admit(client_of(request))
+    _current.set(ticket)
+    return ticket
+
+
+def charge(seconds: Optional[float], enforce: bool = True) -> None:
+    """Charge the current request's client for converting `seconds` of audio, if it was admitted."""
+    ticket = _current.get()
+    if ticket is not None and seconds:
+        ticket.charge(seconds, enforce)
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def configure() -> AdmissionController:
+    """Slots, waiting requests and Retry-After come from the conversion pool (CONVERT_WORKERS etc.).
+
+    Clients can identify themselves with the X-API-Key header using one of
+    CLIENT_API_KEYS or a key in CLIENT_WEIGHTS.
+    """
+    global _controller
+    conversions = pool.get_pool()
+    client_concurrency = _env_int("CLIENT_CONCURRENCY", 0)
+    weights = _parse_weights(os.environ.get("CLIENT_WEIGHTS", ""))
+    # Keys given a weight are known too
+    api_keys = {_key_identity(key.strip()) for key in os.environ.get("CLIENT_API_KEYS", "").split(",") if key.strip()}
+    api_keys.update(name for name in weights if name.startswith("key:"))
+    _controller = AdmissionController(
+        conversions.workers,
+        conversions.queue_depth,
+        client_concurrency=client_concurrency,
+        client_queue_depth=_env_int("CLIENT_QUEUE_DEPTH", client_concurrency),
+        minutes_per_hour=_env_int("CLIENT_MINUTES_PER_HOUR", 0),
+        max_wait_s=_env_int("ADMISSION_MAX_WAIT", 120),
+        retry_after_s=conversions.retry_after_s,
+        weights=weights,
+        api_keys=frozenset(api_keys),
+    )
+    logger.debug(
+        "Admission: %s slots, %s per client, %s audio minutes per hour",
+        _controller.slots, client_concurrency or "no limit", _controller.minutes_per_hour or "no limit",
+    )
+    return _controller
+
+
+def get_controller() -> AdmissionController:
+    if _controller is None:
+        return configure()
+    return _controller
@@ -0,0 +1,85 @@
+import io
+import time
+import zipfile
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+
+class _Buffer(io.RawIOBase):
+    """Write-only, unseekable sink that zipfile writes into and we drain."""
+
+    def __init__(self):
+        self._parts: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+class ZipStream:
+    """Build a ZIP archive piece by piece without a seekable destination.
+
+    Entries are stored, not compressed (MP3 doesn't shrink), and each method
+    returns the bytes that became ready, so an archive can be sent while its
+    later entries are still being produced. CRCs and sizes go into data
+    descriptors after each entry.
+    """
+
+    def __init__(self):
+        self._buffer = _Buffer()
+        self._zip = zipfile.ZipFile(self._buffer, "w", compression=zipfile.ZIP_STORED)
+        self._entry = None
+        self._names: set[str] = set()
+
+    def unique_name(self, name: str) -> str:
+        stem, dot, ext = name.rpartition(".")
+        if not dot:
+            stem, ext = name, ""
+        candidate, n = name, 1
+        while candidate in self._names:
+            n += 1
+            candidate = f"{stem} ({n}){dot}{ext}"
+        return candidate
+
+    def start(self, name: str, size: int) -> bytes:
+        """Begin an entry of exactly `size` bytes; ZIP64 is used when it needs it."""
+        name = self.unique_name(name)
+        self._names.add(name)
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = size
+        self._entry = self._zip.open(info, "w")
+        return self._buffer.drain()
+
+    def write(self, data: bytes) -> bytes:
+        self._entry.write(data)
+        return self._buffer.drain()
+
+    def finish(self) -> bytes:
+        self._entry.close()
+        self._entry = None
+        return self._buffer.drain()
+
+    def add(self, name: str, data: bytes) -> bytes:
+        return self.start(name, len(data)) + self.write(data) + self.finish()
+
+    def close(self) -> bytes:
+        """Write the central directory; nothing can be added afterwards."""
+        self._zip.close()
+        logger.debug("Closed ZIP stream with %s entries", len(self._names))
+        return self._buffer.drain()
@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend import cover, log, mp3
+
+logger = log.getLogger(__name__)
+
+DEFAULT_PROFILE = "default"
+
+
+class TagProfile:
+    """Album-level tags and cover of one show.
+
+    `cover_path` is an already normalized JPEG (see cover.CoverCache). It is
+    read and the shared ID3 frames (TALB, TPE2, TCON, APIC) are serialized
+    once; building a tag for an episode only adds its title, speaker and year.
+    """
+
+    def __init__(self, name: str, *, album: str, album_artist: str, genre: str, title_suffix: str, cover_path: str):
+        self.name = name
+        self.album = album
+        self.album_artist = album_artist
+        self.genre = genre
+        self.title_suffix = title_suffix
+        self.cover_path = os.path.abspath(cover_path)
+        self.cover_mime = "image/jpeg"
+        with open(self.cover_path, "rb") as f:
+            self.cover_data = f.read()
+        self.static_frames = mp3.static_id3_frames(
+            album=album,
+            album_artist=album_artist,
+            genre=genre,
+            cover_data=self.cover_data,
+            cover_mime=self.cover_mime,
+        )
+
+    def with_cover(self, cover_path: str) -> "TagProfile":
+        """The same profile with another (normalized) cover, e.g. one uploaded with the request."""
+        return TagProfile(
+            self.name,
+            album=self.album,
+            album_artist=self.album_artist,
+            genre=self.genre,
+            title_suffix=self.title_suffix,
+            cover_path=cover_path,
+        )
+
+    def title(self, topic: str) -> str:
+        return f"{topic}{self.title_suffix}"
+
+    def tags(self, title: str, speaker: str) -> dict:
+        """Keyword arguments for mp3.convert_and_tag()."""
+        # FFmpeg reads the cover from disk; put it back if the cover cache evicted it
+        cover.restore(self.cover_path, self.cover_data)
+        return dict(
+            title=title,
+            album=self.album,
+            album_artist=self.album_artist,
+            artist=speaker,
+            year=str(datetime.now().year),
+            genre=self.genre,
+            cover_path=self.cover_path,
+            cover_mime=self.cover_mime,
+        )
+
+    def id3_header(self, title: str, speaker: str) -> bytes:
+        return mp3.id3_header_from_frames(self.static_frames, title=title, artist=speaker, year=str(datetime.now().year))
+
+
+class AssetRegistry:
+    """Named tag profiles, rebuilt when the profiles file or a cover changes on disk.
+
+    The "default" profile comes from the environment and the default cover.
+    A JSON profiles file can add more, each falling back to the default for
+    anything it leaves out:
+
+        {"interviews": {"album": "Talks", "cover": "talks.png"}}
+
+    Cover paths in the file are relative to the file itself. Covers are
+    embedded in their normalized form from `covers`.
+    """
+
+    def __init__(
+        self,
+        defaults: dict,
+        cover_path: str,
+        profiles_path: Optional[str] = None,
+        covers: Optional[cover.CoverCache] = None,
+    ):
+        self._defaults = defaults
+        self._cover_path = cover_path
+        self._profiles_path = profiles_path
+        self._covers = covers or cover.get_cache()
+        self._sources: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._profiles: dict[str, TagProfile] = {}
+        self._signature = None
+        self._error: Optional[str] = None
+
+    def _watched(self) -> list[str]:
+        paths = [self._cover_path]
+        if self._profiles_path:
+            paths.append(self._profiles_path)
+        paths += list(self._sources.values())
+        return paths
+
+    def _stat(self) -> tuple:
+        signature = []
+        for path in self._watched():
+            try:
+                st = os.stat(path)
+                signature.append((path, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def _load(self) -> None:
+        if not os.path.exists(self._cover_path):
+            self._profiles = {}
+            self._error = "Default cover art not found"
+            return
+
+        definitions = {}
+        base = os.path.dirname(self._profiles_path or "")
+        if self._profiles_path and os.path.exists(self._profiles_path):
+            with open(self._profiles_path) as f:
+                definitions = json.load(f)
+        sources = {DEFAULT_PROFILE: self._cover_path}
+        settings = {DEFAULT_PROFILE: self._defaults}
+        for name, definition in definitions.items():
+            settings[name] = {**self._defaults, **{k: v for k, v in definition.items() if k != "cover"}}
+            sources[name] = os.path.join(base, definition["cover"]) if definition.get("cover") else self._cover_path
+
+        profiles = {}
+        for name, source in sources.items():
+            with open(source, "rb") as f:
+                normalized = self._covers.path(f.read())
+            profiles[name] = TagProfile(name, cover_path=normalized, **settings[name])
+        self._profiles = profiles
+        self._sources = sources
+        self._error = None
+        logger.info(f"Loaded tag profiles: {', '.join(profiles)}")
+
+    def _refresh(self) -> None:
+        with self._lock:
+            signature = self._stat()
+            if signature == self._signature:
+                return
+            try:
+                self._load()
+            except Exception as e:
+                # Keep serving the last good profiles while a file is half written
+                logger.error(f"Failed to load tag profiles: {e}")
+                if not self._profiles:
+                    self._error = f"Failed to load tag profiles: {e}"
+            # Covers added by the profiles file are watched from now on
+            self._signature = self._stat()
+
+    def get(self, name: Optional[str] = None) -> TagProfile:
+        self._refresh()
+        if self._error:
+            raise HTTPException(status_code=500, detail=self._error)
+        profile = self._profiles.get(name or DEFAULT_PROFILE)
+        if profile is None:
+            raise HTTPException(status_code=422, detail=f"Unknown profile: {name}")
+        return profile
+
+    def names(self) -> list[str]:
+        self._refresh()
+        return list(self._profiles)
+
+
+_registry: Optional[AssetRegistry] = None
+
+
+def configure() -> AssetRegistry:
+    global _registry
+    defaults = dict(
+        album=os.environ.get("ALBUM", ""),
+        album_artist=os.environ.get("ALBUM_ARTIST", ""),
+        genre=os.environ.get("GENRE", ""),
+        title_suffix=os.environ.get("TITLE_SUFFIX", ""),
+    )
+    cover_path = os.environ.get("COVER_PATH", "").strip() or "./media/default_cover.jpg"
+    profiles_path = os.environ.get("PROFILES_FILE", "").strip() or "./media/profiles.json"
+    _registry = AssetRegistry(defaults, os.path.abspath(cover_path), os.path.abspath(profiles_path))
+    return _registry
+
+
+def get_registry() -> AssetRegistry:
+    if _registry is None:
+        return configure()
+    return _registry
@@ -0,0 +1,606 @@
+"""
+Benchmarks for the conversion pipeline.
+
+Usage (from the repository root, ffmpeg must be on PATH):
+
+    python -m backend.benchmark tagging --seconds 600 --runs 3
+    python -m backend.benchmark warm --seconds 10 --runs 30
+    python -m backend.benchmark segments --seconds 1800 --workers 1,2,4
+    python -m backend.benchmark load --formats wav,flac,m4a --durations 1m,10m --requests 8 --concurrency 4 --output before.json
+    python -m backend.benchmark load --formats wav --durations 10m --encoders default,speech-mono-64k,archive-320
+    python -m backend.benchmark load --url http://localhost:8000 --server-pid 1234 --durations 3h
+    python -m backend.benchmark compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+
+from backend import encoders, mp3, segmented, warm
+
+COVER_PATH = os.path.join(os.path.dirname(__file__), "..", "media", "default_cover.jpg")
+
+TAGS = dict(
+    title="Benchmark Episode",
+    album="Benchmark Album",
+    artist="Benchmark Speaker",
+    album_artist="Benchmark Artist",
+    year="2026",
+    genre="Podcast",
+    cover_path=COVER_PATH,
+    cover_mime="image/jpeg",
+)
+
+
+def write_test_wav(path: str, seconds: float, sample_rate: int = 44100, channels: int = 2) -> None:
+    # One second of a 440 Hz tone, repeated: cheap to generate, not trivially compressible
+    second = b"".join(
+        struct.pack("<h", int(12000 * math.sin(2 * math.pi * 440 * i / sample_rate))) * channels
+        for i in range(sample_rate)
+    )
+    with wave.open(path, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        whole, rest = divmod(seconds, 1)
+        for _ in range(int(whole)):
+            w.writeframes(second)
+        w.writeframes(second[: int(rest * sample_rate) * 2 * channels])
+
+
+def _bytes_written() -> int:
+    # wchar counts every write() made by this process and by the children it
+    # has reaped (ffmpeg), whichever filesystem they hit.
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _run_tag_mode(mode: str, audio_in: str, mp3_out: str) -> tuple[float, int]:
+    os.environ["TAG_MODE"] = mode
+    start_written = _bytes_written()
+    start = time.perf_counter()
+    mp3.convert_and_tag(audio_in, mp3_out, **TAGS)
+    elapsed = time.perf_counter() - start
+    # Without /proc only the final file size is known
+    written = _bytes_written() - start_written or os.path.getsize(mp3_out)
+    return elapsed, written
+
+
+def bench_tagging(seconds: float, runs: int) -> dict:
+    tmpdir = tempfile.mkdtemp()
+    previous_mode = os.environ.get("TAG_MODE")
+    try:
+        audio_in = os.path.join(tmpdir, "input.wav")
+        write_test_wav(audio_in, seconds)
+        results = {}
+        for mode in ("mutagen", "ffmpeg"):
+            timings, written = [], 0
+            for _ in range(runs):
+                mp3_out = os.path.join(tmpdir, f"{mode}.mp3")
+                elapsed, written = _run_tag_mode(mode, audio_in, mp3_out)
+                timings.append(elapsed)
+            results[mode] = {
+                "best_s": min(timings),
+                "mean_s": sum(timings) / len(timings),
+                "bytes_written": written,
+                "output_bytes": os.path.getsize(mp3_out),
+            }
+        return results
+    finally:
+        if previous_mode is None:
+            os.environ.pop("TAG_MODE", None)
+        else:
+            os.environ["TAG_MODE"] = previous_mode
+        shutil.rmtree(tmpdir)
+
+
+def _print_tagging(results: dict, seconds: float) -> None:
+    print(f"Tagging benchmark, {seconds:g}s stereo input")
+    print(f"{'mode':<10}{'best s':>10}{'mean s':>10}{'written MB':>14}{'output MB':>12}")
+    for mode, r in results.items():
+        print(
+            f"{mode:<10}{r['best_s']:>10.3f}{r['mean_s']:>10.3f}"
+            f"{r['bytes_written'] / 1e6:>14.2f}{r['output_bytes'] / 1e6:>12.2f}"
+        )
+    base, single = results["mutagen"], results["ffmpeg"]
+    print(
+        f"single-pass saves {1 - single['bytes_written'] / base['bytes_written']:.0%} of bytes written, "
+        f"{1 - single['best_s'] / base['best_s']:.0%} of wall time"
+    )
+
+
+def bench_warm(seconds: float, runs: int, gap_s: float = 0.1) -> dict:
+    """Latency of piped encodes of a short clip, with a fresh ffmpeg each time vs a pre-started one."""
+    tmpdir = tempfile.mkdtemp()
+    previous = warm._pool
+    try:
+        audio_in = os.path.join(tmpdir, "input.wav")
+        write_test_wav(audio_in, seconds)
+        with open(audio_in, "rb") as f:
+            data = f.read()
+        results = {}
+        for mode, size in (("fresh", 0), ("warm", 1)):
+            warm._pool = pool = warm.WarmPool(size=size)
+            try:
+                pool.prewarm(mp3._pipe_args(None, None))
+                timings = []
+                for _ in range(runs):
+                    # Leave the pool time to replace the process, as between requests
+                    time.sleep(gap_s)
+                    start = time.perf_counter()
+                    mp3.convert_pipe(iter([data]), os.path.join(tmpdir, f"{mode}.mp3"), tmpdir)
+                    timings.append(time.perf_counter() - start)
+            finally:
+                pool.shutdown()
+            results[mode] = {"p50_s": percentile(timings, 50), "p95_s": percentile(timings, 95), "best_s": min(timings)}
+        return results
+    finally:
+        warm._pool = previous
+        shutil.rmtree(tmpdir)
+
+
+def _print_warm(results: dict, seconds: float) -> None:
+    print(f"Warm encoder benchmark, {seconds:g}s stereo input")
+    print(f"{'ffmpeg':<10}{'p50 ms':>10}{'p95 ms':>10}{'best ms':>10}")
+    for mode, r in results.items():
+        print(f"{mode:<10}{r['p50_s'] * 1000:>10.1f}{r['p95_s'] * 1000:>10.1f}{r['best_s'] * 1000:>10.1f}")
+    fresh, hot = results["fresh"], results["warm"]
+    print(f"pre-started ffmpeg saves {(fresh['p50_s'] - hot['p50_s']) * 1000:.1f} ms at the median")
+
+
+def bench_segments(seconds: float, workers: list[int], segment_s: float) -> dict:
+    """Wall time of one long encode in a single ffmpeg vs in segments on `workers` threads."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        audio_in = os.path.join(tmpdir, "input.wav")
+        make_input(audio_in, "wav", seconds)
+        encoder = encoders.EncoderProfile("default", quality=2).args()
+        single_out = os.path.join(tmpdir, "single.mp3")
+        start = time.perf_counter()
+        mp3.convert_to_mp3(audio_in, single_out, ["-vn", "-id3v2_version", "0"], timeout_s=None, encoder=encoder)
+        results = {"single": {"wall_s": time.perf_counter() - start, "output_bytes": os.path.getsize(single_out)}}
+        probed = mp3.probe(audio_in)
+        for count in workers:
+            mp3_out = os.path.join(tmpdir, f"segmented-{count}.mp3")
+            with ThreadPoolExecutor(count) as executor:
+                start = time.perf_counter()
+                cuts = segmented.encode(audio_in, mp3_out, tmpdir, probed, encoder, timeout_s=None, segment_s=segment_s, executor=executor)
+                elapsed = time.perf_counter() - start
+            results[f"{count} workers"] = {"wall_s": elapsed, "output_bytes": os.path.getsize(mp3_out), "segments": len(cuts) + 1}
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _print_segments(results: dict, seconds: float) -> None:
+    print(f"Segmented encoding benchmark, {seconds:g}s stereo input on {os.cpu_count()} CPUs")
+    print(f"{'encode':<12}{'wall s':>10}{'speedup':>10}{'output MB':>12}")
+    single = results["single"]["wall_s"]
+    for name, r in results.items():
+        print(f"{name:<12}{r['wall_s']:>10.2f}{single / r['wall_s']:>9.2f}x{r['output_bytes'] / 1e6:>12.2f}")
+
+
+# Generated straight from ffmpeg's sine source, so hours of input never sit in memory
+INPUT_FORMATS = {
+    "wav": ("audio/wav", ["-c:a", "pcm_s16le"]),
+    "flac": ("audio/flac", ["-c:a", "flac"]),
+    "m4a": ("audio/mp4", ["-c:a", "aac", "-b:a", "128k"]),
+}
+
+_STAGE_RE = re.compile(r'^audio_producer_stage_seconds_(bucket|sum|count)\{stage="([^"]+)"(?:,le="([^"]+)")?\} (\S+)$')
+
+
+def parse_duration(text: str) -> float:
+    """Seconds from "90", "90s", "10m" or "3h"."""
+    text = text.strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def make_input(path: str, fmt: str, seconds: float) -> None:
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={seconds}",
+            "-ac", "2", *INPUT_FORMATS[fmt][1], path,
+        ],
+        check=True,
+    )
+
+
+def percentile(values: list, p: float) -> Optional[float]:
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int) -> list[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name can contain spaces, the ppid follows its closing parenthesis
+                if int(f.read().rpartition(")")[2].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+
+def _scratch_used() -> int:
+    # The temp dir plus tmpfs, where small uploads are kept (see scratch.py)
+    used, seen = 0, set()
+    for path in (os.environ.get("SCRATCH_DIR", "").strip() or "/dev/shm", tempfile.gettempdir()):
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            continue
+        if device not in seen:
+            seen.add(device)
+            used += shutil.disk_usage(path).used
+    return used
+
+
+class _Sampler(threading.Thread):
+    """Peak RSS of a process plus its children (the ffmpeg encoders) and peak temp-disk growth."""
+
+    def __init__(self, pid: Optional[int], interval_s: float = 0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval_s = interval_s
+        self.peak_rss = 0
+        self.peak_tmp = 0
+        self._tmp_base = _scratch_used()
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            if self.pid is not None:
+                rss = _rss(self.pid) + sum(_rss(child) for child in _children(self.pid))
+                self.peak_rss = max(self.peak_rss, rss)
+            used = _scratch_used()
+            self.peak_tmp = max(self.peak_tmp, used - self._tmp_base)
+            if self._done.wait(self.interval_s):
+                return
+
+    def stop(self) -> None:
+        self._done.set()
+        self.join()
+
+
+def parse_stage_metrics(text: str) -> dict:
+    """{stage: {"sum": s, "count": n, "buckets": {le: n}}} from a /metrics scrape."""
+    stages: dict = {}
+    for line in text.splitlines():
+        match = _STAGE_RE.match(line)
+        if not match:
+            continue
+        kind, stage, le, value = match.groups()
+        entry = stages.setdefault(stage, {"sum": 0.0, "count": 0, "buckets": {}})
+        if kind == "bucket":
+            entry["buckets"][le] = float(value)
+        else:
+            entry[kind] = float(value)
+    return stages
+
+
+def _bucket_percentile(buckets: dict, count: float, p: float) -> Optional[float]:
+    # Upper bound of the bucket the percentile falls into; that's all a histogram can tell
+    if count <= 0:
+        return None
+    for le, cumulative in sorted(buckets.items(), key=lambda item: float(item[0])):
+        if cumulative >= p / 100 * count:
+            return float(le)
+    return None
+
+
+def stage_breakdown(before: dict, after: dict) -> dict:
+    stages = {}
+    for stage, entry in after.items():
+        base = before.get(stage, {"sum": 0.0, "count": 0, "buckets": {}})
+        count = entry["count"] - base["count"]
+        if count <= 0:
+            continue
+        buckets = {le: n - base["buckets"].get(le, 0) for le, n in entry["buckets"].items()}
+        stages[stage] = {
+            "count": int(count),
+            "mean_s": (entry["sum"] - base["sum"]) / count,
+            "p50_le_s": _bucket_percentile(buckets, count, 50),
+            "p95_le_s": _bucket_percentile(buckets, count, 95),
+        }
+    return stages
+
+
+async def _drive(client, path: str, fmt: str, encoder: str, requests: int, concurrency: int) -> list[dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+    mime = INPUT_FORMATS[fmt][0]
+
+    async def one(n: int) -> dict:
+        async with semaphore:
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                response = await client.post(
+                    "/api/convert",
+                    data={"topic": f"Benchmark {n}", "speaker": "Benchmark", "encoder": encoder},
+                    files={"audioFile": (os.path.basename(path), f, mime)},
+                )
+            return {
+                "latency_s": time.perf_counter() - start,
+                "status": response.status_code,
+                "bytes": len(response.content),
+            }
+
+    return await asyncio.gather(*(one(n) for n in range(requests)))
+
+
+async def _run_scenarios(client, scenarios: list, requests: int, concurrency: int, pid: Optional[int]) -> list[dict]:
+    results = []
+    for fmt, seconds, path, encoder in scenarios:
+        before = parse_stage_metrics((await client.get("/metrics")).text)
+        sampler = _Sampler(pid)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            runs = await _drive(client, path, fmt, encoder, requests, concurrency)
+        finally:
+            sampler.stop()
+        wall = time.perf_counter() - start
+        after = parse_stage_metrics((await client.get("/metrics")).text)
+
+        ok = [r["latency_s"] for r in runs if r["status"] == 200]
+        errors: dict = {}
+        for r in runs:
+            if r["status"] != 200:
+                errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+        results.append(
+            {
+                "format": fmt,
+                "encoder": encoder,
+                "input_seconds": seconds,
+                "input_bytes": os.path.getsize(path),
+                "requests": requests,
+                "concurrency": concurrency,
+                "errors": errors,
+                "wall_s": wall,
+                "p50_s": percentile(ok, 50),
+                "p95_s": percentile(ok, 95),
+                "p99_s": percentile(ok, 99),
+                "throughput_rps": len(ok) / wall,
+                "realtime_factor": len(ok) * seconds / wall,
+                "output_bytes": sum(r["bytes"] for r in runs if r["status"] == 200),
+                "mean_output_bytes": sum(r["bytes"] for r in runs if r["status"] == 200) / len(ok) if ok else None,
+                "peak_rss_bytes": sampler.peak_rss if pid is not None else None,
+                "peak_tmp_bytes": sampler.peak_tmp,
+                "stages": stage_breakdown(before, after),
+            }
+        )
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(
+    formats: list[str],
+    durations: list[float],
+    requests: int,
+    concurrency: int,
+    url: Optional[str] = None,
+    server_pid: Optional[int] = None,
+    encoder_names: tuple = ("default",),
+) -> dict:
+    """Drive /api/convert with synthetic inputs, in-process or against a running server at `url`.
+
+    In-process runs disable the result cache so every request really encodes;
+    a server under test should run with CACHE_MAX_BYTES=0 for the same reason.
+    Peak RSS is only known for this process or for `server_pid`.
+    """
+    import httpx
+
+    # One INFO line per request would drown the results
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        scenarios = []
+        for fmt in formats:
+            for seconds in durations:
+                path = os.path.join(tmpdir, f"input-{seconds:g}s.{fmt}")
+                make_input(path, fmt, seconds)
+                scenarios += [(fmt, seconds, path, encoder) for encoder in encoder_names]
+
+        if url:
+            client = httpx.AsyncClient(base_url=url, timeout=None)
+            pid = server_pid
+        else:
+            from backend import cache
+            from backend.main import app
+
+            os.environ["CACHE_MAX_BYTES"] = "0"
+            cache.configure()
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None)
+            pid = os.getpid()
+
+        async def run():
+            async with client:
+                return await _run_scenarios(client, scenarios, requests, concurrency, pid)
+
+        return {
+            "commit": _git_commit(),
+            "started": datetime.now(timezone.utc).isoformat(),
+            "target": url or "in-process",
+            "cpu_count": os.cpu_count(),
+            "scenarios": asyncio.run(run()),
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _fmt(value, scale: float = 1, digits: int = 3) -> str:
+    return "-" if value is None else f"{value * scale:.{digits}f}"
+
+
+def _label(r: dict) -> str:
+    return f"{r['format']} {r['input_seconds']:g}s {r.get('encoder', 'default')}"
+
+
+def _print_load(results: dict) -> None:
+    print(f"Load benchmark against {results['target']} at commit {results['commit'] or 'unknown'}")
+    print(
+        f"{'input':<32}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'req/s':>8}{'x realtime':>12}"
+        f"{'RSS MB':>9}{'tmp MB':>9}{'out MB':>9}  errors"
+    )
+    for r in results["scenarios"]:
+        print(
+            f"{_label(r):<32}"
+            f"{_fmt(r['p50_s']):>9}{_fmt(r['p95_s']):>9}{_fmt(r['p99_s']):>9}"
+            f"{r['throughput_rps']:>8.2f}{r['realtime_factor']:>12.1f}"
+            f"{_fmt(r['peak_rss_bytes'], 1e-6, 1):>9}{r['peak_tmp_bytes'] / 1e6:>9.1f}"
+            f"{_fmt(r['mean_output_bytes'], 1e-6, 2):>9}  {r['errors'] or ''}"
+        )
+        for stage, s in r["stages"].items():
+            print(f"  {stage:<12}{s['count']:>5} x {s['mean_s']:.3f}s mean, p95 <= {_fmt(s['p95_le_s'], 1, 3)}s")
+
+
+def compare(before: dict, after: dict) -> list[dict]:
+    """Relative change of the headline numbers for every scenario present in both runs."""
+    def scenario(r: dict) -> tuple:
+        # Results from before encoder profiles existed used the default one
+        return r["format"], r["input_seconds"], r.get("encoder", "default"), r["concurrency"]
+
+    baseline = {scenario(r): r for r in before["scenarios"]}
+    changes = []
+    for r in after["scenarios"]:
+        base = baseline.get(scenario(r))
+        if base is None:
+            continue
+        change = {
+            "format": r["format"],
+            "input_seconds": r["input_seconds"],
+            "encoder": r.get("encoder", "default"),
+            "concurrency": r["concurrency"],
+        }
+        for key in ("p50_s", "p95_s", "p99_s", "throughput_rps", "mean_output_bytes", "peak_rss_bytes", "peak_tmp_bytes"):
+            if base.get(key) and r.get(key) is not None:
+                change[key] = r[key] / base[key] - 1
+        changes.append(change)
+    return changes
+
+
+def _print_compare(changes: list[dict], before: dict, after: dict) -> None:
+    print(f"{before['commit'] or 'before'} -> {after['commit'] or 'after'} (negative latency is better)")
+    keys = ("p50_s", "p95_s", "p99_s", "throughput_rps", "mean_output_bytes", "peak_rss_bytes", "peak_tmp_bytes")
+    print(f"{'input':<36}" + "".join(f"{key:>18}" for key in keys))
+    for c in changes:
+        label = f"{_label(c)} c{c['concurrency']}"
+        print(f"{label:<36}" + "".join(f"{c[key]:>+18.1%}" if key in c else f"{'-':>18}" for key in keys))
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    tagging = sub.add_parser("tagging", help="compare mutagen rewrite vs single-pass ffmpeg tagging")
+    tagging.add_argument("--seconds", type=float, default=600)
+    tagging.add_argument("--runs", type=int, default=3)
+
+    warm_parser = sub.add_parser("warm", help="compare piped encodes on a fresh vs a pre-started ffmpeg")
+    warm_parser.add_argument("--seconds", type=float, default=10)
+    warm_parser.add_argument("--runs", type=int, default=30)
+
+    segments = sub.add_parser("segments", help="compare a single encode of a long input with segmented encodes")
+    segments.add_argument("--seconds", type=float, default=1800)
+    segments.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    segments.add_argument("--segment-seconds", type=float, default=300)
+
+    load = sub.add_parser("load", help="drive /api/convert in-process or over HTTP and report latency, throughput and resources")
+    load.add_argument("--formats", default="wav,flac,m4a", help="comma-separated, from: " + ", ".join(INPUT_FORMATS))
+    load.add_argument("--durations", default="1m,10m", help="comma-separated input lengths, e.g. 1m,30m,3h")
+    load.add_argument("--requests", type=int, default=8, help="requests per input")
+    load.add_argument("--concurrency", type=int, default=4)
+    load.add_argument("--encoders", default="default", help="comma-separated encoder profiles, each run on every input")
+    load.add_argument("--url", help="benchmark a running server instead of the app in this process")
+    load.add_argument("--server-pid", type=int, help="process to sample RSS from when using --url")
+    load.add_argument("--output", help="write the results as JSON to this file")
+
+    diff = sub.add_parser("compare", help="compare two JSON results of the load benchmark")
+    diff.add_argument("before")
+    diff.add_argument("after")
+
+    args = parser.parse_args(argv)
+    if args.command == "tagging":
+        _print_tagging(bench_tagging(args.seconds, args.runs), args.seconds)
+    elif args.command == "warm":
+        _print_warm(bench_warm(args.seconds, args.runs), args.seconds)
+    elif args.command == "segments":
+        workers = [int(w) for w in args.workers.split(",") if w.strip()]
+        _print_segments(bench_segments(args.seconds, workers, args.segment_seconds), args.seconds)
+    elif args.command == "load":
+        formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+        unknown = [f for f in formats if f not in INPUT_FORMATS]
+        if unknown:
+            parser.error(f"unknown formats: {', '.join(unknown)}")
+        durations = [parse_duration(d) for d in args.durations.split(",") if d.strip()]
+        encoder_names = tuple(e.strip() for e in args.encoders.split(",") if e.strip())
+        results = bench_load(formats, durations, args.requests, args.concurrency, args.url, args.server_pid, encoder_names)
+        _print_load(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    elif args.command == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        _print_compare(compare(before, after), before, after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Optional
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+
+def cache_key(input_sha256: str, settings: str) -> str:
+    return hashlib.sha256(f"{input_sha256}:{settings}".encode()).hexdigest()
+
+
+class ResultCache:
+    """Untagged MP3 frames on local disk, keyed by input hash + encoder settings.
+
+    Least recently used entries are evicted once the total size exceeds
+    `max_bytes`. Recency survives restarts through the files' mtimes.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.mp3")
+
+    def _load(self) -> None:
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".mp3"):
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                found.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+        logger.debug("Result cache at %s: %s entries, %s bytes", self.root, len(self._entries), self.size)
+        self._evict()
+
+    @property
+    def size(self) -> int:
+        return sum(self._entries.values())
+
+    def open(self, key: str) -> Optional[BinaryIO]:
+        """Return the cached frames opened for reading, or None on a miss."""
+        with self._lock:
+            try:
+                f = open(self._path(key), "rb")
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                # Never cached, or evicted by another process sharing the directory
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Put there by another process sharing the directory
+                self._entries[key] = os.fstat(f.fileno()).st_size
+                self._evict()
+            self.hits += 1
+            return f
+
+    def put(self, key: str, frames_path: str) -> None:
+        """Move an encoded file into the cache."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Land next to the final path first so readers never see a partial file
+        fd, staging = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        os.close(fd)
+        shutil.move(frames_path, staging)
+        os.replace(staging, path)
+        with self._lock:
+            self._entries[key] = os.path.getsize(path)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self.size
+        while total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+            logger.debug("Evicted %s from result cache (%s bytes)", key, size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache: Optional[ResultCache] = None
+
+
+def configure(share: int = 1) -> Optional[ResultCache]:
+    """`share` processes of one server each get that part of CACHE_MAX_BYTES."""
+    global _cache
+    max_bytes = int(os.environ.get("CACHE_MAX_BYTES", "").strip() or 1024 ** 3) // share
+    if max_bytes <= 0:
+        _cache = None
+        return None
+    root = os.environ.get("CACHE_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "audio-producer-cache")
+    _cache = ResultCache(root, max_bytes)
+    return _cache
+
+
+def get_cache() -> Optional[ResultCache]:
+    return _cache
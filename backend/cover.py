@@ -0,0 +1,157 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from typing import Optional
+
+from fastapi import HTTPException
+from PIL import Image
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+# Decoding a huge image is a cheap way to exhaust memory; no cover needs more
+Image.MAX_IMAGE_PIXELS = 64 * 1024 * 1024
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """Image format from the magic bytes, or None if it isn't one we accept."""
+    for signature, name in _SIGNATURES:
+        if data.startswith(signature):
+            return name
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def normalize(data: bytes, max_px: int, max_bytes: int) -> bytes:
+    """Downscale to at most `max_px` on the long side and re-encode as progressive JPEG under `max_bytes`.
+
+    A JPEG that already fits both limits is returned unchanged, so it isn't
+    recompressed again. Raises ValueError for anything that isn't a usable
+    JPEG, PNG, GIF or WebP image.
+    """
+    kind = sniff_format(data)
+    if kind is None:
+        raise ValueError("not a JPEG, PNG, GIF or WebP image")
+    try:
+        image = Image.open(io.BytesIO(data), formats=[kind])
+        if kind == "JPEG" and max(image.size) <= max_px and len(data) <= max_bytes:
+            return data
+        # Let the JPEG decoder skip detail we would throw away anyway
+        image.draft("RGB", (max_px, max_px))
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"unreadable {kind} image: {e}") from e
+
+    if image.mode in ("RGBA", "LA", "P"):
+        # JPEG has no alpha; put transparent covers on white, as players would
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+
+    image.thumbnail((max_px, max_px), Image.LANCZOS)
+    while True:
+        for quality in (90, 85, 80, 75, 70, 60, 50):
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=quality, progressive=True, optimize=True)
+            if out.tell() <= max_bytes:
+                return out.getvalue()
+        if max(image.size) <= 64:
+            return out.getvalue()
+        # Still too big at the lowest quality we accept: give up pixels instead
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    fd, staging = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(staging, path)
+
+
+def restore(path: str, data: bytes) -> None:
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+
+
+class CoverCache:
+    """Normalized covers on local disk, keyed by the hash of the original bytes and the limits.
+
+    The same image is processed once no matter how often it is uploaded or
+    how many profiles use it. The oldest files are removed beyond `max_entries`.
+    """
+
+    def __init__(self, root: str, max_px: int, max_bytes: int, max_entries: int = 256):
+        self.root = root
+        self.max_px = max_px
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.processed = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, data: bytes) -> str:
+        """Path of the normalized variant of `data`, processing it on first use."""
+        key = hashlib.sha256(data + f":{self.max_px}:{self.max_bytes}".encode()).hexdigest()
+        path = os.path.join(self.root, f"{key}.jpg")
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+
+        normalized = normalize(data, self.max_px, self.max_bytes)
+        _write_atomic(path, normalized)
+        with self._lock:
+            self.processed += 1
+            self._evict()
+        logger.debug("Normalized cover: %s -> %s bytes", len(data), len(normalized))
+        return path
+
+    def from_upload(self, data: bytes) -> str:
+        try:
+            return self.path(data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Unsupported cover image: {e}") from e
+
+    def _evict(self) -> None:
+        entries = [e for e in os.scandir(self.root) if e.name.endswith(".jpg")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[: len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+_cache: Optional[CoverCache] = None
+
+
+def configure() -> CoverCache:
+    global _cache
+    root = os.environ.get("COVER_CACHE_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "audio-producer-covers")
+    _cache = CoverCache(
+        root,
+        max_px=int(os.environ.get("COVER_MAX_PX", "").strip() or 1400),
+        max_bytes=int(os.environ.get("COVER_MAX_BYTES", "").strip() or 500 * 1024),
+    )
+    return _cache
+
+
+def get_cache() -> CoverCache:
+    if _cache is None:
+        return configure()
+    return _cache
@@ -0,0 +1,136 @@
+import os
+import re
+from typing import Optional
+
+import anyio
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """Return the inclusive (start, end) of a single byte range, None to send everything.
+
+    Raises ValueError if the range can't be satisfied.
+    """
+    match = _RANGE_RE.match((header or "").strip())
+    if not match:
+        # No range, or several of them: answering with the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def etag(st: os.stat_result) -> str:
+    """A strong validator that changes whenever the file is replaced or rewritten."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _matches(header: Optional[str], tag: str) -> bool:
+    # If-None-Match compares weakly: W/"x" matches "x"
+    if not header:
+        return False
+    candidates = [c.strip().removeprefix("W/") for c in header.split(",")]
+    return "*" in candidates or tag in candidates
+
+
+class FileDownload(Response):
+    """A file on disk, answered according to the request's Range and conditional headers.
+
+    Handles If-None-Match (304), If-Range and a single byte range (206/416),
+    and sends Content-Length and an ETag. The body goes out through the
+    server's zero-copy extension when it offers one, and is otherwise read
+    in large chunks off the event loop.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path: str, media_type: str, headers: Optional[dict] = None, background=None):
+        self.path = path
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = background
+        self.init_headers(headers)
+
+    def _answer(self, scope, size: int, tag: str) -> tuple[int, Optional[tuple[int, int]], dict]:
+        request_headers = Headers(scope=scope)
+        headers = {"Accept-Ranges": "bytes", "ETag": tag}
+        if _matches(request_headers.get("if-none-match"), tag):
+            return 304, None, headers
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if if_range is not None and if_range.strip() != tag:
+            # The client's partial copy is of another version
+            range_header = None
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return 416, None, {**headers, "Content-Range": f"bytes */{size}"}
+        if byte_range is None:
+            return 200, (0, size - 1), {**headers, "Content-Length": str(size)}
+        start, end = byte_range
+        logger.debug("Serving bytes %s-%s/%s of %s", start, end, size, self.path)
+        return 206, byte_range, {**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+
+    async def __call__(self, scope, receive, send) -> None:
+        # Opened before answering: a result replaced in the meantime is still sent whole
+        try:
+            f = await anyio.to_thread.run_sync(open, self.path, "rb")
+        except FileNotFoundError:
+            # Evicted between the lookup and now
+            await Response(status_code=404)(scope, receive, send)
+            return
+        try:
+            st = os.fstat(f.fileno())
+            status, byte_range, headers = self._answer(scope, st.st_size, etag(st))
+            if status == 416:
+                headers["Content-Length"] = "0"
+            # Which of these apply depends on the answer
+            raw_headers = [(k, v) for k, v in self.raw_headers if k not in (b"content-type", b"content-length")]
+            if status not in (304, 416):
+                headers["Content-Type"] = self.media_type
+            raw_headers += [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+            await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+
+            if byte_range is None or scope["method"].upper() == "HEAD" or st.st_size == 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            else:
+                await self._send_body(scope, send, f, *byte_range)
+        finally:
+            f.close()
+        if self.background is not None:
+            await self.background()
+
+    async def _send_body(self, scope, send, f, start: int, end: int) -> None:
+        count = end - start + 1
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            await send({"type": "http.response.zerocopysend", "file": f, "offset": start, "count": count, "more_body": False})
+            return
+        position = start
+        while count > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, f.fileno(), min(self.chunk_size, count), position)
+            if not chunk:
+                break
+            position += len(chunk)
+            count -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+        if count > 0:
+            # Truncated underneath us; end the body rather than hang the client
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,162 @@
+import json
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+from mutagen import MutagenError
+from mutagen.mp3 import MP3, BitrateMode
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+DEFAULT_ENCODER = "default"
+
+# Copy the MP3 frames as they are, only the tags change
+COPY_ARGS = ["-c:a", "copy"]
+
+
+class EncoderProfile:
+    """LAME settings: either constant `bitrate` in kbit/s or VBR `quality` (0 best, 9 smallest).
+
+    `channels` and `sample_rate` are left as the input has them when None.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        bitrate: Optional[int] = None,
+        quality: Optional[int] = None,
+        channels: Optional[int] = None,
+        sample_rate: Optional[int] = None,
+    ):
+        if (bitrate is None) == (quality is None):
+            raise ValueError(f"encoder {name!r} needs either a bitrate or a quality")
+        self.name = name
+        self.bitrate = bitrate
+        self.quality = quality
+        self.channels = channels
+        self.sample_rate = sample_rate
+
+    def args(self) -> list[str]:
+        args = ["-c:a", "libmp3lame"]
+        if self.bitrate is not None:
+            args += ["-b:a", f"{self.bitrate}k"]
+        else:
+            args += ["-q:a", str(self.quality)]
+        if self.channels:
+            args += ["-ac", str(self.channels)]
+        if self.sample_rate:
+            args += ["-ar", str(self.sample_rate)]
+        return args
+
+    def settings(self) -> str:
+        return " ".join(self.args())
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "bitrate": self.bitrate,
+            "quality": self.quality,
+            "channels": self.channels,
+            "sample_rate": self.sample_rate,
+        }
+
+    def can_copy(self, audio_in: str) -> bool:
+        """Whether `audio_in` is an MP3 that already is what this profile would produce.
+
+        Only constant bitrates can be checked from the file; a VBR quality
+        level leaves no trace in it, so VBR profiles always re-encode. So do
+        inputs without a Xing/LAME header: mutagen only sees their first
+        frame, and a VBR file can start at any bitrate.
+        """
+        if self.bitrate is None:
+            return False
+        info = probe_mp3(audio_in)
+        if info is None or info.bitrate_mode != BitrateMode.CBR:
+            return False
+        # mutagen derives the bitrate from the Info frame's totals, so it can be off by a bit/s;
+        # the standard bitrates are far enough apart for a 1% margin
+        return (
+            abs(info.bitrate - self.bitrate * 1000) <= self.bitrate * 10
+            and (not self.channels or info.channels == self.channels)
+            and (not self.sample_rate or info.sample_rate == self.sample_rate)
+        )
+
+    def encoder_args(self, audio_in: str, filters: Optional[str]) -> list[str]:
+        """Arguments for encoding `audio_in`, or COPY_ARGS when re-encoding would change nothing. Blocks."""
+        if not filters and self.can_copy(audio_in):
+            logger.debug("Input already matches encoder %s, copying the stream", self.name)
+            return COPY_ARGS
+        return self.args()
+
+
+def probe_mp3(path: str):
+    """mutagen's MPEGInfo if `path` starts like an MP3 file, else None."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(3)
+    except OSError:
+        return None
+    # An ID3v2 tag or an MPEG frame sync; saves mutagen from hunting for frames in a WAV
+    if not (head == b"ID3" or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)):
+        return None
+    try:
+        return MP3(path).info
+    except MutagenError:
+        return None
+
+
+BUILTIN_ENCODERS = {
+    # What every conversion used before profiles existed; keeps cached results valid
+    DEFAULT_ENCODER: dict(quality=2),
+    "speech-mono-64k": dict(bitrate=64, channels=1),
+    "music-v2": dict(quality=2, channels=2),
+    "archive-320": dict(bitrate=320),
+}
+
+
+class EncoderRegistry:
+    """Named encoder profiles: the built-in ones plus any from a JSON file, loaded at startup.
+
+        {"speech-mono-48k": {"bitrate": 48, "channels": 1, "sample_rate": 32000}}
+
+    `default` names the profile used when a request doesn't pick one.
+    """
+
+    def __init__(self, definitions: dict, default: str = DEFAULT_ENCODER):
+        self._profiles = {name: EncoderProfile(name, **settings) for name, settings in definitions.items()}
+        if default not in self._profiles:
+            raise ValueError(f"default encoder {default!r} is not defined")
+        self.default = default
+
+    def get(self, name: Optional[str] = None) -> EncoderProfile:
+        profile = self._profiles.get(name or self.default)
+        if profile is None:
+            raise HTTPException(status_code=422, detail=f"Unknown encoder: {name}")
+        return profile
+
+    def names(self) -> list[str]:
+        return list(self._profiles)
+
+
+_registry: Optional[EncoderRegistry] = None
+
+
+def configure() -> EncoderRegistry:
+    global _registry
+    definitions = dict(BUILTIN_ENCODERS)
+    path = os.environ.get("ENCODER_PROFILES_FILE", "").strip()
+    if path:
+        with open(path) as f:
+            definitions.update(json.load(f))
+    _registry = EncoderRegistry(definitions, os.environ.get("ENCODER_PROFILE", "").strip() or DEFAULT_ENCODER)
+    logger.info(f"Encoder profiles: {', '.join(_registry.names())} (default: {_registry.default})")
+    return _registry
+
+
+def get_registry() -> EncoderRegistry:
+    if _registry is None:
+        return configure()
+    return _registry
@@ -0,0 +1,136 @@
+import base64
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend import encoders, log, metrics, mp3
+
+logger = log.getLogger(__name__)
+
+DEFAULT_FORMAT = "mp3"
+
+
+class OutputFormat:
+    """A container and codec an episode can be delivered in, and how its tags are written."""
+
+    name = ""
+    extension = ""
+    media_type = ""
+
+    def encoder_args(self, encoder: encoders.EncoderProfile, mp3_args: list[str]) -> list[str]:
+        """Codec arguments for this output; `mp3_args` are what the MP3 output would use."""
+        raise NotImplementedError
+
+    def write_tags(self, path: str, **tags) -> None:
+        """Tag a finished file with the keyword arguments of TagProfile.tags()."""
+        raise NotImplementedError
+
+    def tagged(self, path: str, **tags) -> str:
+        """Tag the untagged file ffmpeg wrote to `path`; returns where the tagged file is."""
+        self.write_tags(path, **tags)
+        return path
+
+
+class Mp3Format(OutputFormat):
+    name = "mp3"
+    extension = "mp3"
+    media_type = "audio/mpeg"
+
+    def encoder_args(self, encoder: encoders.EncoderProfile, mp3_args: list[str]) -> list[str]:
+        # May be the stream copy of an input that already matches
+        return mp3_args
+
+    def write_tags(self, path: str, **tags) -> None:
+        mp3.write_id3_tags(path, **tags)
+
+    def tagged(self, path: str, **tags) -> str:
+        # A tag in front means writing the whole file again either way; the kernel
+        # copying the frames behind it beats mutagen reading and rewriting them
+        tagged_path = os.path.splitext(path)[0] + ".tagged.mp3"
+        header = mp3.build_id3_header(**tags)
+        with open(path, "rb") as frames:
+            mp3.copy_with_header(frames, tagged_path, header)
+        os.remove(path)
+        return tagged_path
+
+
+class M4aFormat(OutputFormat):
+    """AAC in an MP4 container, with iTunes-style atoms."""
+
+    name = "m4a"
+    extension = "m4a"
+    media_type = "audio/mp4"
+
+    def encoder_args(self, encoder: encoders.EncoderProfile, mp3_args: list[str]) -> list[str]:
+        # AAC at the profile's bitrate sounds at least as good as the MP3; VBR profiles get 128k
+        args = ["-c:a", "aac", "-b:a", f"{encoder.bitrate or 128}k"]
+        if encoder.channels:
+            args += ["-ac", str(encoder.channels)]
+        if encoder.sample_rate:
+            args += ["-ar", str(encoder.sample_rate)]
+        # The index goes first, so players can start before the whole file is loaded
+        return args + ["-movflags", "+faststart"]
+
+    def write_tags(self, path: str, *, title, album, artist, album_artist, year, genre, cover_path, cover_mime) -> None:
+        # Only needed for the rarer formats, not imported up front
+        from mutagen.mp4 import MP4, MP4Cover
+
+        with metrics.stage("tag"):
+            audio = MP4(path)
+            if audio.tags is None:
+                audio.add_tags()
+            values = {"\xa9nam": title, "\xa9alb": album, "\xa9ART": artist, "aART": album_artist, "\xa9day": year, "\xa9gen": genre}
+            for key, value in values.items():
+                if value:
+                    audio.tags[key] = [value]
+            with open(cover_path, "rb") as f:
+                image_format = MP4Cover.FORMAT_PNG if cover_mime == "image/png" else MP4Cover.FORMAT_JPEG
+                audio.tags["covr"] = [MP4Cover(f.read(), imageformat=image_format)]
+            audio.save()
+
+
+class OpusFormat(OutputFormat):
+    """Opus in Ogg, with Vorbis comments and the cover as a METADATA_BLOCK_PICTURE."""
+
+    name = "opus"
+    extension = "opus"
+    media_type = "audio/ogg"
+
+    def encoder_args(self, encoder: encoders.EncoderProfile, mp3_args: list[str]) -> list[str]:
+        # Opus only runs at 48 kHz and below, ffmpeg resamples to what libopus supports
+        args = ["-c:a", "libopus", "-b:a", f"{min(encoder.bitrate or 96, 256)}k"]
+        if encoder.channels:
+            args += ["-ac", str(encoder.channels)]
+        return args
+
+    def write_tags(self, path: str, *, title, album, artist, album_artist, year, genre, cover_path, cover_mime) -> None:
+        from mutagen.flac import Picture
+        from mutagen.oggopus import OggOpus
+
+        with metrics.stage("tag"):
+            audio = OggOpus(path)
+            values = {"title": title, "album": album, "artist": artist, "albumartist": album_artist, "date": year, "genre": genre}
+            for key, value in values.items():
+                if value:
+                    audio[key] = [value]
+            picture = Picture()
+            picture.type = 3
+            picture.mime = cover_mime
+            picture.desc = "Cover"
+            with open(cover_path, "rb") as f:
+                picture.data = f.read()
+            audio["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+            audio.save()
+
+
+FORMATS = {f.name: f for f in (Mp3Format(), M4aFormat(), OpusFormat())}
+
+
+def parse(value: Optional[str]) -> list[OutputFormat]:
+    """The formats of a comma-separated list like "mp3,m4a", in order, MP3 when empty."""
+    names = [name.strip().lower() for name in (value or "").split(",") if name.strip()] or [DEFAULT_FORMAT]
+    unknown = [name for name in names if name not in FORMATS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown format: {', '.join(unknown)}; choose from {', '.join(FORMATS)}")
+    return [FORMATS[name] for name in dict.fromkeys(names)]
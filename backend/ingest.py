@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import queue
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from fastapi import HTTPException, Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+# ISO base media (MP4/M4A/MOV/3GP) boxes that may open a file. The moov index
+# can sit at the very end, so ffmpeg has to seek and can't read these from a pipe.
+_ISO_BMFF_BOXES = (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip")
+_SEEKING_EXTENSIONS = (".mp4", ".m4a", ".m4b", ".mov", ".3gp", ".3g2")
+
+SNIFF_BYTES = 12
+# What an AudioSink's inspect() gets to see: enough for a WAV or FLAC header
+HEAD_BYTES = 4096
+
+
+class PipeAborted(Exception):
+    pass
+
+
+_ABORT = object()
+
+
+def needs_seekable_input(head: bytes, filename: str) -> bool:
+    if head[4:8] in _ISO_BMFF_BOXES:
+        return True
+    return (filename or "").lower().endswith(_SEEKING_EXTENSIONS)
+
+
+class AudioSink:
+    """Destination for the audio part of an upload, chosen from its first bytes.
+
+    Inputs ffmpeg can read sequentially are handed to `start_pipe(chunks,
+    info)` as an iterator of chunks while the upload is still arriving;
+    containers that need seeking (or every input, when `start_pipe` is None)
+    are spooled to `path`. `job` is the future returned by `start_pipe`, if it was used.
+    The SHA-256 of the audio is computed on the way through.
+
+    `inspect(head, filename)` sees the first HEAD_BYTES before anything is
+    piped or spooled; what it returns is kept as `info`, and an exception
+    it raises rejects the upload there. Beyond `max_bytes` the upload is
+    rejected with 413. A piped encode that gets no chunk for `stall_s` is
+    aborted, so a sink nobody closes can't hold its worker forever.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        filename: str,
+        start_pipe: Optional[Callable[[Iterator[bytes], dict], asyncio.Future]] = None,
+        queue_size: int = 16,
+        inspect: Optional[Callable[[bytes, str], dict]] = None,
+        max_bytes: int = 0,
+        stall_s: float = 300,
+    ):
+        self.path = path
+        self.filename = filename
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.job: Optional[asyncio.Future] = None
+        self.info: dict = {}
+        self._start_pipe = start_pipe
+        self._inspect = inspect
+        self._head_bytes = HEAD_BYTES if inspect else SNIFF_BYTES
+        self._max_bytes = max_bytes
+        self._stall_s = stall_s
+        self._head = b""
+        self._file = None
+        self._chunks: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._started = False
+
+    @property
+    def piped(self) -> bool:
+        return self.job is not None
+
+    def _start(self) -> None:
+        if self._inspect is not None:
+            self.info = self._inspect(self._head, self.filename)
+        self._started = True
+        if self._start_pipe is not None and not needs_seekable_input(self._head, self.filename):
+            logger.debug("Piping %r straight into the encoder", self.filename)
+            self.job = self._start_pipe(self._drain(), self.info)
+        else:
+            logger.debug("Spooling %r to %s", self.filename, self.path)
+            self._file = open(self.path, "wb")
+
+    def _drain(self) -> Iterator[bytes]:
+        while True:
+            try:
+                item = self._chunks.get(timeout=self._stall_s)
+            except queue.Empty:
+                logger.debug("No more of %r for %ss, aborting its encode", self.filename, self._stall_s)
+                raise PipeAborted()
+            if item is None:
+                return
+            if item is _ABORT:
+                raise PipeAborted()
+            yield item
+
+    async def _put(self, item) -> None:
+        try:
+            self._chunks.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        # Wait for the encoder to catch up, unless it has already stopped reading
+        while not self.job.done():
+            try:
+                await asyncio.to_thread(self._chunks.put, item, True, 1)
+                return
+            except queue.Full:
+                continue
+
+    async def _forward(self, chunk: bytes) -> None:
+        if self._file is not None:
+            await asyncio.to_thread(self._file.write, chunk)
+        elif not self.job.done():
+            await self._put(chunk)
+
+    async def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self._max_bytes and self.size > self._max_bytes:
+            raise HTTPException(status_code=413, detail=f"Audio files are limited to {self._max_bytes} bytes")
+        self.sha256.update(chunk)
+        if not self._started:
+            self._head += chunk
+            if len(self._head) < self._head_bytes:
+                return
+            self._start()
+            chunk, self._head = self._head, b""
+        await self._forward(chunk)
+
+    async def close(self) -> None:
+        if not self._started:
+            self._start()
+            if self._head:
+                await self._forward(self._head)
+        if self._file is not None:
+            self._file.close()
+        elif self.job is not None:
+            await self._put(None)
+
+    async def abort(self) -> None:
+        """Stop a piped encode early, e.g. because its result is not needed."""
+        if self._file is not None:
+            self._file.close()
+        elif self.job is not None:
+            await self._put(_ABORT)
+
+
+async def iter_multipart(request: Request) -> AsyncIterator[tuple]:
+    """Parse a multipart/form-data body incrementally while it is being received.
+
+    Yields ("field", name, value) for plain fields, and for file fields
+    ("file", name, filename) followed by ("data", chunk) events as the bytes
+    arrive and a final ("file_end", name). Nothing is spooled to disk.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=422, detail="Expected a multipart/form-data body")
+
+    events: list[tuple] = []
+    part: dict = {}
+
+    def on_part_begin():
+        part.clear()
+        part.update(headers={}, field=b"", value=b"", data=[])
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = options.get(b"name", b"").decode("utf-8", errors="replace")
+        filename = options.get(b"filename")
+        part["is_file"] = filename is not None
+        if part["is_file"]:
+            events.append(("file", part["name"], filename.decode("utf-8", errors="replace")))
+
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            events.append(("data", data[start:end]))
+        else:
+            part["data"].append(data[start:end])
+
+    def on_part_end():
+        if part["is_file"]:
+            events.append(("file_end", part["name"]))
+        else:
+            value = b"".join(part["data"]).decode("utf-8", errors="replace")
+            events.append(("field", part["name"], value))
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+        },
+    )
+
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                parser.write(chunk)
+            for event in events:
+                yield event
+            events.clear()
+        parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}") from e
+    for event in events:
+        yield event
@@ -0,0 +1,510 @@
+import os
+import queue
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from backend import log, pool
+
+logger = log.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FIELDS = (
+    "id",
+    "status",
+    "progress",
+    "title",
+    "speaker",
+    "profile",
+    "processing",
+    "encoder",
+    "formats",
+    "input_sha256",
+    "filename",
+    "error",
+    "created_at",
+    "updated_at",
+    "worker",
+    "lease_until",
+    "attempts",
+)
+# Added after the first release, older databases get them on open
+_ADDED_COLUMNS = {
+    "profile": "TEXT",
+    "processing": "TEXT",
+    "encoder": "TEXT",
+    "input_sha256": "TEXT",
+    "formats": "TEXT",
+    "worker": "TEXT",
+    "lease_until": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def _gave_up(attempts: int) -> str:
+    return f"Gave up after {attempts} attempts: the worker stopped responding"
+
+
+class JobStore:
+    """Persistence for job records, and the queue workers claim them from.
+
+    Subclass to keep jobs somewhere else, e.g. in a database every worker node can reach.
+    """
+
+    def create(self, job: dict) -> None:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, **fields) -> None:
+        raise NotImplementedError
+
+    def unfinished(self) -> list[dict]:
+        raise NotImplementedError
+
+    def claim(self, worker: str, lease_s: float, max_attempts: int) -> Optional[dict]:
+        """Take the oldest job that is queued or whose worker's lease ran out, leased to `worker`.
+
+        A job already tried `max_attempts` times fails instead of being handed out again.
+        """
+        raise NotImplementedError
+
+    def renew(self, job_id: str, worker: str, lease_s: float) -> bool:
+        """Extend `worker`'s lease on a job; False if the job is no longer its own."""
+        raise NotImplementedError
+
+    def finish(self, job_id: str, worker: str, **fields) -> bool:
+        """Update a job and end `worker`'s lease on it; False if the job is no longer its own."""
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Jobs are lost when the process exits."""
+
+    def __init__(self):
+        self._jobs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict) -> None:
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def unfinished(self) -> list[dict]:
+        with self._lock:
+            jobs = [dict(j) for j in self._jobs.values() if j["status"] in (QUEUED, RUNNING)]
+        return sorted(jobs, key=lambda j: j["created_at"])
+
+    def claim(self, worker: str, lease_s: float, max_attempts: int) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            for job in sorted(self._jobs.values(), key=lambda j: j["created_at"]):
+                expired = job["status"] == RUNNING and (job.get("lease_until") or 0) < now
+                if expired and (job.get("attempts") or 0) >= max_attempts:
+                    job.update(status=FAILED, error=_gave_up(job["attempts"]), worker=None, lease_until=None, updated_at=now)
+                elif job["status"] == QUEUED or expired:
+                    attempts = (job.get("attempts") or 0) + 1
+                    job.update(status=RUNNING, progress=0, worker=worker, lease_until=now + lease_s, attempts=attempts, updated_at=now)
+                    return dict(job)
+        return None
+
+    def renew(self, job_id: str, worker: str, lease_s: float) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING or job.get("worker") != worker:
+                return False
+            job["lease_until"] = time.time() + lease_s
+            return True
+
+    def finish(self, job_id: str, worker: str, **fields) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != RUNNING or job.get("worker") != worker:
+                return False
+            job.update(fields, worker=None, lease_until=None, updated_at=time.time())
+            return True
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs survive a restart of the worker process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Worker processes share the file; wait for each other's writes instead of failing
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                title TEXT NOT NULL,
+                speaker TEXT NOT NULL,
+                profile TEXT,
+                processing TEXT,
+                encoder TEXT,
+                formats TEXT,
+                input_sha256 TEXT,
+                filename TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # Databases created by older versions lack the newer columns
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for name, column_type in _ADDED_COLUMNS.items():
+            if name not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+
+    def create(self, job: dict) -> None:
+        with self._lock:
+            self._db.execute(
+                f"INSERT INTO jobs ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+                [job.get(name, 0 if name == "attempts" else None) for name in FIELDS],
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), job_id])
+
+    def unfinished(self) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, worker: str, lease_s: float, max_attempts: int) -> Optional[dict]:
+        now = time.time()
+        # No lease at all: running under an in-process runner that died
+        expired = "status = ? AND (lease_until IS NULL OR lease_until < ?)"
+        with self._lock:
+            self._db.execute(
+                f"UPDATE jobs SET status = ?, error = 'Gave up after ' || attempts || ' attempts: the worker stopped responding', "
+                f"worker = NULL, lease_until = NULL, updated_at = ? WHERE {expired} AND attempts >= ?",
+                (FAILED, now, RUNNING, now, max_attempts),
+            )
+            # One statement, so two workers can never claim the same job
+            row = self._db.execute(
+                f"""
+                UPDATE jobs SET status = ?, progress = 0, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+                WHERE id = (SELECT id FROM jobs WHERE status = ? OR ({expired}) ORDER BY created_at LIMIT 1)
+                RETURNING *
+                """,
+                (RUNNING, worker, now + lease_s, now, QUEUED, RUNNING, now),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def renew(self, job_id: str, worker: str, lease_s: float) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND worker = ?",
+                (time.time() + lease_s, job_id, RUNNING, worker),
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, worker: str, **fields) -> bool:
+        fields.update(worker=None, lease_until=None, updated_at=time.time())
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status = ? AND worker = ?",
+                [*fields.values(), job_id, RUNNING, worker],
+            )
+        return cursor.rowcount == 1
+
+
+def _execute(store: JobStore, convert: Callable, job: dict, job_dir: str, finish: Callable) -> None:
+    """Run a claimed job, keeping its progress and its outcome in the store; `finish` records the outcome."""
+    job_id = job["id"]
+    reported = [0.0]
+
+    def on_progress(percent: float) -> None:
+        # Only hit the store when the visible percentage moves
+        if int(percent) > int(reported[0]):
+            reported[0] = percent
+            store.update(job_id, progress=round(percent, 1))
+
+    try:
+        convert(job, job_dir, on_progress)
+    except HTTPException as e:
+        logger.warning(f"Job {job_id} failed: {e.detail}")
+        finish(status=FAILED, error=str(e.detail))
+    except Exception as e:
+        logger.exception(f"Job {job_id} failed: {e}")
+        finish(status=FAILED, error=f"Conversion failed: {e}")
+    else:
+        finish(status=DONE, progress=100)
+        logger.debug("Job %s done", job_id)
+
+
+class JobRunner:
+    """In-process queue that feeds jobs to the conversion pool.
+
+    At most `concurrency` jobs occupy pool slots at once (half the workers by
+    default) so interactive /api/convert requests still get one. When the pool is full the
+    dispatcher waits for its Retry-After instead of failing the job.
+
+    With `dispatch` off jobs are only stored, for JobWorkers in other processes to claim.
+    """
+
+    def __init__(self, store: JobStore, root: str, convert: Callable, concurrency: int, dispatch: bool = True):
+        self.store = store
+        self.root = root
+        self.dispatch = dispatch
+        self._convert = convert
+        self._queue: queue.Queue = queue.Queue()
+        self._slots = threading.Semaphore(max(1, concurrency))
+        self._thread = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def start(self) -> None:
+        if not self.dispatch:
+            return
+        # Anything queued or running when the last process died starts over
+        for job in self.store.unfinished():
+            logger.info(f"Re-queueing job {job['id']} ({job['status']})")
+            self.store.update(job["id"], status=QUEUED, progress=0)
+            self._queue.put(job["id"])
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._queue.put(None)
+
+    def create(
+        self,
+        *,
+        title: str,
+        speaker: str,
+        filename: str,
+        profile: Optional[str] = None,
+        processing: Optional[str] = None,
+        encoder: Optional[str] = None,
+        formats: Optional[str] = None,
+        input_sha256: Optional[str] = None,
+    ) -> dict:
+        now = time.time()
+        job = dict(
+            id=uuid.uuid4().hex,
+            status=QUEUED,
+            progress=0,
+            title=title,
+            speaker=speaker,
+            profile=profile,
+            processing=processing,
+            encoder=encoder,
+            formats=formats,
+            input_sha256=input_sha256,
+            filename=filename,
+            error=None,
+            created_at=now,
+            updated_at=now,
+            worker=None,
+            lease_until=None,
+            attempts=0,
+        )
+        os.makedirs(self.job_dir(job["id"]))
+        return job
+
+    def submit(self, job: dict) -> None:
+        self.store.create(job)
+        if self.dispatch:
+            self._queue.put(job["id"])
+
+    def _dispatch(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            self._slots.acquire()
+            while True:
+                try:
+                    future = pool.get_pool().execute(self._run, job_id)
+                    break
+                except HTTPException as e:
+                    time.sleep(int(e.headers.get("Retry-After", "1")))
+            future.add_done_callback(lambda _: self._slots.release())
+
+    def _run(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        self.store.update(job_id, status=RUNNING, progress=0)
+        _execute(self.store, self._convert, job, self.job_dir(job_id), lambda **fields: self.store.update(job_id, **fields))
+
+
+class JobWorker:
+    """Claims jobs from a store shared with the API and runs `concurrency` of them at once.
+
+    Any number of workers can share the store and JOBS_DIR, in more processes
+    or on more hosts. A worker renews the lease on each of its jobs every
+    third of `lease_s`; when it dies, the lease runs out and another worker
+    starts the job over, up to `max_attempts` times in all.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        root: str,
+        convert: Callable,
+        concurrency: int,
+        lease_s: float = 60,
+        max_attempts: int = 3,
+        poll_s: float = 1.0,
+        name: Optional[str] = None,
+    ):
+        self.store = store
+        self.root = root
+        self.lease_s = lease_s
+        self.max_attempts = max(1, max_attempts)
+        self.poll_s = poll_s
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self._convert = convert
+        self._running: set[str] = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{n}", daemon=True) for n in range(max(1, concurrency))
+        ]
+        self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def start(self) -> None:
+        logger.info(f"Worker {self.name} taking up to {len(self._threads)} jobs at once")
+        self._heartbeat.start()
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout_s: Optional[float] = None) -> None:
+        """Take no more jobs and wait for the running ones, whose leases are kept alive meanwhile."""
+        self._stopping.set()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout_s)
+        self._stopped.set()
+
+    def _work(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = self.store.claim(self.name, self.lease_s, self.max_attempts)
+            except Exception:
+                logger.exception("Claiming a job failed")
+                job = None
+            if job is None:
+                self._stopping.wait(self.poll_s)
+                continue
+            logger.info(f"Worker {self.name} running job {job['id']} (attempt {job['attempts']})")
+            with self._lock:
+                self._running.add(job["id"])
+            try:
+                _execute(self.store, self._convert, job, self.job_dir(job["id"]), lambda **fields: self._finish(job["id"], fields))
+            finally:
+                with self._lock:
+                    self._running.discard(job["id"])
+
+    def _finish(self, job_id: str, fields: dict) -> None:
+        if not self.store.finish(job_id, self.name, **fields):
+            logger.warning(f"Job {job_id} was taken over by another worker, dropping this outcome")
+
+    def _beat(self) -> None:
+        while not self._stopped.wait(self.lease_s / 3):
+            with self._lock:
+                running = list(self._running)
+            for job_id in running:
+                try:
+                    if not self.store.renew(job_id, self.name, self.lease_s):
+                        logger.warning(f"Lost the lease on job {job_id}")
+                except Exception:
+                    logger.exception(f"Renewing the lease on job {job_id} failed")
+
+
+_runner: Optional[JobRunner] = None
+
+
+def _jobs_root() -> str:
+    root = os.environ.get("JOBS_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "audio-producer-jobs")
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def _open_store(root: str) -> JobStore:
+    if os.environ.get("JOB_STORE", "sqlite") == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore(os.path.join(root, "jobs.sqlite3"))
+
+
+def configure(convert: Callable) -> JobRunner:
+    """The API's side: run jobs in-process, or with JOB_WORKERS=external only queue them."""
+    global _runner
+    if _runner is not None:
+        _runner.stop()
+    root = _jobs_root()
+    store = _open_store(root)
+    concurrency = int(os.environ.get("JOB_CONCURRENCY", "").strip() or max(1, pool.get_pool().workers // 2))
+    dispatch = os.environ.get("JOB_WORKERS", "inline") != "external"
+    _runner = JobRunner(store, root, convert, concurrency, dispatch=dispatch)
+    _runner.start()
+    return _runner
+
+
+def configure_worker(convert: Callable) -> JobWorker:
+    """A JobWorker for the store and JOBS_DIR the API queues to, not yet started."""
+    if os.environ.get("JOB_STORE", "sqlite") == "memory":
+        raise RuntimeError("JOB_STORE=memory can't be shared with a worker process")
+    root = _jobs_root()
+    return JobWorker(
+        _open_store(root),
+        root,
+        convert,
+        _env_int("JOB_CONCURRENCY", os.cpu_count() or 1),
+        lease_s=_env_int("JOB_LEASE", 60) or 60,
+        max_attempts=_env_int("JOB_MAX_ATTEMPTS", 3),
+    )
+
+
+def get_runner() -> JobRunner:
+    return _runner
@@ -1,6 +1,27 @@
 import logging
+import os
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def configure() -> None:
+    """Set up the root logger from LOG_LEVEL (default INFO) and LOG_FORMAT."""
+    level = (os.environ.get("LOG_LEVEL", "").strip() or "INFO").upper()
+    logging.basicConfig(format=os.environ.get("LOG_FORMAT", "").strip() or DEFAULT_FORMAT)
+    # basicConfig does nothing if a server already installed handlers, the level still applies
+    logging.getLogger().setLevel(level)
 
 
 def getLogger(name) -> logging.Logger:
-    logging.basicConfig(level=logging.DEBUG)
     return logging.getLogger(name)
+
+
+class lazy:
+    """Log argument that is only computed when the record is actually formatted."""
+
+    def __init__(self, fn, *args):
+        self._fn = fn
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._fn(*self._args))
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend import log, mp3
+
+logger = log.getLogger(__name__)
+
+MODES = ("off", "fast", "accurate")
+
+# loudnorm resamples to 192 kHz internally; bring the output back to a rate MP3 supports
+OUTPUT_SAMPLE_RATE = 44100
+# Input rates the output keeps instead, saving a resampling step that changes nothing audible
+_KEPT_SAMPLE_RATES = (32000, 44100, 48000)
+# Limiting on an oversampled signal also catches the peaks between samples
+OVERSAMPLED_RATE = 192000
+
+_SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end: (-?\d+(?:\.\d+)?)")
+_LOUDNORM_JSON_RE = re.compile(r"\{[^{}]*\"input_i\"[^{}]*\}")
+_MEASURED = ("input_i", "input_tp", "input_lra", "input_thresh", "target_offset")
+
+_TRUE = ("1", "true", "on", "yes")
+_FALSE = ("", "0", "false", "off", "no")
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name, "").strip()
+    return float(value) if value else default
+
+
+def _flag(name: str, value) -> bool:
+    if isinstance(value, bool):
+        return value
+    value = (value or "").strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False
+    raise HTTPException(status_code=422, detail=f"Invalid value for {name}: {value}")
+
+
+class Processing:
+    """Level processing applied while encoding: EBU R128 loudnorm, silence trimming and a limiter.
+
+    "fast" loudnorm runs in the encoding pass (dynamic mode). "accurate"
+    measures the whole input first and normalizes linearly with the measured
+    values, as does trimming, which needs to know where the trailing silence
+    starts. Both share one analysis pass, see measure().
+    """
+
+    def __init__(
+        self,
+        loudnorm: str = "off",
+        trim_silence: bool = False,
+        limiter: bool = False,
+        *,
+        target_i: float = -16.0,
+        target_tp: float = -1.5,
+        target_lra: float = 11.0,
+        silence_db: float = -50.0,
+        silence_s: float = 0.5,
+    ):
+        self.loudnorm = loudnorm
+        self.trim_silence = trim_silence
+        self.limiter = limiter
+        self.target_i = target_i
+        self.target_tp = target_tp
+        self.target_lra = target_lra
+        self.silence_db = silence_db
+        self.silence_s = silence_s
+
+    @property
+    def needs_analysis(self) -> bool:
+        return self.loudnorm == "accurate" or self.trim_silence
+
+    def options(self) -> dict:
+        """The request fields that select this processing, for from_form()."""
+        return {
+            "loudnorm": self.loudnorm,
+            "trimSilence": "true" if self.trim_silence else "false",
+            "limiter": "true" if self.limiter else "false",
+        }
+
+    def _loudnorm_targets(self) -> str:
+        return f"I={self.target_i:g}:TP={self.target_tp:g}:LRA={self.target_lra:g}"
+
+    def analysis_filters(self) -> str:
+        return (
+            f"silencedetect=n={self.silence_db:g}dB:d={self.silence_s:g},"
+            f"loudnorm={self._loudnorm_targets()}:print_format=json"
+        )
+
+    def settings(self) -> str:
+        """What the processing does to the audio, for cache keys; empty when it does nothing."""
+        parts = []
+        if self.loudnorm != "off":
+            parts.append(f"loudnorm={self.loudnorm}:{self._loudnorm_targets()}")
+        if self.trim_silence:
+            parts.append(f"trim={self.silence_db:g}dB/{self.silence_s:g}s")
+        if self.limiter:
+            parts.append(f"limiter={self.target_tp:g}dBTP")
+        return " ".join(parts)
+
+    def filters(self, analysis: Optional[dict] = None, sample_rate: Optional[int] = None) -> Optional[str]:
+        """The -af chain for the encoding pass; `analysis` is required when needs_analysis.
+
+        `sample_rate` is the input's, if known.
+        """
+        chain = []
+        if self.trim_silence and analysis:
+            trim = f"atrim=start={analysis['speech_start']:.3f}"
+            if analysis["speech_end"] is not None:
+                trim += f":end={analysis['speech_end']:.3f}"
+            chain += [trim, "asetpts=PTS-STARTPTS"]
+
+        measured = (analysis or {}).get("loudness")
+        if self.loudnorm == "accurate" and measured:
+            chain.append(
+                f"loudnorm={self._loudnorm_targets()}"
+                f":measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+                f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+                f":offset={measured['target_offset']}:linear=true"
+            )
+        elif self.loudnorm != "off":
+            # Also the fallback when the input was too quiet to measure
+            chain.append(f"loudnorm={self._loudnorm_targets()}")
+
+        if self.limiter:
+            if self.loudnorm == "off":
+                chain.append(f"aresample={OVERSAMPLED_RATE}")
+            chain.append(f"alimiter=limit={10 ** (self.target_tp / 20):.4f}:level=disabled")
+        if self.loudnorm != "off" or self.limiter:
+            chain.append(f"aresample={sample_rate if sample_rate in _KEPT_SAMPLE_RATES else OUTPUT_SAMPLE_RATE}")
+        return ",".join(chain) or None
+
+
+def from_form(form: dict) -> Processing:
+    """Processing selected by the loudnorm, trimSilence and limiter fields, defaulting to the environment."""
+    mode = (form.get("loudnorm") or os.environ.get("LOUDNORM", "") or "off").strip().lower()
+    if mode not in MODES:
+        raise HTTPException(status_code=422, detail=f"Unknown loudnorm mode: {mode}")
+    return Processing(
+        mode,
+        _flag("trimSilence", form.get("trimSilence")),
+        _flag("limiter", form.get("limiter")),
+        target_i=_env_float("LOUDNORM_I", -16.0),
+        target_tp=_env_float("LOUDNORM_TP", -1.5),
+        target_lra=_env_float("LOUDNORM_LRA", 11.0),
+        silence_db=_env_float("SILENCE_THRESHOLD_DB", -50.0),
+        silence_s=_env_float("SILENCE_MIN_S", 0.5),
+    )
+
+
+def parse_analysis(output: str) -> dict:
+    """Speech boundaries and loudness measurement from the log of an analysis pass.
+
+    `speech_end` is None when the input doesn't end in silence. `loudness`
+    is None when nothing could be measured (e.g. an all-silent input).
+    """
+    duration = mp3._parse_duration(output.encode())
+    starts = [float(m) for m in _SILENCE_START_RE.findall(output)]
+    ends = [float(m) for m in _SILENCE_END_RE.findall(output)]
+    speech_start = 0.0
+    if starts and starts[0] <= 0.01 and ends:
+        speech_start = ends[0]
+    speech_end = None
+    if starts and len(starts) > len(ends):
+        # Silence that is still going on at the end of the input
+        speech_end = starts[-1]
+    elif starts and ends and duration and ends[-1] >= duration - 0.05 and starts[-1] > speech_start:
+        # Newer ffmpeg closes trailing silence at the end of the stream
+        speech_end = starts[-1]
+    if (speech_end is not None and speech_end <= speech_start) or (duration and speech_start >= duration - 0.05):
+        # Nothing but silence: leave it alone rather than produce an empty file
+        speech_start, speech_end = 0.0, None
+
+    loudness = None
+    found = _LOUDNORM_JSON_RE.findall(output)
+    if found:
+        values = json.loads(found[-1])
+        if all(math.isfinite(float(values[key])) for key in _MEASURED):
+            loudness = {key: values[key] for key in _MEASURED}
+    return {"speech_start": speech_start, "speech_end": speech_end, "loudness": loudness}
+
+
+class AnalysisCache:
+    """Results of analysis passes as small JSON files, keyed by input hash and analysis settings.
+
+    The oldest files are removed beyond `max_entries`.
+    """
+
+    def __init__(self, root: str, max_entries: int = 4096):
+        self.root = root
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key)) as f:
+                analysis = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(self._path(key))
+        return analysis
+
+    def put(self, key: str, analysis: dict) -> None:
+        fd, staging = tempfile.mkstemp(dir=self.root, suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            json.dump(analysis, f)
+        os.replace(staging, self._path(key))
+        with self._lock:
+            entries = [e for e in os.scandir(self.root) if e.name.endswith(".json")]
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for entry in entries[: len(entries) - self.max_entries]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def measure(audio_in: str, input_sha256: str, processing: Processing, timeout_s: Optional[int] = 60) -> Optional[dict]:
+    """Run (or reuse) the analysis pass `processing` needs, None if it needs none."""
+    if not processing.needs_analysis:
+        return None
+    filters = processing.analysis_filters()
+    if not input_sha256:
+        # Jobs queued by an older version don't know their hash
+        return parse_analysis(mp3.measure(audio_in, filters, timeout_s))
+    key = hashlib.sha256(f"{input_sha256}:{filters}".encode()).hexdigest()
+    analysis_cache = get_cache()
+    analysis = analysis_cache.get(key)
+    if analysis is not None:
+        logger.debug("Analysis cache hit for %s", key)
+        return analysis
+
+    analysis = parse_analysis(mp3.measure(audio_in, filters, timeout_s))
+    logger.debug("Analyzed %s: %s", audio_in, analysis)
+    analysis_cache.put(key, analysis)
+    return analysis
+
+
+def filters_for(
+    processing: Processing, audio_in: str, input_sha256: str, timeout_s: Optional[int] = 60, sample_rate: Optional[int] = None
+) -> Optional[str]:
+    """The -af chain for encoding `audio_in`, analyzing it first if needed. Blocks."""
+    return processing.filters(measure(audio_in, input_sha256, processing, timeout_s), sample_rate)
+
+
+_cache: Optional[AnalysisCache] = None
+
+
+def configure() -> AnalysisCache:
+    global _cache
+    root = os.environ.get("ANALYSIS_CACHE_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "audio-producer-analysis")
+    _cache = AnalysisCache(root)
+    return _cache
+
+
+def get_cache() -> AnalysisCache:
+    if _cache is None:
+        return configure()
+    return _cache
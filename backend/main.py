@@ -1,100 +1,1346 @@
+import asyncio
+import fcntl
+import json
 import os
 import shutil
-import tempfile
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, BinaryIO, Callable, Iterator, Optional
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 
-from backend import mp3, file, log
+from backend import admission, archive, assets, cache, cover, download, encoders, formats, mp3, file, ingest, jobs, log, loudness, metrics, peaks, pool, probe, results, scratch, segmented, uploads, warm
 
 
 logger = log.getLogger(__name__)
-app = FastAPI()
-
-def main():
-    ENV_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".env"))
-    load_dotenv(ENV_PATH)
-
-    app.add_middleware(
-        CORSMiddleware,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
+
+_configured = False
+# Processes the server forks, which split the scratch and cache budgets between them
+_processes = 1
+# Set once at startup: the readiness probe doesn't start a process per request
+_ffmpeg_version: Optional[str] = None
+_draining = False
+
+
+def configure(processes: int = 1) -> None:
+    """Load the settings and shared assets. Done once per server, before it forks its `processes`."""
+    global _configured, _ffmpeg_version, _processes
+    if _configured:
+        return
+    _processes = processes
+    load_dotenv(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".env")))
+    log.configure()
+    pool.configure()
+    admission.configure()
+    cover.configure()
+    assets.configure()
+    cache.configure(share=processes)
+    uploads.configure()
+    encoders.configure()
+    loudness.configure()
+    probe.configure()
+    segmented.configure()
+    _ffmpeg_version = mp3.ffmpeg_version()
+    if _ffmpeg_version is None:
+        logger.warning("FFmpeg with MP3 support not found on PATH, conversions will fail")
+    _configured = True
+
+
+def start() -> None:
+    """Start what runs in the background of each server process: sweepers, warm encoders and jobs."""
+    results.configure()
+    scratch.configure(share=_processes)
+    warm.configure()
+    mp3.prewarm(encoders.get_registry().get().args())
+    jobs.configure(_run_job)
+
+
+def drain() -> None:
+    """Fail the readiness probe from now on, the process is about to shut down."""
+    global _draining
+    _draining = True
+
+
+async def stop() -> None:
+    """Give conversions that are still running, e.g. jobs, up to SERVER_DRAIN_TIMEOUT seconds to finish."""
+    drain()
+    if jobs.get_runner() is not None:
+        jobs.get_runner().stop()
+    conversions = pool.get_pool()
+    deadline = time.monotonic() + int(os.environ.get("SERVER_DRAIN_TIMEOUT", "").strip() or 60)
+    while conversions.pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if conversions.pending:
+        logger.warning(f"Shutting down with {conversions.pending} conversions unfinished; their jobs restart with the next process")
+
+
+def _report_startup() -> None:
+    age = metrics.process_age()
+    usage = metrics.record_memory()
+    if age is not None:
+        metrics.STARTUP_SECONDS.set(age)
+    logger.info(
+        f"Process {os.getpid()} ready after {age or 0:.2f}s, "
+        f"{usage.get('rss', 0) / 2**20:.0f} MiB resident of which {usage.get('shared', 0) / 2**20:.0f} MiB shared"
     )
 
-    if os.path.isdir("static"):
-        app.mount("/", StaticFiles(directory="static", html=True), name="static")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure()
+    start()
+    _report_startup()
+    yield
+    await stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+
+def _download_headers(title: str, extension: str = "mp3") -> dict:
+    safe_name = file.safe_filename(title, "output") + "." + extension
+    return {"Content-Disposition": f'attachment; filename="{safe_name}"'}
+
+
+def _content_length(request: Request) -> Optional[int]:
+    try:
+        return int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _stored_response(write: Callable[[str], None], media_type: str, headers: dict) -> Response:
+    """Have `write` put the output at the path it is given, keep it in the result store and send it from there.
+
+    The output outlives the scratch directory it was made in, so a download
+    that breaks off resumes from its Content-Location instead of converting again.
+    """
+    store = results.get_store()
+    result_id, partial = store.create()
+    try:
+        write(partial)
+        path = store.commit(result_id, media_type, headers)
+    except BaseException:
+        store.discard(result_id)
+        raise
+    logger.debug("Stored result %s: %s bytes", result_id, log.lazy(os.path.getsize, path))
+    if not store.retention_s:
+        return download.FileDownload(path, media_type, headers, background=BackgroundTask(store.discard, result_id))
+    return download.FileDownload(path, media_type, {**headers, "Content-Location": f"/api/results/{result_id}"})
+
+
+def _build_mp3_response(mp3_out: str, title: str, header: bytes = b"") -> Response:
+    def write(path):
+        if not header:
+            shutil.move(mp3_out, path)
+            return
+        with open(mp3_out, "rb") as frames:
+            mp3.copy_with_header(frames, path, header)
+
+    return _stored_response(write, "audio/mpeg", _download_headers(title))
+
+
+def _encode_options(
+    audio_in: str,
+    input_sha256: str,
+    processing: loudness.Processing,
+    encoder: encoders.EncoderProfile,
+    timeout_s: Optional[int] = None,
+) -> dict:
+    """filters=, encoder= and timeout_s= for the mp3 functions. Blocks: the input is probed and may be analyzed.
+
+    Without a `timeout_s` each FFmpeg pass gets one scaled to the input's duration.
+    """
+    info = probe.probe_file(audio_in, input_sha256)
+    admission.charge(info.get("duration"))
+    timeout_s = timeout_s or probe.timeout_for(info)
+    filters = loudness.filters_for(processing, audio_in, input_sha256, timeout_s, info.get("sample_rate"))
+    return dict(filters=filters, encoder=encoder.encoder_args(audio_in, filters), timeout_s=timeout_s)
 
 
+def _audio_sink(path: str, filename: str, start_pipe=None) -> ingest.AudioSink:
+    # Uploads that are clearly not audio, or too long or large, are refused from their first bytes
+    return ingest.AudioSink(path, filename, start_pipe, inspect=probe.sniff, max_bytes=probe.max_bytes())
 
-def _build_mp3_response(mp3_out: str, title: str) -> StreamingResponse:
-    safe_name = file.safe_filename(title, "output") + ".mp3"
 
-    # Read the MP3 file into memory so we can delete the temp directory
-    with open(mp3_out, "rb") as f:
-        mp3_data = f.read()
+def _store_result(cache_key: Optional[str], mp3_out: str) -> None:
+    result_cache = cache.get_cache()
+    if cache_key and result_cache is not None:
+        result_cache.put(cache_key, mp3_out)
 
-    logger.debug(f"Read MP3 data: {len(mp3_data)} bytes")
-    return StreamingResponse(
-        iter([mp3_data]),
-        media_type="audio/mpeg",
-        headers={"Content-Disposition": f'attachment; filename="{safe_name}"'},
+
+def _encode_segmented(
+    audio_in: str,
+    mp3_out: str,
+    workdir: str,
+    options: dict,
+    input_sha256: str,
+    on_progress=None,
+    timeout_s: Optional[int] = 60,
+    extra_outputs: list = (),
+    pass_fds: tuple = (),
+) -> bool:
+    """Encode a long input to untagged MP3 in segments on several cores; False leaves it to a single encode."""
+    if not segmented.enabled():
+        return False
+    # Already probed for the options, this comes from the cache
+    probed = probe.probe_file(audio_in, input_sha256)
+    if not segmented.applies(probed, options["encoder"]):
+        return False
+    segmented.encode(
+        audio_in, mp3_out, workdir, probed, options["encoder"], options["filters"], on_progress, timeout_s, extra_outputs, pass_fds
     )
+    return True
+
 
+def _convert(
+    tmpdir: str,
+    profile: assets.TagProfile,
+    title: str,
+    speaker: str,
+    cache_key: Optional[str],
+    processing: loudness.Processing,
+    encoder: encoders.EncoderProfile,
+    input_sha256: str,
+) -> Response:
+    audio_in = os.path.join(tmpdir, "input")
+    mp3_out = os.path.join(tmpdir, "output.mp3")
+    options = _encode_options(audio_in, input_sha256, processing, encoder)
 
+    if _encode_segmented(audio_in, mp3_out, tmpdir, options, input_sha256, timeout_s=options["timeout_s"]):
+        return _tagged_response(mp3_out, profile, title, speaker, cache_key)
+    if not cache_key:
+        mp3.convert_and_tag(audio_in, mp3_out, **options, **profile.tags(title, speaker))
+        return _build_mp3_response(mp3_out, title)
 
-@app.post("/api/convert")
-async def convert_audio(
-    audioFile: UploadFile = File(...),
-    topic: str = Form(...),
-    speaker: str = Form(default="Unknown"),
-):
-    title = f"{topic}{os.environ['TITLE_SUFFIX']}"
+    # Keep the frames untagged so they can be cached and re-tagged later
+    mp3.convert_untagged(audio_in, mp3_out, **options)
+    response = _build_mp3_response(mp3_out, title, profile.id3_header(title, speaker))
+    _store_result(cache_key, mp3_out)
+    return response
 
-    if not audioFile.filename:
-        raise HTTPException(status_code=400, detail="Audio file required")
 
-    tmpdir = tempfile.mkdtemp()
-    logger.debug(f"Created temp directory: {tmpdir}")
+def _convert_stream(
+    tmpdir: str,
+    profile: assets.TagProfile,
+    title: str,
+    speaker: str,
+    cache_key: Optional[str],
+    processing: loudness.Processing,
+    encoder: encoders.EncoderProfile,
+    input_sha256: str,
+) -> Iterator[bytes]:
     try:
         audio_in = os.path.join(tmpdir, "input")
+        header = profile.id3_header(title, speaker)
+
+        frames = mp3.stream_mp3(audio_in, tmpdir, **_encode_options(audio_in, input_sha256, processing, encoder))
+        # Hold the header back until ffmpeg has produced audio, so a file it
+        # can't decode still gets a proper error status
+        if not cache_key:
+            yield header + next(frames, b"")
+            yield from frames
+            return
+
         mp3_out = os.path.join(tmpdir, "output.mp3")
+        with open(mp3_out, "wb") as copy:
+            first = next(frames, b"")
+            copy.write(first)
+            yield header + first
+            for chunk in frames:
+                copy.write(chunk)
+                yield chunk
+        # Only reached when the whole stream was encoded and sent
+        _store_result(cache_key, mp3_out)
+    finally:
+        scratch.get_space().release(tmpdir)
+
 
-        file.save_upload_file(audioFile, audio_in)
-        logger.debug(f"Saved audio to {audio_in}, size: {os.path.getsize(audio_in)} bytes")
+def _convert_piped(chunks: Iterator[bytes], tmpdir: str, upload: dict, options: dict) -> Response:
+    mp3_out = os.path.join(tmpdir, "output.mp3")
+    mp3.convert_pipe(chunks, mp3_out, tmpdir, **options)
+    # Piped inputs aren't probed, their cost is only known now
+    admission.charge(mp3.duration(mp3_out), enforce=False)
 
-        cover_in = file.resolve_cover_path(tmpdir)
+    # The form fields may follow the file in the body; by the time the input
+    # is exhausted they have all been parsed into `upload`.
+    return _tagged_response(mp3_out, upload["profile"], upload["title"], upload["speaker"], upload["cache_key"])
 
-        mp3.convert_to_mp3(audio_in, mp3_out)
 
-        cover_mime = file.guess_cover_mime("default_cover.jpg")
-        mp3.write_id3_tags(
-            mp3_out,
-            title=title,
-            album=os.environ['ALBUM'],
-            album_artist=os.environ['ALBUM_ARTIST'],
-            artist=speaker,
-            year=str(datetime.now().year),
-            genre=os.environ['GENRE'],
-            cover_path=cover_in,
-            cover_mime=cover_mime,
+def _encode_formats(
+    audio_in: str,
+    workdir: str,
+    output_formats: list,
+    options: dict,
+    tags: dict,
+    encoder: encoders.EncoderProfile,
+    on_progress=None,
+    timeout_s: Optional[int] = 60,
+    extra_outputs: list = (),
+    pass_fds: tuple = (),
+    input_sha256: str = "",
+) -> dict:
+    """Encode and tag every format from one decode of `audio_in`; returns the files by format name.
+
+    `extra_outputs` are further (arguments, path) outputs of the same run, left as ffmpeg writes them.
+    """
+    paths = {f.name: os.path.join(workdir, f"output.{f.extension}") for f in output_formats}
+    outputs = [(f.encoder_args(encoder, options["encoder"]), paths[f.name]) for f in output_formats]
+    only_mp3 = [f.name for f in output_formats] == [formats.DEFAULT_FORMAT]
+    segments = only_mp3 and _encode_segmented(
+        audio_in, outputs[0][1], workdir, options, input_sha256, on_progress, timeout_s, extra_outputs, pass_fds
+    )
+    if not segments:
+        mp3.convert_outputs(
+            audio_in, outputs + list(extra_outputs), on_progress=on_progress, timeout_s=timeout_s, filters=options["filters"], pass_fds=pass_fds
+        )
+    for output_format in output_formats:
+        paths[output_format.name] = output_format.tagged(paths[output_format.name], **tags)
+    return paths
+
+
+def _convert_formats(
+    tmpdir: str,
+    profile: assets.TagProfile,
+    title: str,
+    speaker: str,
+    processing: loudness.Processing,
+    encoder: encoders.EncoderProfile,
+    input_sha256: str,
+    output_formats: list,
+) -> Response:
+    audio_in = os.path.join(tmpdir, "input")
+    options = _encode_options(audio_in, input_sha256, processing, encoder)
+    paths = _encode_formats(
+        audio_in, tmpdir, output_formats, options, profile.tags(title, speaker), encoder,
+        timeout_s=options["timeout_s"], input_sha256=input_sha256,
+    )
+
+    if len(output_formats) == 1:
+        output_format = output_formats[0]
+        return _stored_response(
+            lambda path: shutil.move(paths[output_format.name], path),
+            output_format.media_type,
+            _download_headers(title, output_format.extension),
+        )
+
+    # Every format of the episode in one download, copied a chunk at a time
+    def write_archive(path, chunk_size=1024 * 1024):
+        archive_out = archive.ZipStream()
+        with open(path, "wb") as out:
+            for output_format in output_formats:
+                with open(paths[output_format.name], "rb") as f:
+                    name = file.safe_filename(title, "output") + "." + output_format.extension
+                    out.write(archive_out.start(name, os.fstat(f.fileno()).st_size))
+                    while chunk := f.read(chunk_size):
+                        out.write(archive_out.write(chunk))
+                    out.write(archive_out.finish())
+            out.write(archive_out.close())
+
+    return _stored_response(write_archive, "application/zip", _download_headers(title, "zip"))
+
+
+def _tagged_response(
+    mp3_out: str, profile: assets.TagProfile, title: str, speaker: str, cache_key: Optional[str]
+) -> Response:
+    response = _build_mp3_response(mp3_out, title, profile.id3_header(title, speaker))
+    _store_result(cache_key, mp3_out)
+    return response
+
+
+def _replay_cached(
+    frames: BinaryIO, tmpdir: str, profile: assets.TagProfile, title: str, speaker: str, chunk_size: int = 64 * 1024
+) -> Iterator[bytes]:
+    try:
+        yield profile.id3_header(title, speaker)
+        while chunk := frames.read(chunk_size):
+            yield chunk
+    finally:
+        frames.close()
+        scratch.get_space().release(tmpdir)
+
+
+def _build_cached_response(frames: BinaryIO, profile: assets.TagProfile, title: str, speaker: str) -> Response:
+    with frames:
+        header = profile.id3_header(title, speaker)
+        return _stored_response(lambda path: mp3.copy_with_header(frames, path, header), "audio/mpeg", _download_headers(title))
+
+
+_CONVERT_FORM = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["audioFile", "topic"],
+                "properties": {
+                    "audioFile": {"type": "string", "format": "binary"},
+                    "topic": {"type": "string"},
+                    "speaker": {"type": "string", "default": "Unknown"},
+                    "profile": {"type": "string", "default": assets.DEFAULT_PROFILE},
+                    "loudnorm": {"type": "string", "enum": list(loudness.MODES), "description": "Default: LOUDNORM"},
+                    "encoder": {"type": "string", "description": "Encoder profile, see GET /api/encoders"},
+                    "trimSilence": {"type": "boolean", "default": False},
+                    "limiter": {"type": "boolean", "default": False},
+                    "formats": {
+                        "type": "string",
+                        "description": f"Comma-separated output formats out of {', '.join(formats.FORMATS)}; "
+                        "more than one returns a ZIP. Default: mp3",
+                    },
+                    "cover": {"type": "string", "format": "binary", "description": "Replaces the profile's cover"},
+                },
+            }
+        }
+    },
+}
+
+
+async def _settle(job: asyncio.Future) -> None:
+    # Wait for a job we no longer need the result of, without leaking its error
+    await asyncio.wait([job])
+    if not job.cancelled():
+        job.exception()
+
+
+def _add_cover_chunk(form: dict, chunk: bytes) -> None:
+    limit = int(os.environ.get("COVER_MAX_UPLOAD_BYTES", "").strip() or 20 * 1024 * 1024)
+    form["cover"] += chunk
+    if len(form["cover"]) > limit:
+        raise HTTPException(status_code=413, detail=f"Cover image larger than {limit} bytes")
+
+
+def _encoding_choice(fields: dict) -> tuple[loudness.Processing, encoders.EncoderProfile]:
+    return loudness.from_form(fields), encoders.get_registry().get(fields.get("encoder"))
+
+
+def _pipe_options(choice: tuple, filename: str) -> Optional[dict]:
+    # Processing that has to analyze the whole input first can't be piped,
+    # nor can an MP3 that might be copied as it is
+    processing, encoder = choice
+    filters = processing.filters()
+    if processing.needs_analysis or (encoder.bitrate and not filters and filename.lower().endswith(".mp3")):
+        return None
+    return dict(filters=filters, encoder=encoder.args())
+
+
+def _pipe_for(fields: dict, filename: str, tmpdir: str, upload: dict):
+    # ffmpeg needs the filters and encoder when it starts, so they come from
+    # the fields sent before the audio. Uploads that can't be piped are spooled.
+    choice = upload["piped_choice"] = _encoding_choice(fields)
+    options = _pipe_options(choice, filename)
+    if options is None or _other_formats(formats.parse(fields.get("formats"))):
+        return None
+    return lambda chunks, info: pool.get_pool().submit(
+        _convert_piped, chunks, tmpdir, upload, dict(options, timeout_s=probe.timeout_for(info))
+    )
+
+
+def _other_formats(output_formats: list) -> bool:
+    # Anything but a single MP3 takes the multi-format path
+    return [f.name for f in output_formats] != [formats.DEFAULT_FORMAT]
+
+
+def _check_early_choice(received: Optional[tuple], choice: tuple) -> None:
+    # The part of the form that was used before all of it had arrived must not change
+    def settings(c):
+        processing, encoder = c
+        return processing.settings(), encoder.settings()
+
+    if received is not None and settings(received) != settings(choice):
+        raise HTTPException(
+            status_code=422,
+            detail="Send the encoder, loudnorm, trimSilence and limiter fields before the audio file",
+        )
+
+
+def _select_profile(name: Optional[str], cover_data: Optional[bytes]) -> assets.TagProfile:
+    # Blocks while an uploaded cover is normalized the first time, run it in a thread
+    profile = assets.get_registry().get(name)
+    if cover_data:
+        profile = profile.with_cover(cover.get_cache().from_upload(bytes(cover_data)))
+    return profile
+
+
+async def _receive_form(request: Request, audio_path: str, pipe_for=None) -> tuple[dict, ingest.AudioSink]:
+    """Read the convert form, passing the audio part to an AudioSink as it arrives.
+
+    `pipe_for(fields, filename)` gets the fields sent before the audio and
+    returns the sink's start_pipe, or None to spool. An optional cover image is collected
+    in memory. The sink is left open on success; on any error a piped encode
+    is aborted.
+    """
+    form = {}
+    sink = None
+    receiving = None
+    try:
+        async for event in ingest.iter_multipart(request):
+            if event[0] == "field":
+                form[event[1]] = event[2]
+            elif event[0] == "file":
+                receiving = event[1]
+                if receiving == "audioFile":
+                    if sink is not None:
+                        raise HTTPException(status_code=422, detail="Send one audio file per request")
+                    if not event[2]:
+                        raise HTTPException(status_code=400, detail="Audio file required")
+                    sink = _audio_sink(audio_path, event[2], pipe_for and pipe_for(dict(form), event[2]))
+                elif receiving == "cover":
+                    form["cover"] = bytearray()
+            elif event[0] == "data" and receiving == "audioFile":
+                await sink.write(event[1])
+            elif event[0] == "data" and receiving == "cover":
+                _add_cover_chunk(form, event[1])
+            elif event[0] == "file_end":
+                receiving = None
+
+        missing = [name for name, given in (("audioFile", sink), ("topic", form.get("topic"))) if not given]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"Missing form fields: {', '.join(missing)}")
+    except BaseException:
+        if sink is not None:
+            await sink.abort()
+            if sink.job is not None:
+                await _settle(sink.job)
+        raise
+
+    form["speaker"] = form.get("speaker") or "Unknown"
+    logger.debug("Received %r, size: %s bytes", sink.filename, sink.size)
+    return form, sink
+
+
+@app.post("/api/convert", openapi_extra={"requestBody": _CONVERT_FORM})
+async def convert_audio(request: Request):
+    # Wait for a slot before reading any of the body
+    ticket = await admission.admit(request)
+    try:
+        return await _convert_audio(request)
+    finally:
+        ticket.release()
+
+
+async def _convert_audio(request: Request):
+    # The body is parsed here rather than through File()/Form() so the audio
+    # can reach ffmpeg while it is still being uploaded.
+    tmpdir = await scratch.get_space().acquire(_content_length(request))
+    owns_tmpdir = True
+    sink = None
+    upload = {"cache_key": None, "piped_choice": None}
+    streaming = os.environ.get("RESPONSE_MODE", "buffered") == "stream"
+    try:
+        pipe_for = None
+        if os.environ.get("INGEST_MODE", "pipe") == "pipe" and not streaming:
+            pipe_for = lambda fields, filename: _pipe_for(fields, filename, tmpdir, upload)
+
+        with metrics.stage("upload"):
+            form, sink = await _receive_form(request, os.path.join(tmpdir, "input"), pipe_for)
+        processing, encoder = choice = _encoding_choice(form)
+        output_formats = formats.parse(form.get("formats"))
+        if sink.piped:
+            _check_early_choice(upload["piped_choice"], choice)
+            if _other_formats(output_formats):
+                raise HTTPException(status_code=422, detail="Send the formats field before the audio file")
+        profile = upload["profile"] = await asyncio.to_thread(_select_profile, form.get("profile"), form.get("cover"))
+        title = upload["title"] = profile.title(form["topic"])
+        speaker = upload["speaker"] = form["speaker"]
+        input_sha256 = sink.sha256.hexdigest()
+
+        if _other_formats(output_formats):
+            # Not cached: the result cache holds untagged MP3 frames
+            await sink.close()
+            return await pool.get_pool().run(
+                _convert_formats, tmpdir, profile, title, speaker, processing, encoder, input_sha256, output_formats
+            )
+
+        cached = None
+        result_cache = cache.get_cache()
+        if result_cache is not None:
+            settings = mp3.encoder_settings(piped_output=streaming, processing=processing.settings(), encoder=encoder.args())
+            upload["cache_key"] = cache.cache_key(input_sha256, settings)
+            cached = result_cache.open(upload["cache_key"])
+
+        if cached is not None:
+            # Same audio, same settings: only the ID3 header has to be rebuilt
+            logger.debug("Result cache hit for %s", upload['cache_key'])
+            await sink.abort()
+            if streaming:
+                chunks = await pool.get_pool().stream(_replay_cached, cached, tmpdir, profile, title, speaker)
+                owns_tmpdir = False
+                return StreamingResponse(chunks, media_type="audio/mpeg", headers=_download_headers(title))
+            return await pool.get_pool().run(_build_cached_response, cached, profile, title, speaker)
+
+        await sink.close()
+        if sink.piped:
+            return await sink.job
+
+        # ffmpeg and tagging block, so keep them off the event loop
+        if streaming:
+            chunks = await pool.get_pool().stream(
+                _convert_stream, tmpdir, profile, title, speaker, upload["cache_key"], processing, encoder, input_sha256
+            )
+            owns_tmpdir = False
+            return StreamingResponse(chunks, media_type="audio/mpeg", headers=_download_headers(title))
+
+        return await pool.get_pool().run(
+            _convert, tmpdir, profile, title, speaker, upload["cache_key"], processing, encoder, input_sha256
         )
-        return _build_mp3_response(mp3_out, title)
     except HTTPException:
         raise
     except Exception as e:
         logger.exception(f"Conversion error: {e}")
         raise HTTPException(status_code=500, detail=f"Conversion failed: {str(e)}")
     finally:
-        if os.path.exists(tmpdir):
-            shutil.rmtree(tmpdir)
-            logger.debug(f"Cleaned up temp directory: {tmpdir}")
+        if sink is not None and sink.job is not None:
+            if not sink.job.done():
+                # Failed before the upload was handed over, e.g. an unknown profile
+                await sink.abort()
+            # ffmpeg may still be writing into tmpdir
+            await _settle(sink.job)
+        if owns_tmpdir:
+            scratch.get_space().release(tmpdir)
+
+
+_BATCH_FORM = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["audioFile", "topic"],
+                "properties": {
+                    "audioFile": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                    "topic": {"type": "array", "items": {"type": "string"}, "description": "One per audio file, in order"},
+                    "speaker": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "One per audio file, or a single speaker for all of them",
+                    },
+                    "profile": {"type": "string", "default": assets.DEFAULT_PROFILE},
+                    "loudnorm": {"type": "string", "enum": list(loudness.MODES), "description": "Default: LOUDNORM"},
+                    "encoder": {"type": "string", "description": "Encoder profile, see GET /api/encoders"},
+                    "trimSilence": {"type": "boolean", "default": False},
+                    "limiter": {"type": "boolean", "default": False},
+                    "cover": {"type": "string", "format": "binary", "description": "Replaces the profile's cover"},
+                },
+            }
+        }
+    },
+}
+
+
+def _encode_untagged(
+    workdir: str, cache_key: Optional[str], processing: loudness.Processing, encoder: encoders.EncoderProfile, input_sha256: str
+) -> BinaryIO:
+    audio_in = os.path.join(workdir, "input")
+    mp3_out = os.path.join(workdir, "output.mp3")
+    mp3.convert_untagged(audio_in, mp3_out, **_encode_options(audio_in, input_sha256, processing, encoder))
+    os.remove(audio_in)
+
+    # The open handle stays valid when the cache moves or evicts the file
+    frames = open(mp3_out, "rb")
+    _store_result(cache_key, mp3_out)
+    return frames
+
+
+async def _encode_batch_item(item: dict, input_sha256: str) -> BinaryIO:
+    cache_key = None
+    processing, encoder = item["choice"]
+    result_cache = cache.get_cache()
+    if result_cache is not None:
+        settings = mp3.encoder_settings(processing=processing.settings(), encoder=encoder.args())
+        cache_key = cache.cache_key(input_sha256, settings)
+        frames = result_cache.open(cache_key)
+        if frames is not None:
+            logger.debug("Result cache hit for %r", item['filename'])
+            return frames
+
+    item["future"] = await pool.get_pool().execute_when_idle(
+        _encode_untagged, item["dir"], cache_key, processing, encoder, input_sha256
+    )
+    return await asyncio.wrap_future(item["future"])
+
+
+async def _receive_batch(request: Request, tmpdir: str, items: list) -> dict:
+    """Spool every audio part of a batch upload, starting its encode as soon as it is complete.
+
+    Each file gets an entry in `items`. Returns the form: the topics and
+    speakers in the order they were sent, the profile name and the cover.
+    """
+    max_files = int(os.environ.get("BATCH_MAX_FILES", "").strip() or 50)
+    form = {"topic": [], "speaker": []}
+    sink = None
+    receiving = None
+    try:
+        async for event in ingest.iter_multipart(request):
+            if event[0] == "field":
+                if event[1] in ("topic", "speaker"):
+                    form[event[1]].append(event[2])
+                else:
+                    form[event[1]] = event[2]
+            elif event[0] == "file" and event[1] == "cover":
+                receiving = "cover"
+                form["cover"] = bytearray()
+            elif event[0] == "data" and receiving == "cover":
+                _add_cover_chunk(form, event[1])
+            elif event[0] == "file" and event[1] == "audioFile":
+                if not event[2]:
+                    raise HTTPException(status_code=400, detail="Audio file required")
+                if len(items) >= max_files:
+                    raise HTTPException(status_code=413, detail=f"At most {max_files} files per batch")
+                item = {"dir": os.path.join(tmpdir, str(len(items))), "filename": event[2]}
+                os.mkdir(item["dir"])
+                items.append(item)
+                sink = _audio_sink(os.path.join(item["dir"], "input"), event[2])
+            elif event[0] == "data" and sink is not None:
+                await sink.write(event[1])
+            elif event[0] == "file_end" and receiving == "cover":
+                receiving = None
+            elif event[0] == "file_end" and sink is not None:
+                await sink.close()
+                logger.debug("Received %r, size: %s bytes", sink.filename, sink.size)
+                # Like a piped upload, the encode starts before the rest of the form is known
+                items[-1]["choice"] = _encoding_choice(form)
+                items[-1]["task"] = asyncio.create_task(_encode_batch_item(items[-1], sink.sha256.hexdigest()))
+                sink = None
+    finally:
+        if sink is not None:
+            await sink.abort()
+    return form
+
+
+async def _abandon_batch(items: list, tmpdir: str) -> None:
+    tasks = [item["task"] for item in items if "task" in item]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks)
+    # Encodes that already reached a worker run to the end, wait for them
+    # before their directories go away
+    futures = [asyncio.wrap_future(item["future"]) for item in items if "future" in item]
+    if futures:
+        await asyncio.wait(futures)
+    for future in tasks + futures:
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+    scratch.get_space().release(tmpdir)
+
+
+async def _batch_zip(items: list, tmpdir: str, profile: assets.TagProfile, chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+    archive_out = archive.ZipStream()
+    try:
+        by_task = {item["task"]: item for item in items}
+        pending = set(by_task)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = by_task[task]
+                name = file.safe_filename(item["title"], "output") + ".mp3"
+                try:
+                    frames = task.result()
+                except Exception as e:
+                    # The response is already under way; report the failure inside the archive
+                    detail = e.detail if isinstance(e, HTTPException) else f"Conversion failed: {e}"
+                    logger.warning(f"Batch entry {item['filename']!r} failed: {detail}")
+                    yield archive_out.add(f"{name}.error.txt", f"{item['filename']}: {detail}\n".encode())
+                    continue
+
+                with frames:
+                    header = profile.id3_header(item["title"], item["speaker"])
+                    yield archive_out.start(name, len(header) + os.fstat(frames.fileno()).st_size)
+                    yield archive_out.write(header)
+                    while chunk := await asyncio.to_thread(frames.read, chunk_size):
+                        yield archive_out.write(chunk)
+                    yield archive_out.finish()
+        yield archive_out.close()
+    finally:
+        await _abandon_batch(items, tmpdir)
+
+
+@app.post("/api/convert/batch", openapi_extra={"requestBody": _BATCH_FORM})
+async def convert_batch(request: Request):
+    # The slot is given back once the zip starts streaming; the pool still bounds its encodes
+    ticket = await admission.admit(request)
+    try:
+        return await _convert_batch(request)
+    finally:
+        ticket.release()
+
+
+async def _convert_batch(request: Request):
+    tmpdir = await scratch.get_space().acquire(_content_length(request))
+    items = []
+    handed_off = False
+    try:
+        with metrics.stage("upload"):
+            form = await _receive_batch(request, tmpdir, items)
+        topics, speakers = form["topic"], form["speaker"]
+        if not items or not topics:
+            missing = [name for name, given in (("audioFile", items), ("topic", topics)) if not given]
+            raise HTTPException(status_code=422, detail=f"Missing form fields: {', '.join(missing)}")
+        if len(topics) != len(items):
+            raise HTTPException(status_code=422, detail=f"Got {len(items)} audio files but {len(topics)} topics")
+        choice = _encoding_choice(form)
+        for item in items:
+            _check_early_choice(item["choice"], choice)
+        if len(speakers) == 1:
+            speakers = speakers * len(items)
+        elif speakers and len(speakers) != len(items):
+            raise HTTPException(status_code=422, detail=f"Got {len(items)} audio files but {len(speakers)} speakers")
+
+        profile = await asyncio.to_thread(_select_profile, form.get("profile"), form.get("cover"))
+        for n, item in enumerate(items):
+            item["title"] = profile.title(topics[n])
+            item["speaker"] = (speakers[n] if speakers else "") or "Unknown"
+
+        zip_name = file.safe_filename(profile.album, "episodes") + ".zip"
+        response = StreamingResponse(
+            _batch_zip(items, tmpdir, profile),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{zip_name}"'},
+        )
+        handed_off = True
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Batch conversion error: {e}")
+        raise HTTPException(status_code=500, detail=f"Conversion failed: {str(e)}")
+    finally:
+        if not handed_off:
+            await _abandon_batch(items, tmpdir)
+
+
+_UPLOAD_OPTIONS = ("encoder", "loudnorm", "trimSilence", "limiter", "formats")
+
+_COMPLETE_FORM = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["topic"],
+                "properties": {
+                    "topic": {"type": "string"},
+                    "speaker": {"type": "string", "default": "Unknown"},
+                    "profile": {"type": "string", "default": assets.DEFAULT_PROFILE},
+                    "cover": {"type": "string", "format": "binary", "description": "Replaces the profile's cover"},
+                },
+            }
+        }
+    },
+}
+
+
+def _upload_status(session: uploads.UploadSession) -> JSONResponse:
+    status = {
+        "id": session.id,
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.offset,
+        "missing": session.missing(),
+        "chunk_size": uploads.get_registry().chunk_bytes,
+        "upload_url": f"/api/uploads/{session.id}",
+        "complete_url": f"/api/uploads/{session.id}/complete",
+    }
+    return JSONResponse(status, headers={"Upload-Offset": str(session.offset), "Upload-Length": str(session.size)})
+
+
+def _encode_prefix(session: uploads.UploadSession, options: dict) -> str:
+    mp3_out = os.path.join(session.dir, "output.mp3")
+    mp3.convert_pipe(session.read_prefix(uploads.get_registry().stall_s), mp3_out, session.dir, **options)
+    return mp3_out
+
+
+def _start_prefix_encode(session: uploads.UploadSession) -> None:
+    # Encode what has arrived without gaps while the rest is still uploading
+    # Not before the head was probed, its duration sets the timeout
+    if session.encode is not None or session.pipe_options is None or session.info is None:
+        return
+    if ingest.needs_seekable_input(session.head(ingest.SNIFF_BYTES), session.filename):
+        session.pipe_options = None
+        return
+    try:
+        options = dict(session.pipe_options, timeout_s=probe.timeout_for(session.info))
+        session.encode = pool.get_pool().execute(_encode_prefix, session, options)
+    except HTTPException:
+        # No worker to spare; try again with the next chunk, or encode the whole file at the end
+        return
+    logger.debug("Encoding upload %s while it arrives", session.id)
+
+
+@app.post("/api/uploads", status_code=201)
+async def create_upload(request: Request):
+    """Start a resumable upload of {"filename", "size"}, with the encoder and processing options."""
+    try:
+        body = await request.json()
+        filename, size = str(body["filename"]), int(body["size"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=422, detail="Send a JSON object with the filename and size of the audio file")
+    if not filename or size <= 0:
+        raise HTTPException(status_code=400, detail="Audio file required")
+    probe.check_size(size)
+    admission.get_controller().check(admission.client_of(request))
+    fields = {name: body[name] for name in _UPLOAD_OPTIONS if body.get(name) is not None}
+    choice = _encoding_choice(fields)
+    output_formats = formats.parse(fields.get("formats"))
+
+    session = await uploads.get_registry().create(filename, size, fields)
+    if os.environ.get("RESPONSE_MODE", "buffered") != "stream" and not _other_formats(output_formats):
+        session.pipe_options = _pipe_options(choice, filename)
+    response = _upload_status(session)
+    response.status_code = 201
+    return response
+
+
+@app.get("/api/uploads/{upload_id}")
+async def upload_status(upload_id: str):
+    return _upload_status(uploads.get_registry().get(upload_id))
+
+
+@app.patch("/api/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request):
+    """Store the body at the byte offset in the Upload-Offset header; chunks may come in any order."""
+    registry = uploads.get_registry()
+    session = registry.get(upload_id)
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Upload-Offset header required")
+    checksum = request.headers.get("upload-checksum")
+    digest = uploads.parse_checksum(checksum) if checksum else None
+
+    too_large = HTTPException(status_code=413, detail=f"Chunks are limited to {registry.max_chunk_bytes} bytes")
+    if (_content_length(request) or 0) > registry.max_chunk_bytes:
+        raise too_large
+    data = bytearray()
+    async for piece in request.stream():
+        data += piece
+        if len(data) > registry.max_chunk_bytes:
+            raise too_large
+    await asyncio.to_thread(session.write, offset, bytes(data), digest)
+    if session.info is None and session.offset >= min(ingest.HEAD_BYTES, session.size):
+        try:
+            session.info = probe.sniff(session.head(ingest.HEAD_BYTES), session.filename)
+        except HTTPException:
+            registry.discard(upload_id)
+            raise
+    _start_prefix_encode(session)
+    return _upload_status(session)
+
+
+@app.delete("/api/uploads/{upload_id}", status_code=204)
+async def delete_upload(upload_id: str):
+    uploads.get_registry().discard(upload_id)
+    return Response(status_code=204)
+
+
+async def _receive_fields(request: Request, audio_path: Optional[str] = None) -> dict:
+    # The tag fields and optional cover of a completed upload; without a cover they may come urlencoded.
+    # With `audio_path`, an audioFile part is spooled there and its sink is form["audioFile"].
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        return dict(await request.form())
+    form = {}
+    receiving = None
+    sink = None
+    try:
+        async for event in ingest.iter_multipart(request):
+            if event[0] == "field":
+                form[event[1]] = event[2]
+            elif event[0] == "file":
+                receiving = event[1]
+                if receiving == "cover":
+                    form["cover"] = bytearray()
+                elif receiving == "audioFile" and audio_path and event[2]:
+                    sink = form["audioFile"] = ingest.AudioSink(audio_path, event[2])
+            elif event[0] == "data" and receiving == "cover":
+                _add_cover_chunk(form, event[1])
+            elif event[0] == "data" and receiving == "audioFile" and sink is not None:
+                await sink.write(event[1])
+            elif event[0] == "file_end":
+                if receiving == "audioFile" and sink is not None:
+                    await sink.close()
+                receiving = None
+    except BaseException:
+        if sink is not None:
+            await sink.abort()
+        raise
+    return form
+
+
+@app.post("/api/uploads/{upload_id}/complete", openapi_extra={"requestBody": _COMPLETE_FORM})
+async def complete_upload(upload_id: str, request: Request):
+    """Convert a fully received upload; responds like POST /api/convert."""
+    ticket = await admission.admit(request)
+    try:
+        return await _complete_upload(upload_id, request)
+    finally:
+        ticket.release()
+
+
+async def _complete_upload(upload_id: str, request: Request):
+    registry = uploads.get_registry()
+    session = registry.get(upload_id)
+    if not session.complete:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload incomplete: {session.offset} of {session.size} bytes received",
+            headers={"Upload-Offset": str(session.offset)},
+        )
+    form = await _receive_fields(request)
+    if not form.get("topic"):
+        raise HTTPException(status_code=422, detail="Missing form fields: topic")
+    processing, encoder = _encoding_choice(session.fields)
+    output_formats = formats.parse(session.fields.get("formats"))
+    profile = await asyncio.to_thread(_select_profile, form.get("profile"), form.get("cover"))
+    title = profile.title(form["topic"])
+    speaker = form.get("speaker") or "Unknown"
+
+    session = registry.detach(upload_id)
+    try:
+        input_sha256 = session.sha256.hexdigest()
+        if _other_formats(output_formats):
+            return await pool.get_pool().run(
+                _convert_formats, session.dir, profile, title, speaker, processing, encoder, input_sha256, output_formats
+            )
+        cache_key = None
+        result_cache = cache.get_cache()
+        if result_cache is not None:
+            settings = mp3.encoder_settings(processing=processing.settings(), encoder=encoder.args())
+            cache_key = cache.cache_key(input_sha256, settings)
+
+        if session.encode is not None:
+            try:
+                mp3_out = await asyncio.wrap_future(session.encode)
+            except ingest.PipeAborted:
+                logger.info(f"Upload {session.id} stalled while encoding, encoding the whole file instead")
+            else:
+                admission.charge(await asyncio.to_thread(mp3.duration, mp3_out), enforce=False)
+                return await pool.get_pool().run(_tagged_response, mp3_out, profile, title, speaker, cache_key)
+
+        cached = result_cache.open(cache_key) if cache_key else None
+        if cached is not None:
+            logger.debug("Result cache hit for %s", cache_key)
+            return await pool.get_pool().run(_build_cached_response, cached, profile, title, speaker)
+        return await pool.get_pool().run(
+            _convert, session.dir, profile, title, speaker, cache_key, processing, encoder, input_sha256
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Conversion error: {e}")
+        raise HTTPException(status_code=500, detail=f"Conversion failed: {str(e)}")
+    finally:
+        session.release()
+
+
+_RETAG_FORM = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["topic"],
+                "properties": {
+                    "audioFile": {"type": "string", "format": "binary", "description": "The MP3 to retag, or send job"},
+                    "job": {"type": "string", "description": "Retag the MP3 result of this job instead"},
+                    "topic": {"type": "string"},
+                    "speaker": {"type": "string", "description": "Default: Unknown, or the job's speaker"},
+                    "profile": {"type": "string", "default": assets.DEFAULT_PROFILE},
+                    "cover": {"type": "string", "format": "binary", "description": "Replaces the profile's cover"},
+                },
+            }
+        }
+    },
+}
+
+
+def _retag_job(job: dict, profile: assets.TagProfile, title: str, speaker: str) -> str:
+    result = os.path.join(jobs.get_runner().job_dir(job["id"]), "result.mp3")
+    # One retag of a stored result at a time, across the server's workers too: a
+    # lock on the job's directory, the result itself is replaced. Never written
+    # over, so downloads in progress keep reading the file they opened
+    lock = os.open(os.path.dirname(result), os.O_RDONLY)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        header, audio_start = mp3.retag(result, in_place=False, **profile.tags(title, speaker))
+        mp3.rewrite_with_header(result, header, audio_start)
+    finally:
+        os.close(lock)
+    jobs.get_runner().store.update(job["id"], title=title, speaker=speaker)
+    return result
+
+
+@app.post("/api/retag", openapi_extra={"requestBody": _RETAG_FORM})
+async def retag_mp3(request: Request):
+    """Replace the tags of an MP3, or of a job's result, without re-encoding it."""
+    tmpdir = await scratch.get_space().acquire(_content_length(request))
+    handed_off = False
+    try:
+        audio_in = os.path.join(tmpdir, "input")
+        form = await _receive_fields(request, audio_in)
+        given = (("topic", form.get("topic")), ("audioFile or job", form.get("audioFile") or form.get("job")))
+        missing = [name for name, value in given if not value]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"Missing form fields: {', '.join(missing)}")
+        profile = await asyncio.to_thread(_select_profile, form.get("profile"), form.get("cover"))
+        title = profile.title(form["topic"])
+
+        if form.get("job"):
+            job = _get_job(form["job"])
+            if job["status"] != jobs.DONE:
+                raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+            if formats.FORMATS["mp3"] not in formats.parse(job["formats"]):
+                raise HTTPException(status_code=404, detail="Job has no mp3 result")
+            speaker = form.get("speaker") or job["speaker"]
+            result = await asyncio.to_thread(_retag_job, job, profile, title, speaker)
+            return download.FileDownload(result, "audio/mpeg", _download_headers(title))
+
+        if await asyncio.to_thread(encoders.probe_mp3, audio_in) is None:
+            raise HTTPException(status_code=400, detail="Not an MP3 file")
+        speaker = form.get("speaker") or "Unknown"
+        header, audio_start = await asyncio.to_thread(mp3.retag, audio_in, **profile.tags(title, speaker))
+        cleanup = BackgroundTask(scratch.get_space().release, tmpdir)
+        handed_off = True
+        if not header:
+            return download.FileDownload(audio_in, "audio/mpeg", _download_headers(title), background=cleanup)
+        return StreamingResponse(
+            mp3.stream_with_header(audio_in, header, audio_start),
+            media_type="audio/mpeg",
+            headers=_download_headers(title),
+            background=cleanup,
+        )
+    finally:
+        if not handed_off:
+            scratch.get_space().release(tmpdir)
+
+
+@app.get("/api/profiles")
+async def list_profiles():
+    registry = assets.get_registry()
+    return [{"name": name, "album": registry.get(name).album} for name in registry.names()]
+
+
+@app.get("/api/ready")
+async def readiness():
+    """200 while this process can convert: FFmpeg was found at startup and it isn't shutting down."""
+    if _ffmpeg_version is None:
+        raise HTTPException(status_code=503, detail="FFmpeg with MP3 support not found")
+    if _draining:
+        raise HTTPException(status_code=503, detail="Shutting down")
+    return {"ready": True, "ffmpeg": _ffmpeg_version, "pid": os.getpid()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    metrics.record_memory()
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/api/encoders")
+async def list_encoders():
+    registry = encoders.get_registry()
+    return [{**registry.get(name).describe(), "default": name == registry.default} for name in registry.names()]
+
+
+@app.get("/api/admission")
+async def admission_stats():
+    return admission.get_controller().stats()
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    result_cache = cache.get_cache()
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+
+def _preview_output(job_dir: str) -> list:
+    """The preview clip as an extra output of the encode, none when PREVIEW_SECONDS is 0."""
+    seconds = int(os.environ.get("PREVIEW_SECONDS", "").strip() or 30)
+    if seconds <= 0:
+        return []
+    # Small enough to start playing at once, good enough to recognise the episode
+    args = ["-t", str(seconds), "-ac", "1", "-ar", "22050", "-c:a", "libmp3lame", "-b:a", "32k"]
+    return [(args, os.path.join(job_dir, "preview.partial.mp3"))]
+
+
+def _run_job(job: dict, job_dir: str, on_progress) -> None:
+    audio_in = os.path.join(job_dir, "input")
+
+    profile = assets.get_registry().get(job["profile"])
+    job_cover = os.path.join(job_dir, "cover.jpg")
+    if os.path.exists(job_cover):
+        profile = profile.with_cover(job_cover)
+    # Scaled to the input's duration unless set
+    timeout_s = int(os.environ.get("JOB_TIMEOUT", "").strip() or 0) or None
+    processing = loudness.from_form(json.loads(job["processing"] or "{}"))
+    encoder = encoders.get_registry().get(job["encoder"])
+    output_formats = formats.parse(job["formats"])
+    options = _encode_options(audio_in, job["input_sha256"], processing, encoder, timeout_s)
+    timeout_s = options["timeout_s"]
+    tags = profile.tags(job["title"], job["speaker"])
+
+    # The waveform and the preview come out of the same decode as the results
+    tap = peaks.PeaksTap()
+    preview = _preview_output(job_dir)
+    tap.start()
+    try:
+        paths = _encode_formats(
+            audio_in, job_dir, output_formats, options, tags, encoder, on_progress, timeout_s, [*preview, tap.output()], tap.pass_fds,
+            job["input_sha256"] or "",
+        )
+    finally:
+        tap.close()
+    peaks.save(tap.finish(), job_dir)
+    for _, path in preview:
+        os.replace(path, os.path.join(job_dir, "preview.mp3"))
+    # Only a complete file ever carries the final name
+    for output_format in output_formats:
+        os.replace(paths[output_format.name], os.path.join(job_dir, f"result.{output_format.extension}"))
+    os.remove(audio_in)
+
+
+def _job_status(job: dict) -> dict:
+    status = {name: job[name] for name in ("id", "status", "progress", "title", "error")}
+    status["status_url"] = f"/api/jobs/{job['id']}"
+    if job["status"] == jobs.DONE:
+        status["result_url"] = f"/api/jobs/{job['id']}/result"
+        output_formats = formats.parse(job["formats"])
+        if _other_formats(output_formats):
+            status["results"] = {f.name: f"/api/jobs/{job['id']}/result?format={f.name}" for f in output_formats}
+        status["peaks_url"] = f"/api/jobs/{job['id']}/peaks"
+        status["peaks_levels"] = list(peaks.LEVELS)
+        if os.path.exists(os.path.join(jobs.get_runner().job_dir(job["id"]), "preview.mp3")):
+            status["preview_url"] = f"/api/jobs/{job['id']}/preview"
+    return status
+
+
+def _get_job(job_id: str) -> dict:
+    job = jobs.get_runner().store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/api/jobs", status_code=202, openapi_extra={"requestBody": _CONVERT_FORM})
+async def submit_job(request: Request):
+    # Jobs wait in the job queue rather than for a slot, only the quota applies
+    client = admission.client_of(request)
+    admission.get_controller().check(client)
+    runner = jobs.get_runner()
+    job = runner.create(title="", speaker="", filename="", profile=assets.DEFAULT_PROFILE)
+    job_dir = runner.job_dir(job["id"])
+    try:
+        with metrics.stage("upload"):
+            form, sink = await _receive_form(request, os.path.join(job_dir, "input"))
+        await sink.close()
+        # Refuse what can't be converted now rather than as a failed job later
+        info = await asyncio.to_thread(probe.probe_file, os.path.join(job_dir, "input"), sink.sha256.hexdigest())
+        admission.get_controller().charge(client, info.get("duration") or 0)
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    try:
+        processing, encoder = _encoding_choice(form)
+        output_formats = formats.parse(form.get("formats"))
+        profile = await asyncio.to_thread(_select_profile, form.get("profile"), form.get("cover"))
+        if form.get("cover"):
+            # Kept with the job so a restart still has it
+            shutil.copyfile(profile.cover_path, os.path.join(job_dir, "cover.jpg"))
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+    job.update(
+        title=profile.title(form["topic"]),
+        speaker=form["speaker"],
+        filename=sink.filename,
+        profile=profile.name,
+        processing=json.dumps(processing.options()),
+        encoder=encoder.name,
+        formats=",".join(f.name for f in output_formats),
+        input_sha256=sink.sha256.hexdigest(),
+    )
+    runner.submit(job)
+    logger.debug("Queued job %s", job['id'])
+    return _job_status(job)
+
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    return _job_status(_get_job(job_id))
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str, format: Optional[str] = None):
+    job = _get_job(job_id)
+    if job["status"] != jobs.DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    # The first format the job was submitted with, unless another one is asked for
+    output_formats = formats.parse(job["formats"])
+    output_format = formats.parse(format)[0] if format else output_formats[0]
+    if output_format not in output_formats:
+        raise HTTPException(status_code=404, detail=f"Job has no {output_format.name} result")
+    result = os.path.join(jobs.get_runner().job_dir(job_id), f"result.{output_format.extension}")
+    headers = _download_headers(job["title"], output_format.extension)
+    return download.FileDownload(result, output_format.media_type, headers)
+
+
+@app.get("/api/results/{result_id}")
+async def stored_result(result_id: str):
+    """A recent /api/convert output again, e.g. to resume its download with a Range request."""
+    result = results.get_store().get(result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    return download.FileDownload(result["path"], result["media_type"], result["headers"])
+
+
+# A finished job's waveform and preview never change
+_ARTIFACT_HEADERS = {"Cache-Control": "private, max-age=86400"}
+
+
+def _job_artifact(job_id: str, name: str) -> str:
+    job = _get_job(job_id)
+    if job["status"] != jobs.DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    path = os.path.join(jobs.get_runner().job_dir(job_id), name)
+    if not os.path.exists(path):
+        # Jobs finished before peaks and previews existed, or with PREVIEW_SECONDS=0
+        raise HTTPException(status_code=404, detail=f"Job has no {name}")
+    return path
+
+
+@app.get("/api/jobs/{job_id}/peaks")
+async def job_peaks(job_id: str, samples_per_pixel: int = peaks.LEVELS[-1]):
+    """Min/max pairs of the episode in audiowaveform's binary .dat format, coarsest zoom level by default."""
+    if samples_per_pixel not in peaks.LEVELS:
+        levels = ", ".join(map(str, peaks.LEVELS))
+        raise HTTPException(status_code=404, detail=f"No peaks at {samples_per_pixel} samples per pixel; choose from {levels}")
+    path = _job_artifact(job_id, peaks.file_name(samples_per_pixel))
+    return download.FileDownload(path, "application/octet-stream", _ARTIFACT_HEADERS)
+
+
+@app.get("/api/jobs/{job_id}/preview")
+async def job_preview(job_id: str):
+    path = _job_artifact(job_id, "preview.mp3")
+    return download.FileDownload(path, "audio/mpeg", _ARTIFACT_HEADERS)
 
 
-main()
+# Last, so the API routes take precedence over the frontend's files
+if os.path.isdir("static"):
+    app.mount("/", StaticFiles(directory="static", html=True), name="static")
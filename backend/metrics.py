@@ -0,0 +1,260 @@
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: list["_Metric"] = []
+
+# Stage durations of the request being handled, for its Server-Timing header
+_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("timings", default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values) or ({(): 0} if not self.labels else {})
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    # Seconds, from a cached re-tag to a multi-hour job
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.setdefault(key, [[0] * len(self.buckets), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[key][1] = total + value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[0][-1] if series else 0
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}"
+
+
+STAGE_SECONDS = Histogram(
+    "audio_producer_stage_seconds", "Time spent in each stage of a conversion (queue, upload, encode, tag, send)", ("stage",)
+)
+REQUEST_BYTES = Counter("audio_producer_request_bytes_total", "Request body bytes received by the API")
+RESPONSE_BYTES = Counter("audio_producer_response_bytes_total", "Response body bytes sent by the API")
+FFMPEG_FAILURES = Counter("audio_producer_ffmpeg_failures_total", "FFmpeg runs that exited with an error", ("exit_code",))
+FFMPEG_TIMEOUTS = Counter("audio_producer_ffmpeg_timeouts_total", "FFmpeg runs killed for taking too long")
+WARM_ENCODERS = Counter(
+    "audio_producer_warm_encoder_total", "Encodes that found a pre-started FFmpeg (hit) or had to start one (miss)", ("result",)
+)
+RETAGS = Counter(
+    "audio_producer_retag_total", "Tags replaced in place (in_place) or by rewriting the file (rewritten)", ("result",)
+)
+SCRATCH_RESERVED = Gauge("audio_producer_scratch_reserved_bytes", "Scratch space handed out to conversions", ("root",))
+IN_FLIGHT = Gauge("audio_producer_conversions_in_flight", "Conversions running or waiting for a worker")
+STARTUP_SECONDS = Gauge("audio_producer_startup_seconds", "Seconds from the start (or fork) of this process until it served")
+MEMORY_BYTES = Gauge(
+    "audio_producer_memory_bytes",
+    "Memory of this process: rss, pss (shared pages divided among the processes sharing them) and shared",
+    ("kind",),
+)
+ADMISSION_WAITING = Gauge("audio_producer_admission_waiting", "Conversions waiting for a slot behind other clients")
+ADMISSION_REJECTIONS = Counter(
+    "audio_producer_admission_rejections_total",
+    "Requests refused before their upload was read: busy, timeout (503), concurrency or quota (429)",
+    ("reason",),
+)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one stage of the current conversion."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def process_age() -> Optional[float]:
+    """Seconds since this process was started, or forked; None where /proc isn't available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name can contain spaces, the fields after it can't
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+def memory() -> dict:
+    """{"rss", "pss", "shared"} bytes of this process, empty where /proc isn't available."""
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"):
+                    fields[name] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return {}
+    return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0), "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)}
+
+
+def record_memory() -> dict:
+    usage = memory()
+    for kind, value in usage.items():
+        MEMORY_BYTES.set(value, kind=kind)
+    return usage
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+class MetricsMiddleware:
+    """Counts API body bytes, times the response send and adds a Server-Timing header.
+
+    Only stages that finished before the response started can be in the
+    header; with a streamed response that is usually just the upload. The
+    send stage is only recorded for requests that did conversion work.
+    """
+
+    def __init__(self, app, prefix: str = "/api/"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        timings: dict = {}
+        token = _timings.set(timings)
+        started = [0.0]
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                REQUEST_BYTES.inc(len(message.get("body", b"")))
+            return message
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                if timings:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                    message = {**message, "headers": headers}
+                started[0] = time.perf_counter()
+            elif message["type"] == "http.response.body":
+                RESPONSE_BYTES.inc(len(message.get("body", b"")))
+                if not message.get("more_body", False) and timings:
+                    observe_stage("send", time.perf_counter() - started[0])
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timed_send)
+        finally:
+            _timings.reset(token)
@@ -1,17 +1,62 @@
+import io
+import mmap
+import os
+import re
+import shutil
 import subprocess
-import os.path
-from typing import Optional
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
 
 from fastapi import HTTPException
-from mutagen.id3 import ID3, APIC, TIT2, TALB, TPE1, TPE2, TDRC, TRCK, TCON
+from mutagen.id3 import ID3, APIC, TIT2, TALB, TPE1, TPE2, TDRC, TRCK, TCON, ID3NoHeaderError
 from mutagen.mp3 import MP3
 
-from backend import log
+from backend import ingest, log, metrics, warm
 logger = log.getLogger(__name__)
 
+# Used when no encoder profile is given (see encoders.py)
+ENCODER_ARGS = ["-c:a", "libmp3lame", "-q:a", "2"]
+# No seeking on a pipe: skip the ID3 tag and the Xing frame ffmpeg would have
+# to patch afterwards.
+PIPE_OUTPUT_ARGS = ["-id3v2_version", "0", "-write_xing", "0", "-f", "mp3"]
 
-def _run_ffmpeg(args: list[str], timeout_s: int = 60) -> None:
-    logger.debug(f"Running FFmpeg: {' '.join(args)}")
+_DURATION_RE = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+# Zero bytes left at the end of the tags we write, so a later retag with a
+# slightly longer title or speaker fits without moving the audio
+ID3_PADDING = 1024
+
+
+def encoder_settings(piped_output: bool = False, processing: str = "", encoder: Optional[list[str]] = None) -> str:
+    """Everything besides the input that determines the encoded frames.
+
+    `processing` describes the audio filters (see loudness.Processing.settings()),
+    `encoder` are the encoder arguments of the profile in use.
+    """
+    settings = " ".join((encoder or ENCODER_ARGS) + (PIPE_OUTPUT_ARGS if piped_output else []))
+    return f"{settings} -af {processing}" if processing else settings
+
+
+def _filter_args(filters: Optional[str]) -> list[str]:
+    return ["-af", filters] if filters else []
+
+
+def _timed_out() -> HTTPException:
+    metrics.FFMPEG_TIMEOUTS.inc()
+    return HTTPException(status_code=504, detail="Transcode timed out")
+
+
+def _failed(returncode: int, stderr: str) -> HTTPException:
+    metrics.FFMPEG_FAILURES.inc(exit_code=returncode)
+    logger.error(f"FFmpeg failed: {stderr}")
+    return HTTPException(status_code=400, detail=f"FFmpeg failed: {stderr}")
+
+
+def _run_ffmpeg(args: list[str], timeout_s: Optional[int] = 60, pass_fds: tuple = ()) -> str:
+    logger.debug("Running FFmpeg: %s", log.lazy(" ".join, args))
     try:
         proc = subprocess.run(
             args,
@@ -19,42 +64,389 @@ def _run_ffmpeg(args: list[str], timeout_s: int = 60) -> None:
             stderr=subprocess.PIPE,
             timeout=timeout_s,
             check=False,
+            pass_fds=pass_fds,
         )
     except subprocess.TimeoutExpired as e:
-        raise HTTPException(status_code=504, detail="Transcode timed out") from e
+        raise _timed_out() from e
 
-    logger.debug(f"FFmpeg return code: {proc.returncode}")
+    logger.debug("FFmpeg return code: %s", proc.returncode)
     if proc.returncode != 0:
-        stderr = proc.stderr.decode("utf-8", errors="replace")[-4000:]
-        logger.error(f"FFmpeg failed: {stderr}")
-        raise HTTPException(status_code=400, detail=f"FFmpeg failed: {stderr}")
-
-
-def convert_to_mp3(audio_in: str, mp3_out: str) -> None:
-    _run_ffmpeg(
-        [
-            "ffmpeg",
-            "-y",
-            "-i",
-            audio_in,
-            "-vn",
-            "-c:a",
-            "libmp3lame",
-            "-q:a",
-            "2",
-            mp3_out,
-        ],
-    )
+        raise _failed(proc.returncode, proc.stderr.decode("utf-8", errors="replace")[-4000:])
+    return proc.stderr.decode("utf-8", errors="replace")
+
+
+def _parse_duration(line: bytes) -> Optional[float]:
+    match = _DURATION_RE.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _run_ffmpeg_with_progress(
+    args: list[str], on_progress: Callable[[float], None], timeout_s: Optional[int], pass_fds: tuple = ()
+) -> None:
+    """Like _run_ffmpeg, reporting percent done from ffmpeg's -progress output."""
+    args = [args[0], "-progress", "pipe:1", "-nostats", *args[1:]]
+    logger.debug("Running FFmpeg: %s", log.lazy(" ".join, args))
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds)
+
+    stderr_tail: deque = deque(maxlen=200)
+    duration: list[float] = []
+
+    def read_stderr():
+        for line in proc.stderr:
+            stderr_tail.append(line)
+            if not duration:
+                parsed = _parse_duration(line)
+                if parsed:
+                    duration.append(parsed)
+
+    reader = threading.Thread(target=read_stderr, daemon=True)
+    reader.start()
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout_s, kill) if timeout_s else None
+    if timer:
+        timer.start()
+    try:
+        for line in proc.stdout:
+            key, _, value = line.decode("ascii", errors="replace").strip().partition("=")
+            if key != "out_time_us" or not duration:
+                continue
+            try:
+                done_s = int(value) / 1_000_000
+            except ValueError:
+                # N/A until the first packet is out
+                continue
+            on_progress(max(0.0, min(99.9, 100 * done_s / duration[0])))
+        returncode = proc.wait()
+        reader.join()
+    finally:
+        if timer:
+            timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    logger.debug("FFmpeg return code: %s", returncode)
+    if returncode != 0:
+        if timed_out.is_set():
+            raise _timed_out()
+        raise _failed(returncode, b"".join(stderr_tail).decode("utf-8", errors="replace")[-4000:])
+
 
-    logger.debug(f"FFmpeg completed, checking output file: {mp3_out}")
+def convert_to_mp3(
+    audio_in: str,
+    mp3_out: str,
+    tag_args: Optional[list[str]] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+    timeout_s: Optional[int] = 60,
+    filters: Optional[str] = None,
+    encoder: Optional[list[str]] = None,
+) -> None:
+    args = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        audio_in,
+        *(tag_args or ["-vn"]),
+        *_filter_args(filters),
+        *(encoder or ENCODER_ARGS),
+        mp3_out,
+    ]
+    with metrics.stage("encode"):
+        if on_progress is None:
+            _run_ffmpeg(args, timeout_s)
+        else:
+            _run_ffmpeg_with_progress(args, on_progress, timeout_s)
+
+    logger.debug("FFmpeg completed, checking output file: %s", mp3_out)
     if os.path.exists(mp3_out):
-        logger.debug(f"Output file exists, size: {os.path.getsize(mp3_out)} bytes")
+        logger.debug("Output file exists, size: %s bytes", log.lazy(os.path.getsize, mp3_out))
         return
 
     logger.error("Output file does not exist after FFmpeg conversion!")
     raise HTTPException(status_code=500, detail="FFmpeg conversion failed to produce output file")
 
 
+def convert_outputs(
+    audio_in: str,
+    outputs: list[tuple[list[str], str]],
+    on_progress: Optional[Callable[[float], None]] = None,
+    timeout_s: Optional[int] = 60,
+    filters: Optional[str] = None,
+    pass_fds: tuple = (),
+) -> None:
+    """Encode `audio_in` into several files at once: (encoder arguments, path) per output.
+
+    One ffmpeg run decodes and filters the input once and feeds every
+    encoder from it. The outputs are left untagged. A path may be a
+    "pipe:N" for one of `pass_fds`.
+    """
+    if filters:
+        labels = [f"[out{n}]" for n in range(len(outputs))]
+        split = f",asplit={len(outputs)}" if len(outputs) > 1 else ""
+        args = ["ffmpeg", "-y", "-i", audio_in, "-filter_complex", f"[0:a:0]{filters}{split}{''.join(labels)}"]
+    else:
+        labels = ["0:a:0"] * len(outputs)
+        args = ["ffmpeg", "-y", "-i", audio_in]
+    for label, (encoder, path) in zip(labels, outputs):
+        # Tags are written afterwards, none of the input's should carry over
+        args += ["-map", label, "-map_metadata", "-1", *encoder]
+        if path.endswith(".mp3"):
+            args += ["-id3v2_version", "0"]
+        args.append(path)
+    with metrics.stage("encode"):
+        if on_progress is None:
+            _run_ffmpeg(args, timeout_s, pass_fds)
+        else:
+            _run_ffmpeg_with_progress(args, on_progress, timeout_s, pass_fds)
+
+    missing = [path for _, path in outputs if not path.startswith("pipe:") and not os.path.exists(path)]
+    if missing:
+        logger.error(f"FFmpeg did not produce {', '.join(missing)}")
+        raise HTTPException(status_code=500, detail="FFmpeg conversion failed to produce output file")
+
+
+def _pipe_args(filters: Optional[str], encoder: Optional[list[str]]) -> list[str]:
+    """ffmpeg arguments for encoding stdin into untagged MP3 frames, all but the output path."""
+    return ["ffmpeg", "-y", "-i", "pipe:0", "-vn", *_filter_args(filters), *(encoder or ENCODER_ARGS), "-id3v2_version", "0"]
+
+
+def prewarm(encoder: Optional[list[str]] = None) -> None:
+    """Keep ffmpeg processes for `encoder` started, so short inputs don't wait for one."""
+    warm.get_pool().prewarm(_pipe_args(None, encoder))
+
+
+def _start_pipe(filters: Optional[str], encoder: Optional[list[str]], mp3_out: str, workdir: str) -> warm.EncoderProcess:
+    # Warm processes are only kept for plain encodes; filters can carry per-input measurements
+    process = None if filters else warm.get_pool().take(_pipe_args(filters, encoder))
+    if process is None:
+        process = warm.EncoderProcess(_pipe_args(filters, encoder), mp3_out, os.path.join(workdir, "ffmpeg.log"))
+    logger.debug("Running FFmpeg on piped input: %s", log.lazy(" ".join, process.proc.args))
+    return process
+
+
+def _feed(
+    process: warm.EncoderProcess, chunks: Iterable[bytes], mp3_out: str, timeout_s: Optional[int], uploading: bool = True
+) -> None:
+    """Write `chunks` to the stdin of `process` and wait for it to finish `mp3_out`.
+
+    With `uploading`, the chunks arrive with the upload and only the wait
+    after the last one counts as encoding.
+    """
+    timer = None
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.proc.kill()
+
+    try:
+        with nullcontext() if uploading else metrics.stage("encode"):
+            received = 0
+            for chunk in chunks:
+                try:
+                    process.proc.stdin.write(chunk)
+                except BrokenPipeError:
+                    # ffmpeg gave up on the input, its exit status tells why
+                    break
+                received += len(chunk)
+            logger.debug("Piped %s bytes into FFmpeg", received)
+            try:
+                process.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            # Only what is left after the input ends; the rest overlapped the upload
+            with metrics.stage("encode") if uploading else nullcontext():
+                # wait(timeout) polls with growing sleeps, which adds up to
+                # tens of ms to a short clip; a timer kills ffmpeg instead
+                if timeout_s:
+                    timer = threading.Timer(timeout_s, kill)
+                    timer.start()
+                returncode = process.proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        process.kill()
+
+    logger.debug("FFmpeg return code: %s", returncode)
+    try:
+        if returncode != 0 and timed_out.is_set():
+            raise _timed_out()
+        if returncode != 0:
+            raise _failed(returncode, process.stderr())
+        if process.output != mp3_out:
+            shutil.move(process.output, mp3_out)
+    finally:
+        if process.output != mp3_out:
+            process.remove_files()
+
+
+def _read_chunks(path: str, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def convert_untagged(
+    audio_in: str, mp3_out: str, filters: Optional[str] = None, encoder: Optional[list[str]] = None, timeout_s: Optional[int] = 60
+) -> None:
+    """Encode to bare MP3 frames, for an ID3 header to be put in front later.
+
+    Uses a warm ffmpeg process when one is ready, falling back to a fresh
+    one if there is none or it can't handle the input on stdin.
+    """
+    process = None
+    if not filters and warm.get_pool().enabled:
+        with open(audio_in, "rb") as f:
+            head = f.read(ingest.SNIFF_BYTES)
+        if not ingest.needs_seekable_input(head, ""):
+            process = warm.get_pool().take(_pipe_args(None, encoder))
+    if process is not None:
+        logger.debug("Encoding %s on a warm FFmpeg", audio_in)
+        try:
+            _feed(process, _read_chunks(audio_in), mp3_out, timeout_s, uploading=False)
+            return
+        except HTTPException as e:
+            if e.status_code == 504:
+                raise
+            logger.info("Warm FFmpeg failed on %s, retrying from the file", audio_in)
+    convert_to_mp3(audio_in, mp3_out, ["-vn", "-id3v2_version", "0"], timeout_s=timeout_s, filters=filters, encoder=encoder)
+
+
+def measure(audio_in: str, filters: str, timeout_s: Optional[int] = 60) -> str:
+    """Decode through analysis-only `filters` without encoding anything; returns ffmpeg's log."""
+    args = ["ffmpeg", "-hide_banner", "-nostats", "-i", audio_in, "-vn", "-af", filters, "-f", "null", "-"]
+    with metrics.stage("analyze"):
+        return _run_ffmpeg(args, timeout_s)
+
+
+_AUDIO_STREAM_RE = re.compile(r"Stream #\d+:\d+.*?: Audio: ([^,]+), (\d+) Hz, ([^,]+)")
+
+
+def ffmpeg_version(timeout_s: int = 10) -> Optional[str]:
+    """Version of the ffmpeg on PATH, None if there is none or it can't encode MP3."""
+    try:
+        version = subprocess.run(["ffmpeg", "-version"], capture_output=True, timeout=timeout_s)
+        available = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, timeout=timeout_s)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = re.match(rb"ffmpeg version (\S+)", version.stdout)
+    if version.returncode != 0 or not match or b"libmp3lame" not in available.stdout:
+        return None
+    return match.group(1).decode(errors="replace")
+
+
+def probe(audio_in: str, timeout_s: Optional[int] = 60) -> Optional[dict]:
+    """Duration in seconds (None if unknown), codec, sample rate and channel count of the first audio stream.
+
+    Reads only the container headers. None when ffmpeg finds no audio.
+    """
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-i", audio_in], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout_s
+        )
+    except subprocess.TimeoutExpired as e:
+        raise _timed_out() from e
+    # Without an output ffmpeg exits with an error after printing what it found
+    log_text = proc.stderr.decode("utf-8", errors="replace")
+    stream = _AUDIO_STREAM_RE.search(log_text)
+    if not stream:
+        return None
+    layout = stream.group(3).strip()
+    channels = re.match(r"(\d+) channels", layout)
+    return {
+        "duration": _parse_duration(log_text.encode()),
+        "codec": stream.group(1).split()[0],
+        "sample_rate": int(stream.group(2)),
+        "channels": 1 if layout == "mono" else int(channels.group(1)) if channels else 2,
+    }
+
+
+def duration(mp3_path: str) -> float:
+    """Length of an encoded MP3 in seconds, from its Xing header."""
+    return MP3(mp3_path).info.length
+
+
+def convert_pipe(
+    chunks: Iterable[bytes],
+    mp3_out: str,
+    workdir: str,
+    timeout_s: int = 60,
+    filters: Optional[str] = None,
+    encoder: Optional[list[str]] = None,
+) -> None:
+    """Encode input fed to ffmpeg's stdin chunk by chunk into untagged MP3 frames.
+
+    The timeout starts once the input is complete, not while it is still
+    being uploaded.
+    """
+    _feed(_start_pipe(filters, encoder, mp3_out, workdir), chunks, mp3_out, timeout_s)
+
+
+def ffmpeg_tag_args(
+    *,
+    title: str,
+    album: str,
+    artist: str,
+    album_artist: str,
+    year: Optional[str],
+    genre: Optional[str],
+    cover_path: str,
+    cover_mime: str,
+) -> list[str]:
+    # ffmpeg's mp3 muxer maps these keys onto TIT2/TALB/TPE1/TPE2/TDRC/TCON and
+    # turns an attached picture stream into an APIC frame, so the file is
+    # encoded and tagged in a single write. cover_mime is implied by the codec.
+    metadata = {
+        "title": title,
+        "album": album,
+        "artist": artist,
+        "album_artist": album_artist,
+        "date": year,
+        "genre": genre,
+    }
+    args = [
+        "-i", cover_path,
+        "-map", "0:a:0",
+        "-map", "1:v:0",
+        "-c:v", "copy",
+        "-disposition:v", "attached_pic",
+        "-metadata:s:v", "title=Cover",
+        "-metadata:s:v", "comment=Cover (front)",
+        "-id3v2_version", "3",
+    ]
+    for key, value in metadata.items():
+        if value:
+            args += ["-metadata", f"{key}={value}"]
+    return args
+
+
+def convert_and_tag(
+    audio_in: str,
+    mp3_out: str,
+    *,
+    on_progress: Optional[Callable[[float], None]] = None,
+    timeout_s: Optional[int] = 60,
+    filters: Optional[str] = None,
+    encoder: Optional[list[str]] = None,
+    **tags,
+) -> None:
+    options = dict(on_progress=on_progress, timeout_s=timeout_s, filters=filters, encoder=encoder)
+    if os.environ.get("TAG_MODE", "ffmpeg") == "mutagen":
+        convert_to_mp3(audio_in, mp3_out, **options)
+        write_id3_tags(mp3_out, **tags)
+        return
+
+    convert_to_mp3(audio_in, mp3_out, ffmpeg_tag_args(**tags), **options)
+
+
 def write_an_id3_tag(
     value,
     spec_function,
@@ -65,8 +457,8 @@ def write_an_id3_tag(
     mutable_tags.add(tag)
 
 
-def write_id3_tags(
-    mp3_path: str,
+def _fill_id3_tags(
+    tags: ID3,
     *,
     title: str,
     album: str,
@@ -77,13 +469,6 @@ def write_id3_tags(
     cover_path: str,
     cover_mime: str,
 ) -> None:
-    MP3(mp3_path).save()
-
-    try:
-        tags = ID3(mp3_path)
-    except Exception:
-        tags = ID3()
-
     write_an_id3_tag(title, TIT2, tags)
     write_an_id3_tag(album, TALB, tags)
     write_an_id3_tag(artist, TPE1, tags)
@@ -96,6 +481,12 @@ def write_id3_tags(
         write_an_id3_tag(genre, TCON, tags)
 
     # write cover image
+    with open(cover_path, "rb") as f:
+        cover_data = f.read()
+    _add_cover(tags, cover_data, cover_mime)
+
+
+def _add_cover(tags: ID3, cover_data: bytes, cover_mime: str) -> None:
     tags.delall("APIC")
     tags.add(
         APIC(
@@ -103,8 +494,256 @@ def write_id3_tags(
             mime=cover_mime,
             type=3,
             desc="Cover",
-            data=open(cover_path, "rb").read(),
+            data=cover_data,
         )
     )
 
-    tags.save(mp3_path, v2_version=3)
+
+def write_id3_tags(mp3_path: str, **tags) -> None:
+    with metrics.stage("tag"):
+        MP3(mp3_path).save()
+
+        try:
+            id3 = ID3(mp3_path)
+        except Exception:
+            id3 = ID3()
+
+        _fill_id3_tags(id3, **tags)
+        id3.save(mp3_path, v2_version=3, padding=lambda info: ID3_PADDING)
+
+
+def build_id3_header(**tags) -> bytes:
+    """Serialize the ID3v2.3 tag on its own so it can be sent ahead of untagged MP3 frames."""
+    with metrics.stage("tag"):
+        id3 = ID3()
+        _fill_id3_tags(id3, **tags)
+        header = io.BytesIO()
+        id3.save(header, v2_version=3, padding=lambda info: ID3_PADDING)
+        return header.getvalue()
+
+
+def _serialize_frames(id3: ID3) -> bytes:
+    out = io.BytesIO()
+    id3.save(out, v2_version=3, padding=lambda info: 0)
+    # Drop the 10-byte tag header, keep the frames
+    return out.getvalue()[10:]
+
+
+def static_id3_frames(*, album: str, album_artist: str, genre: Optional[str], cover_data: bytes, cover_mime: str) -> bytes:
+    """Serialize the frames every episode of an album shares, for id3_header_from_frames()."""
+    id3 = ID3()
+    write_an_id3_tag(album, TALB, id3)
+    write_an_id3_tag(album_artist, TPE2, id3)
+    if genre:
+        write_an_id3_tag(genre, TCON, id3)
+    _add_cover(id3, cover_data, cover_mime)
+    return _serialize_frames(id3)
+
+
+def id3_header_from_frames(static_frames: bytes, *, title: str, artist: str, year: Optional[str]) -> bytes:
+    """Build an ID3v2.3 tag from pre-serialized shared frames plus the per-episode ones."""
+    with metrics.stage("tag"):
+        id3 = ID3()
+        write_an_id3_tag(title, TIT2, id3)
+        write_an_id3_tag(artist, TPE1, id3)
+        if year:
+            write_an_id3_tag(year, TDRC, id3)
+        frames = _serialize_frames(id3) + static_frames
+    return _id3_header(frames)
+
+
+def _id3_header(frames: bytes, padding: int = ID3_PADDING) -> bytes:
+    size = len(frames) + padding
+    # Tag size is a 28-bit "syncsafe" integer, 7 bits per byte
+    syncsafe = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b"ID3\x03\x00\x00" + syncsafe + frames + bytes(padding)
+
+
+def id3_tag_size(head: bytes) -> int:
+    """Bytes taken by the ID3v2 tag that `head` (at least 10 bytes of a file) starts with, 0 without one."""
+    if len(head) < 10 or head[:3] != b"ID3" or any(b & 0x80 for b in head[6:10]):
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    # A v2.4 footer repeats the header after the frames
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def retag(mp3_path: str, in_place: bool = True, **tags) -> tuple[bytes, int]:
+    """Replace the ID3v2 tag of `mp3_path`, keeping any frames the new tags don't cover.
+
+    If the new tag fits into the space of the old one, padding included, it
+    is written over it and (b"", 0) is returned: the audio frames are not
+    touched. Otherwise, or without `in_place` (someone may be reading the
+    file), the file is left alone and the new tag, with fresh padding, is
+    returned along with the offset its audio frames start at.
+    """
+    with metrics.stage("tag"):
+        with open(mp3_path, "rb") as f:
+            old_size = id3_tag_size(f.read(10))
+        try:
+            id3 = ID3(mp3_path) if old_size else ID3()
+        except ID3NoHeaderError:
+            id3 = ID3()
+        _fill_id3_tags(id3, **tags)
+        frames = _serialize_frames(id3)
+
+        if in_place and old_size and 10 + len(frames) <= old_size:
+            header = _id3_header(frames, padding=old_size - 10 - len(frames))
+            fd = os.open(mp3_path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, header, 0)
+            finally:
+                os.close(fd)
+            metrics.RETAGS.inc(result="in_place")
+            logger.debug("Rewrote the %s byte tag of %s in place", old_size, mp3_path)
+            return b"", 0
+
+        metrics.RETAGS.inc(result="rewritten")
+        logger.debug("New tag of %s rewrites it, its old tag took %s bytes", mp3_path, old_size)
+        return _id3_header(frames), old_size
+
+
+def copy_with_header(src: BinaryIO, dst_path: str, header: bytes, audio_start: int = 0) -> None:
+    """Write `header` and then the audio of `src` from `audio_start` to `dst_path`; the audio is copied by the kernel."""
+    with open(dst_path, "wb") as dst:
+        dst.write(header)
+        dst.flush()
+        offset, remaining = audio_start, os.fstat(src.fileno()).st_size - audio_start
+        try:
+            while remaining > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        except OSError:
+            # No file-to-file sendfile on this platform
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+
+
+def rewrite_with_header(mp3_path: str, header: bytes, audio_start: int) -> None:
+    """Replace everything before `audio_start` with `header`; the audio is copied by the kernel."""
+    partial = f"{mp3_path}.partial"
+    with open(mp3_path, "rb") as src:
+        copy_with_header(src, partial, header, audio_start)
+    os.replace(partial, mp3_path)
+
+
+def stream_with_header(mp3_path: str, header: bytes, audio_start: int, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Yield `header` followed by the audio of `mp3_path` from `audio_start`, read through a memory map."""
+    yield header
+    with open(mp3_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= audio_start:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as frames:
+            for position in range(audio_start, len(frames), chunk_size):
+                yield frames[position:position + chunk_size]
+
+
+class _Watchdog:
+    """One thread that calls `on_timeout` once it has been running for `timeout_s`, not counting pauses."""
+
+    def __init__(self, timeout_s: float, on_timeout: Callable[[], None]):
+        self.fired = False
+        self._remaining_s = float(timeout_s)
+        # When it was last resumed, None while paused
+        self._since: Optional[float] = None
+        self._stopped = False
+        self._on_timeout = on_timeout
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name="ffmpeg-watchdog", daemon=True).start()
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._stopped:
+                if self._since is None:
+                    self._cond.wait()
+                    continue
+                left_s = self._remaining_s - (time.perf_counter() - self._since)
+                if left_s <= 0:
+                    self.fired = True
+                    break
+                self._cond.wait(left_s)
+        if self.fired:
+            self._on_timeout()
+
+    def resume(self) -> None:
+        with self._cond:
+            self._since = time.perf_counter()
+            self._cond.notify()
+
+    def pause(self) -> None:
+        # The thread wakes at the old deadline, finds it paused and waits again
+        with self._cond:
+            if self._since is not None:
+                self._remaining_s -= time.perf_counter() - self._since
+                self._since = None
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
+def stream_mp3(
+    audio_in: str,
+    workdir: str,
+    chunk_size: int = 64 * 1024,
+    timeout_s: int = 60,
+    filters: Optional[str] = None,
+    encoder: Optional[list[str]] = None,
+) -> Iterator[bytes]:
+    """Encode to untagged MP3 frames on ffmpeg's stdout and yield them as they arrive.
+
+    Raises HTTPException if ffmpeg fails before producing any audio. Closing the
+    generator early (client went away) kills ffmpeg.
+    """
+    args = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        audio_in,
+        "-vn",
+        *_filter_args(filters),
+        *(encoder or ENCODER_ARGS),
+        *PIPE_OUTPUT_ARGS,
+        "pipe:1",
+    ]
+    logger.debug("Streaming FFmpeg: %s", log.lazy(" ".join, args))
+    stderr_path = os.path.join(workdir, "ffmpeg.log")
+    with open(stderr_path, "wb") as stderr:
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+    # Only the time spent waiting on ffmpeg counts against the timeout, not
+    # the time the consumer (a slow download) takes to take each chunk
+    watchdog = _Watchdog(timeout_s, proc.kill)
+    started = time.perf_counter()
+    sent = 0
+    try:
+        while True:
+            watchdog.resume()
+            chunk = proc.stdout.read(chunk_size)
+            watchdog.pause()
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+
+        watchdog.resume()
+        returncode = proc.wait()
+        watchdog.pause()
+        metrics.observe_stage("encode", time.perf_counter() - started)
+        logger.debug("FFmpeg return code: %s, streamed %s bytes", returncode, sent)
+        if returncode != 0:
+            if watchdog.fired:
+                raise _timed_out()
+            with open(stderr_path, "rb") as f:
+                raise _failed(returncode, f.read()[-4000:].decode("utf-8", errors="replace"))
+    finally:
+        watchdog.stop()
+        if proc.poll() is None:
+            logger.debug("Stream closed early, killing FFmpeg")
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
@@ -0,0 +1,156 @@
+import os
+import struct
+import threading
+from typing import TYPE_CHECKING, Optional
+
+from backend import log, metrics
+
+# numpy takes longer to import than the rest of the API and only jobs need
+# peaks, so it is imported where it's used
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = log.getLogger(__name__)
+
+# PCM tapped for the waveform: mono, 16-bit, at a rate that is plenty for drawing
+SAMPLE_RATE = 8000
+# Samples per min/max pair, finest first; each level is 4 times coarser than the one before
+LEVELS = (32, 128, 512, 2048)
+# audiowaveform's binary format (version 1, 8-bit), which waveform viewers like peaks.js read
+_HEADER = struct.Struct("<iIiiI")
+_FLAG_8_BIT = 1
+
+
+def file_name(samples_per_pixel: int) -> str:
+    return f"peaks-{samples_per_pixel}.dat"
+
+
+class PeaksBuilder:
+    """Min/max per bucket of 16-bit mono PCM fed in arbitrary pieces, at every zoom level.
+
+    Only the finest level is computed from the samples; the coarser ones
+    are reductions of it, so each sample is looked at once.
+    """
+
+    def __init__(self, levels: tuple = LEVELS):
+        self.levels = levels
+        self._bucket = levels[0]
+        self._rest = b""
+        self._mins: list = []
+        self._maxs: list = []
+
+    def feed(self, pcm: bytes) -> None:
+        import numpy as np
+
+        data = self._rest + pcm
+        # Whole buckets only; an odd trailing byte waits for its partner too
+        usable = len(data) // (2 * self._bucket) * 2 * self._bucket
+        self._rest = data[usable:]
+        if not usable:
+            return
+        buckets = np.frombuffer(data, dtype="<i2", count=usable // 2).reshape(-1, self._bucket)
+        self._mins.append(buckets.min(axis=1))
+        self._maxs.append(buckets.max(axis=1))
+
+    def finish(self) -> dict:
+        """{samples_per_pixel: int8 array of interleaved min, max} for every level."""
+        import numpy as np
+
+        if len(self._rest) >= 2:
+            tail = np.frombuffer(self._rest, dtype="<i2", count=len(self._rest) // 2)
+            self._mins.append(tail.min(keepdims=True))
+            self._maxs.append(tail.max(keepdims=True))
+        mins = np.concatenate(self._mins) if self._mins else np.zeros(0, dtype="<i2")
+        maxs = np.concatenate(self._maxs) if self._maxs else np.zeros(0, dtype="<i2")
+
+        result = {}
+        for samples_per_pixel in self.levels:
+            factor = samples_per_pixel // self._bucket
+            if factor > 1 and len(mins):
+                # Pad the last bucket with values that don't change its min or max
+                pad = -len(mins) % factor
+                mins = np.concatenate([mins, np.repeat(mins[-1:], pad)]).reshape(-1, factor).min(axis=1)
+                maxs = np.concatenate([maxs, np.repeat(maxs[-1:], pad)]).reshape(-1, factor).max(axis=1)
+            pairs = np.empty(2 * len(mins), dtype=np.int8)
+            # The top byte of each 16-bit sample
+            pairs[0::2] = mins >> 8
+            pairs[1::2] = maxs >> 8
+            result[samples_per_pixel] = pairs
+            self._bucket = samples_per_pixel
+        self._bucket = self.levels[0]
+        return result
+
+
+def encode(samples_per_pixel: int, pairs: "np.ndarray") -> bytes:
+    return _HEADER.pack(1, _FLAG_8_BIT, SAMPLE_RATE, samples_per_pixel, len(pairs) // 2) + pairs.tobytes()
+
+
+def decode(data: bytes) -> tuple[int, "np.ndarray"]:
+    """(samples_per_pixel, interleaved min/max) of a file written by save()."""
+    import numpy as np
+
+    version, flags, _, samples_per_pixel, length = _HEADER.unpack_from(data)
+    if version != 1 or not flags & _FLAG_8_BIT:
+        raise ValueError("not an 8-bit audiowaveform file")
+    return samples_per_pixel, np.frombuffer(data, dtype=np.int8, offset=_HEADER.size, count=2 * length)
+
+
+def save(levels: dict, directory: str) -> None:
+    for samples_per_pixel, pairs in levels.items():
+        path = os.path.join(directory, file_name(samples_per_pixel))
+        with open(f"{path}.partial", "wb") as f:
+            f.write(encode(samples_per_pixel, pairs))
+        os.replace(f"{path}.partial", path)
+
+
+class PeaksTap:
+    """Peaks of the audio an ffmpeg run decodes, from an extra output it writes into a pipe.
+
+    Add output() to the run's outputs and pass pass_fds to it, call start()
+    before and finish() after it.
+    """
+
+    def __init__(self, levels: tuple = LEVELS):
+        self._builder = PeaksBuilder(levels)
+        self._read, self._write = os.pipe()
+        self._thread = threading.Thread(target=self._consume, name="peaks-tap", daemon=True)
+        self._error: Optional[BaseException] = None
+
+    @property
+    def pass_fds(self) -> tuple:
+        return (self._write,)
+
+    def output(self) -> tuple[list[str], str]:
+        """(arguments, path) of the output for mp3.convert_outputs()."""
+        return ["-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le"], f"pipe:{self._write}"
+
+    def _consume(self) -> None:
+        with open(self._read, "rb", buffering=0) as pipe:
+            while chunk := pipe.read(256 * 1024):
+                if self._error is not None:
+                    # Keep draining, a full pipe would stall the encode
+                    continue
+                try:
+                    self._builder.feed(chunk)
+                except Exception as e:
+                    self._error = e
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        # Once ffmpeg's copy is gone too, the reader sees the end of the data
+        if self._write is not None:
+            os.close(self._write)
+            self._write = None
+
+    def finish(self) -> dict:
+        """The peaks at every level; call once ffmpeg has exited."""
+        self.close()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        with metrics.stage("peaks"):
+            levels = self._builder.finish()
+        logger.debug("Computed peaks at %s samples per pixel", ", ".join(map(str, levels)))
+        return levels
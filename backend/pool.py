@@ -0,0 +1,184 @@
+import asyncio
+import contextvars
+import os
+import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+
+from backend import log, metrics
+
+logger = log.getLogger(__name__)
+
+_DONE = object()
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return default
+    return max(0, int(value))
+
+
+class ConversionPool:
+    """Bounded worker pool for the blocking parts of a conversion.
+
+    At most `workers` jobs run at once and at most `queue_depth` more wait for
+    a free worker. Anything beyond that is rejected with 503 + Retry-After
+    instead of piling up on the event loop.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, retry_after_s: int = 5):
+        self.workers = max(1, workers)
+        self.queue_depth = queue_depth
+        self.retry_after_s = retry_after_s
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="convert")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._pending >= self.workers + self.queue_depth:
+                logger.warning(f"Conversion queue full ({self._pending} pending), rejecting request")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is busy, please retry later",
+                    headers={"Retry-After": str(self.retry_after_s)},
+                )
+            self._pending += 1
+        metrics.IN_FLIGHT.inc()
+
+    def release(self, _future=None) -> None:
+        with self._lock:
+            self._pending -= 1
+        metrics.IN_FLIGHT.dec()
+
+    def execute(self, fn, *args, **kwargs) -> Future:
+        """Queue `fn` on a worker, or raise 503 right away if the pool is full."""
+        self.acquire()
+        try:
+            # Carry the request's context along, so stage timings reach its Server-Timing header
+            future = self._executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+        # Release the slot when the work is really done, not when the awaiting
+        # request goes away, so a disconnected client can't over-commit the pool.
+        future.add_done_callback(self.release)
+        return future
+
+    def submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        return asyncio.wrap_future(self.execute(fn, *args, **kwargs))
+
+    async def execute_when_idle(self, fn, *args, poll_s: float = 0.25, **kwargs) -> Future:
+        """Like execute(), but wait until a worker is idle instead of queueing or failing.
+
+        For bulk work, so it doesn't use up the queue slots meant for
+        interactive requests.
+        """
+        while True:
+            if self._pending < self.workers:
+                try:
+                    return self.execute(fn, *args, **kwargs)
+                except HTTPException as e:
+                    if e.status_code != 503:
+                        raise
+            await asyncio.sleep(poll_s)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    async def stream(self, fn, *args, buffer: int = 8, **kwargs) -> AsyncIterator:
+        """Drive the generator `fn(*args, **kwargs)` on a worker and iterate it asynchronously.
+
+        The worker keeps its slot until the generator is exhausted or the
+        consumer stops iterating, and runs at most `buffer` items ahead of the
+        consumer. The first item is produced before this returns, so errors
+        raised while setting up surface here rather than mid-response.
+        """
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        space = threading.Semaphore(buffer)
+        stop = threading.Event()
+
+        def deliver(item) -> None:
+            try:
+                loop.call_soon_threadsafe(items.put_nowait, item)
+            except RuntimeError:
+                # The loop is gone, nobody is listening any more
+                stop.set()
+
+        def pump() -> None:
+            gen = fn(*args, **kwargs)
+            try:
+                for item in gen:
+                    while not space.acquire(timeout=0.5):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        return
+                    deliver(item)
+                deliver(_DONE)
+            except BaseException as e:
+                deliver(e)
+            finally:
+                gen.close()
+
+        self.acquire()
+        try:
+            future = self._executor.submit(contextvars.copy_context().run, pump)
+        except BaseException:
+            self.release()
+            raise
+        future.add_done_callback(self.release)
+
+        first = await items.get()
+        if isinstance(first, BaseException):
+            raise first
+
+        async def iterate():
+            item = first
+            try:
+                while item is not _DONE:
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+                    space.release()
+                    item = await items.get()
+            finally:
+                stop.set()
+
+        chunks = iterate()
+        # Also stop the worker if the iterator is dropped without ever being started
+        weakref.finalize(chunks, stop.set)
+        return chunks
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_pool: Optional[ConversionPool] = None
+
+
+def configure() -> ConversionPool:
+    global _pool
+    workers = _env_int("CONVERT_WORKERS", 0) or os.cpu_count() or 1
+    _pool = ConversionPool(
+        workers=workers,
+        queue_depth=_env_int("CONVERT_QUEUE_DEPTH", workers * 2),
+        retry_after_s=_env_int("CONVERT_RETRY_AFTER", 5),
+    )
+    logger.debug("Conversion pool: %s workers, queue depth %s", _pool.workers, _pool.queue_depth)
+    return _pool
+
+
+def get_pool() -> ConversionPool:
+    if _pool is None:
+        return configure()
+    return _pool
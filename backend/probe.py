@@ -0,0 +1,170 @@
+import hashlib
+import math
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend import log, loudness, mp3
+
+logger = log.getLogger(__name__)
+
+# Files that get uploaded by mistake; rejected before the rest of them is read
+_NOT_AUDIO = (
+    (b"\xff\xd8\xff", "a JPEG image"),
+    (b"\x89PNG\r\n\x1a\n", "a PNG image"),
+    (b"GIF8", "a GIF image"),
+    (b"%PDF", "a PDF document"),
+    (b"PK\x03\x04", "a ZIP archive"),
+    (b"\x7fELF", "a program"),
+    (b"<!DOCTYPE", "an HTML page"),
+    (b"<html", "an HTML page"),
+)
+_AUDIO = (
+    (b"fLaC", "flac"),
+    (b"OggS", "ogg"),
+    (b"ID3", "mp3"),
+    (b"\x1a\x45\xdf\xa3", "matroska"),
+    (b"caff", "caf"),
+    (b"#!AMR", "amr"),
+    (b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", "asf"),
+    (b".snd", "au"),
+    (b"MAC ", "ape"),
+    (b"wvpk", "wavpack"),
+    (b"\x0b\x77", "ac3"),
+)
+
+_max_bytes = 0
+_max_duration_s = 6 * 3600
+_min_speed = 2.0
+_timeout_s = 10
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def _format(head: bytes) -> Optional[str]:
+    if head[:4] in (b"RIFF", b"RF64") and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    for magic, name in _AUDIO:
+        if head.startswith(magic):
+            return name
+    # MPEG audio or ADTS AAC frame sync
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return "mpeg"
+    return None
+
+
+def _wav_header(head: bytes) -> dict:
+    info = {}
+    position = 12
+    while position + 8 <= len(head):
+        chunk, size = head[position:position + 4], int.from_bytes(head[position + 4:position + 8], "little")
+        if chunk == b"fmt " and position + 24 <= len(head):
+            fmt = head[position + 8:position + 24]
+            info["channels"] = int.from_bytes(fmt[2:4], "little")
+            info["sample_rate"] = int.from_bytes(fmt[4:8], "little")
+            info["byte_rate"] = int.from_bytes(fmt[8:12], "little")
+        elif chunk == b"data":
+            # Streaming writers leave the size at 0 or all ones
+            if info.get("byte_rate") and 0 < size < 0xFFFFFFFF:
+                info["duration"] = size / info["byte_rate"]
+            break
+        position += 8 + size + (size & 1)
+    info.pop("byte_rate", None)
+    return info
+
+
+def _flac_header(head: bytes) -> dict:
+    # STREAMINFO is always the first metadata block
+    if len(head) < 26 or head[4] & 0x7F != 0:
+        return {}
+    bits = int.from_bytes(head[18:26], "big")
+    sample_rate = bits >> 44
+    total = bits & ((1 << 36) - 1)
+    info = {"sample_rate": sample_rate, "channels": ((bits >> 41) & 7) + 1}
+    if sample_rate and total:
+        info["duration"] = total / sample_rate
+    return info
+
+
+def sniff(head: bytes, filename: str = "") -> dict:
+    """What the first bytes of an upload say about it: {"format"} and, for WAV and FLAC, their header fields.
+
+    Raises 415 for files that are clearly not audio, and 422 when the header
+    already shows the input is longer than INPUT_MAX_DURATION. Anything
+    unrecognized is left for ffmpeg to judge.
+    """
+    for magic, name in _NOT_AUDIO:
+        if head[:len(magic)].lower() == magic.lower():
+            raise HTTPException(status_code=415, detail=f"{filename or 'The upload'} is {name}, not audio")
+    info = {"format": _format(head)}
+    if info["format"] == "wav":
+        info.update(_wav_header(head))
+    elif info["format"] == "flac":
+        info.update(_flac_header(head))
+    check(info)
+    logger.debug("Sniffed %r: %s", filename, info)
+    return info
+
+
+def max_bytes() -> int:
+    return _max_bytes
+
+
+def check_size(size: Optional[int]) -> None:
+    """413 for an upload announced larger than INPUT_MAX_BYTES."""
+    if _max_bytes and size and size > _max_bytes:
+        raise HTTPException(status_code=413, detail=f"Audio files are limited to {_max_bytes} bytes")
+
+
+def check(info: dict) -> None:
+    if info.get("sample_rate") == 0 or info.get("channels") == 0:
+        raise HTTPException(status_code=415, detail="The audio header is damaged")
+    duration = info.get("duration")
+    if _max_duration_s and duration and duration > _max_duration_s:
+        raise HTTPException(
+            status_code=422, detail=f"Audio is {duration / 60:.0f} minutes long; at most {_max_duration_s / 60:.0f} minutes are accepted"
+        )
+
+
+def probe_file(audio_in: str, input_sha256: str = "") -> dict:
+    """Duration, codec, sample rate and channels of a received input, from ffmpeg reading only its headers.
+
+    Raises 415 when there is no audio in it and 422 when it is too long.
+    Cached by content hash, so the same recording is only probed once.
+    """
+    key = hashlib.sha256(f"{input_sha256}:probe".encode()).hexdigest() if input_sha256 else None
+    info = loudness.get_cache().get(key) if key else None
+    if info is None:
+        info = mp3.probe(audio_in, _timeout_s) or {}
+        if key:
+            loudness.get_cache().put(key, info)
+    else:
+        logger.debug("Probe cache hit for %s", input_sha256)
+    if not info:
+        raise HTTPException(status_code=415, detail="No audio found in the upload")
+    check(info)
+    return info
+
+
+def timeout_for(info: Optional[dict]) -> int:
+    """FFmpeg timeout for one pass over the input: a minute plus its duration at CONVERT_MIN_SPEED."""
+    duration = (info or {}).get("duration")
+    if not duration:
+        return 60
+    return 60 + math.ceil(duration / _min_speed)
+
+
+def configure() -> None:
+    global _max_bytes, _max_duration_s, _min_speed, _timeout_s
+    _max_bytes = _env_int("INPUT_MAX_BYTES", 0)
+    _max_duration_s = _env_int("INPUT_MAX_DURATION", 6 * 3600)
+    _min_speed = float(os.environ.get("CONVERT_MIN_SPEED", "").strip() or 2) or 2.0
+    _timeout_s = _env_int("PROBE_TIMEOUT", 10) or 10
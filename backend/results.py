@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+from backend import log
+
+logger = log.getLogger(__name__)
+
+_RESULT = "result"
+_META = "meta.json"
+# Without retention a result is removed once sent; the sweep only catches what a crash left behind
+_ORPHAN_AGE_S = 3600
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+class ResultStore:
+    """Finished /api/convert outputs on disk, kept for `retention_s` after they are written.
+
+    A download that breaks off can be resumed from /api/results/<id> with a
+    Range request instead of converting again. With a retention of 0 a
+    result only lives until its response has been sent.
+    """
+
+    def __init__(self, root: str, retention_s: int):
+        self.root = root
+        self.retention_s = retention_s
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, result_id: str) -> str:
+        return os.path.join(self.root, result_id)
+
+    def create(self) -> tuple[str, str]:
+        """A new result id and the path to write its file to; commit() it once complete."""
+        result_id = uuid.uuid4().hex
+        os.makedirs(self._dir(result_id))
+        return result_id, os.path.join(self._dir(result_id), f"{_RESULT}.partial")
+
+    def commit(self, result_id: str, media_type: str, headers: dict) -> str:
+        """Make a written result available; returns the path of its file."""
+        directory = self._dir(result_id)
+        path = os.path.join(directory, _RESULT)
+        os.replace(f"{path}.partial", path)
+        # Written last: a result without it is incomplete and only ever swept
+        with open(os.path.join(directory, f"{_META}.partial"), "w") as f:
+            json.dump({"media_type": media_type, "headers": headers}, f)
+        os.replace(os.path.join(directory, f"{_META}.partial"), os.path.join(directory, _META))
+        return path
+
+    def get(self, result_id: str) -> Optional[dict]:
+        """{"path", "media_type", "headers"} of a stored result, None once it expired."""
+        if not result_id.isalnum():
+            return None
+        directory = self._dir(result_id)
+        try:
+            with open(os.path.join(directory, _META)) as f:
+                meta = json.load(f)
+            age = time.time() - os.stat(os.path.join(directory, _META)).st_mtime
+        except (FileNotFoundError, ValueError):
+            return None
+        if age > self.retention_s:
+            return None
+        return dict(meta, path=os.path.join(directory, _RESULT))
+
+    def discard(self, result_id: str) -> None:
+        shutil.rmtree(self._dir(result_id), ignore_errors=True)
+
+    def sweep(self) -> int:
+        """Remove results older than the retention; returns how many were removed.
+
+        A download still reading one keeps its open file; only the name goes away.
+        """
+        removed = 0
+        now = time.time()
+        keep_s = self.retention_s or _ORPHAN_AGE_S
+        with self._lock:
+            try:
+                entries = list(os.scandir(self.root))
+            except FileNotFoundError:
+                return 0
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    age = now - entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+                if age <= keep_s:
+                    continue
+                self.discard(entry.name)
+                removed += 1
+                logger.debug("Evicted result %s after %.0fs", entry.name, age)
+        return removed
+
+
+class _Sweeper(threading.Thread):
+    def __init__(self, store: ResultStore, interval_s: float):
+        super().__init__(name="results-sweeper", daemon=True)
+        self.store = store
+        self.interval_s = interval_s
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        while not self._done.wait(self.interval_s):
+            try:
+                removed = self.store.sweep()
+                if removed:
+                    logger.info(f"Evicted {removed} expired results")
+            except Exception:
+                logger.exception("Sweeping results failed")
+
+    def stop(self) -> None:
+        self._done.set()
+
+
+_store: Optional[ResultStore] = None
+_sweeper: Optional[_Sweeper] = None
+
+
+def configure() -> ResultStore:
+    global _store, _sweeper
+    root = os.environ.get("RESULTS_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "audio-producer-results")
+    _store = ResultStore(root, _env_int("RESULTS_RETENTION", 3600))
+    # Whatever expired while the server was down
+    _store.sweep()
+    if _sweeper is not None:
+        _sweeper.stop()
+    _sweeper = _Sweeper(_store, min(300, _store.retention_s or 300))
+    _sweeper.start()
+    return _store
+
+
+def get_store() -> ResultStore:
+    if _store is None:
+        return configure()
+    return _store
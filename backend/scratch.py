@@ -0,0 +1,248 @@
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend import log, metrics
+
+logger = log.getLogger(__name__)
+
+# Work directories are named after the process that owns them, so a sweep can
+# tell a live request's directory from one a crashed worker left behind
+_DIR_RE = re.compile(r"^job-(\d+)-[0-9a-f]{32}$")
+SUBDIR = "audio-producer-scratch"
+
+FAST = "fast"
+DISK = "disk"
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's process
+        return True
+    return True
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class ScratchSpace:
+    """Work directories for conversions, with a byte budget shared by all requests.
+
+    A directory is sized up front from what the request declares (its
+    Content-Length), counting the input and an output of up to the same size.
+    Ones that fit under `spill_bytes` and the `fast_max_bytes` left on the
+    fast root (tmpfs) go there, everything else to `disk_root`. Once
+    `max_bytes` are handed out, new requests wait for space, and get 503
+    after `wait_s`, before reading their body.
+    """
+
+    def __init__(
+        self,
+        fast_root: str,
+        disk_root: str,
+        *,
+        spill_bytes: int,
+        fast_max_bytes: int,
+        max_bytes: int,
+        wait_s: float = 30,
+        orphan_age_s: float = 24 * 3600,
+        poll_s: float = 0.25,
+    ):
+        self.roots = {FAST: os.path.join(fast_root, SUBDIR), DISK: os.path.join(disk_root, SUBDIR)}
+        for root in set(self.roots.values()):
+            os.makedirs(root, exist_ok=True)
+        self.spill_bytes = spill_bytes
+        self.fast_max_bytes = fast_max_bytes
+        self.max_bytes = max_bytes
+        self.wait_s = wait_s
+        self.orphan_age_s = orphan_age_s
+        self.poll_s = poll_s
+        self._lock = threading.Lock()
+        # path -> (root kind, reserved bytes)
+        self._active: dict[str, tuple[str, int]] = {}
+        self._reserved = {FAST: 0, DISK: 0}
+
+    @property
+    def reserved(self) -> int:
+        return sum(self._reserved.values())
+
+    def reserved_on(self, kind: str) -> int:
+        return self._reserved[kind]
+
+    def _create(self, kind: str, reserve: int) -> str:
+        # Called with the lock held
+        path = os.path.join(self.roots[kind], f"job-{os.getpid()}-{uuid.uuid4().hex}")
+        os.mkdir(path)
+        self._active[path] = (kind, reserve)
+        self._reserved[kind] += reserve
+        metrics.SCRATCH_RESERVED.inc(reserve, root=kind)
+        return path
+
+    def try_acquire(self, expected_bytes: Optional[int]) -> Optional[str]:
+        """A new work directory, or None if the budget is used up right now."""
+        # Unknown sizes (chunked uploads) are assumed large
+        size = expected_bytes if expected_bytes is not None else self.spill_bytes + 1
+        reserve = 2 * size
+        if self.max_bytes and reserve > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload larger than the scratch space ({self.max_bytes} bytes)")
+        with self._lock:
+            if self.max_bytes and self.reserved + reserve > self.max_bytes:
+                return None
+            fits_fast = size <= self.spill_bytes and self._reserved[FAST] + reserve <= self.fast_max_bytes
+            return self._create(FAST if fits_fast else DISK, reserve)
+
+    async def acquire(self, expected_bytes: Optional[int]) -> str:
+        """Like try_acquire(), but wait for space instead, up to `wait_s`, then raise 503."""
+        deadline = time.monotonic() + self.wait_s
+        while True:
+            path = self.try_acquire(expected_bytes)
+            if path is not None:
+                logger.debug("Created scratch directory %s for %s bytes", path, expected_bytes)
+                return path
+            if time.monotonic() >= deadline:
+                logger.warning(f"Scratch space budget used up ({self.reserved} bytes reserved), rejecting request")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is out of scratch space, please retry later",
+                    headers={"Retry-After": str(max(1, int(self.wait_s)))},
+                )
+            await asyncio.sleep(self.poll_s)
+
+    def release(self, path: str) -> None:
+        """Remove a work directory and give its bytes back to the budget."""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            entry = self._active.pop(path, None)
+            if entry is not None:
+                kind, reserve = entry
+                self._reserved[kind] -= reserve
+                metrics.SCRATCH_RESERVED.dec(reserve, root=kind)
+        logger.debug("Cleaned up scratch directory: %s", path)
+
+    def sweep(self) -> int:
+        """Remove work directories left behind by processes that are gone; returns the bytes freed.
+
+        Directories of this process that are no longer in use, and any older
+        than `orphan_age_s` (the pid may have been reused), count as left behind too.
+        """
+        freed = 0
+        now = time.time()
+        for root in set(self.roots.values()):
+            try:
+                entries = list(os.scandir(root))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                match = _DIR_RE.match(entry.name)
+                if not match or not entry.is_dir(follow_symlinks=False):
+                    continue
+                pid = int(match.group(1))
+                with self._lock:
+                    active = entry.path in self._active
+                try:
+                    age = now - entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+                if pid == os.getpid():
+                    orphaned = not active and age > 60
+                else:
+                    orphaned = not _pid_alive(pid)
+                if not (orphaned or age > self.orphan_age_s):
+                    continue
+                size = _dir_size(entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                if active:
+                    self.release(entry.path)
+                freed += size
+                logger.info(f"Removed orphaned scratch directory {entry.path} ({size} bytes)")
+        return freed
+
+
+class _Sweeper(threading.Thread):
+    def __init__(self, space: ScratchSpace, interval_s: float):
+        super().__init__(name="scratch-sweeper", daemon=True)
+        self.space = space
+        self.interval_s = interval_s
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        while not self._done.wait(self.interval_s):
+            try:
+                self.space.sweep()
+            except Exception:
+                logger.exception("Sweeping scratch space failed")
+
+    def stop(self) -> None:
+        self._done.set()
+
+
+def _default_fast_root() -> str:
+    # RAM-backed where there is one; a container's /dev/shm is small, see fast_max_bytes
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+_space: Optional[ScratchSpace] = None
+_sweeper: Optional[_Sweeper] = None
+
+
+def configure(share: int = 1) -> ScratchSpace:
+    """`share` processes of one server each get that part of the budgets."""
+    global _space, _sweeper
+    fast_root = os.environ.get("SCRATCH_DIR", "").strip() or _default_fast_root()
+    disk_root = os.environ.get("SCRATCH_SPILL_DIR", "").strip() or tempfile.gettempdir()
+    for root in (fast_root, disk_root):
+        os.makedirs(root, exist_ok=True)
+    _space = ScratchSpace(
+        fast_root,
+        disk_root,
+        spill_bytes=_env_int("SCRATCH_SPILL_BYTES", 32 * 1024 * 1024),
+        fast_max_bytes=_env_int("SCRATCH_FAST_MAX_BYTES", shutil.disk_usage(fast_root).total // 2) // share,
+        max_bytes=_env_int("SCRATCH_MAX_BYTES", int(shutil.disk_usage(disk_root).free * 0.8)) // share,
+        wait_s=_env_int("SCRATCH_WAIT", 30),
+        orphan_age_s=_env_int("SCRATCH_ORPHAN_AGE", 24 * 3600),
+    )
+    freed = _space.sweep()
+    if freed:
+        logger.info(f"Freed {freed} bytes of orphaned scratch space")
+    if _sweeper is not None:
+        _sweeper.stop()
+    _sweeper = _Sweeper(_space, _env_int("SCRATCH_SWEEP_INTERVAL", 300) or 300)
+    _sweeper.start()
+    logger.debug(
+        "Scratch space: %s up to %s bytes, spilling to %s, budget %s bytes",
+        _space.roots[FAST], _space.fast_max_bytes, _space.roots[DISK], _space.max_bytes,
+    )
+    return _space
+
+
+def get_space() -> ScratchSpace:
+    if _space is None:
+        return configure()
+    return _space
@@ -0,0 +1,298 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Optional
+
+from backend import log, metrics, mp3
+
+# Only long inputs need numpy, see peaks
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = log.getLogger(__name__)
+
+# Sample rates libmp3lame encodes; below 32 kHz a frame holds 576 samples instead of 1152
+SAMPLE_RATES = (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)
+# LAME's encoder delay, written into the LAME tag so players can trim it
+ENCODER_DELAY = 576
+# Frames encoded before and after each segment and thrown away, so the
+# encoder's state at the cut matches what it would be without one
+OVERLAP_FRAMES = 8
+
+_BITRATES = {
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# Segments are encoded by ffmpeg processes; these threads only wait for them
+_executor: Optional[ThreadPoolExecutor] = None
+_min_duration_s = 0
+_segment_s = 300
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def frame_samples(sample_rate: int) -> int:
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def frame_offsets(data) -> list[int]:
+    """Start of every MPEG audio layer III frame in `data`, which must begin with a frame.
+
+    Raises ValueError where there is no frame, including free-format frames,
+    whose length the header doesn't give.
+    """
+    offsets = []
+    position = 0
+    while position + 4 <= len(data):
+        b1, b2 = data[position + 1], data[position + 2]
+        version, bitrate_index, rate_index = (b1 >> 3) & 3, b2 >> 4, (b2 >> 2) & 3
+        if (
+            data[position] != 0xFF or b1 & 0xE0 != 0xE0 or (b1 >> 1) & 3 != 1
+            # Reserved version, free format, invalid bitrate, reserved sample rate
+            or version == 1 or bitrate_index in (0, 15) or rate_index == 3
+        ):
+            raise ValueError(f"no MP3 frame at byte {position}")
+        bitrate = _BITRATES[version == 3][bitrate_index] * 1000
+        sample_rate = _RATES[version][rate_index]
+        offsets.append(position)
+        position += (144 if version == 3 else 72) * bitrate // sample_rate + ((b2 >> 1) & 1)
+    return offsets
+
+
+def plan(pcm: "np.ndarray", sample_rate: int, segment_s: float, search_s: float = 5.0) -> list[int]:
+    """Sample positions to cut `pcm` (samples × channels, int16) at, roughly every `segment_s`.
+
+    Each cut is on a frame boundary, at the quietest frame within `search_s`
+    of its target, so joins land in pauses where there are any. Depends only
+    on the audio and the arguments, never on how many workers encode it.
+    """
+    import numpy as np
+
+    step = frame_samples(sample_rate)
+    total = len(pcm)
+    segment = max(1, int(segment_s * sample_rate) // step) * step
+    search = int(search_s * sample_rate) // step
+    cuts = []
+    for target in range(segment, total - segment // 2, segment):
+        first = max(target // step - search, (cuts[-1] if cuts else 0) // step + 1)
+        last = min(target // step + search, total // step - 1)
+        if last < first:
+            continue
+        window = pcm[first * step:(last + 1) * step].astype(np.int64)
+        energy = (window.reshape(last + 1 - first, -1) ** 2).sum(axis=1)
+        # The quietest frame, the one closest to the target among equals
+        distance = np.abs(np.arange(first, last + 1) - target // step)
+        cuts.append(int(first + np.lexsort((distance, energy))[0]) * step)
+    return cuts
+
+
+def _pcm_rate(probed: dict, encoder: list[str]) -> tuple[int, int]:
+    def option(name):
+        return int(encoder[encoder.index(name) + 1]) if name in encoder else None
+
+    rate = option("-ar") or min(SAMPLE_RATES, key=lambda r: (abs(r - probed["sample_rate"]), r))
+    channels = option("-ac") or min(probed["channels"], 2)
+    return rate, channels
+
+
+def enabled() -> bool:
+    return _executor is not None and _min_duration_s > 0
+
+
+def applies(probed: Optional[dict], encoder: list[str]) -> bool:
+    """Whether an input this long is worth splitting, with an encoder that can be split."""
+    return (
+        enabled()
+        and probed is not None
+        and (probed["duration"] or 0) >= _min_duration_s
+        and "libmp3lame" in encoder
+    )
+
+
+def _encode_segment(pcm_path: str, rate: int, channels: int, start: int, end: int, encoder: list[str], out: str, timeout_s) -> None:
+    width = 2 * channels
+    # The subfile protocol hands ffmpeg exactly these bytes of the decoded audio
+    source = f"subfile,,start,{start * width},end,{end * width},,:{pcm_path}"
+    args = [
+        "ffmpeg", "-y", "-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", source,
+        *encoder,
+        # Every frame decodes on its own, so segments can be cut at any frame
+        "-reservoir", "0",
+        "-fflags", "+bitexact", "-flags:a", "+bitexact",
+        "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", out,
+    ]
+    mp3._run_ffmpeg(args, timeout_s)
+
+
+def _crc16(data: bytes) -> int:
+    # CRC-16/ARC, as the LAME tag uses
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def _set_gapless(mp3_path: str, padding: int) -> None:
+    """Put the encoder delay and padding of the joined stream into the LAME tag ffmpeg wrote."""
+    with open(mp3_path, "r+b") as f:
+        head = bytearray(f.read(1024))
+        tag = max(head.find(b"Xing"), head.find(b"Info"))
+        if tag < 0:
+            logger.warning(f"No Xing header in {mp3_path}, players won't trim the encoder delay")
+            return
+        lame = tag + 120
+        head[lame + 21:lame + 24] = ((ENCODER_DELAY << 12) | min(padding, 0xFFF)).to_bytes(3, "big")
+        # The tag's own CRC covers the first 190 bytes of the frame
+        head[lame + 34:lame + 36] = _crc16(bytes(head[:190])).to_bytes(2, "big")
+        f.seek(0)
+        f.write(head[:lame + 36])
+
+
+def encode(
+    audio_in: str,
+    mp3_out: str,
+    workdir: str,
+    probed: dict,
+    encoder: list[str],
+    filters: Optional[str] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+    timeout_s: Optional[int] = 60,
+    extra_outputs: list = (),
+    pass_fds: tuple = (),
+    segment_s: Optional[float] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
+) -> list[int]:
+    """Encode `audio_in` to an untagged MP3 in segments on several cores; returns the cuts made.
+
+    No cuts are returned if the segments couldn't be joined and the audio
+    was encoded in one piece instead.
+
+    The input is decoded and filtered once into 16-bit PCM (`extra_outputs`
+    come out of that run too). The PCM is cut into segments, and each is
+    encoded by its own ffmpeg, with OVERLAP_FRAMES of audio on either side
+    so the encoder's state at the cut matches a continuous encode. The
+    overlap frames are dropped and the rest joined in order. Then ffmpeg
+    adds a Xing/LAME header, patched to the joined stream's encoder delay and
+    padding so playback is gapless.
+
+    The result depends only on the input and the cuts, not on how many
+    segments were encoded at once.
+    """
+    import numpy as np
+
+    rate, channels = _pcm_rate(probed, encoder)
+    step = frame_samples(rate)
+    pcm_path = os.path.join(workdir, "decoded.pcm")
+    report = on_progress or (lambda percent: None)
+
+    outputs = [(["-ac", str(channels), "-ar", str(rate), "-f", "s16le"], pcm_path), *extra_outputs]
+    decode_progress = (lambda percent: report(percent * 0.1)) if on_progress else None
+    mp3.convert_outputs(audio_in, outputs, on_progress=decode_progress, timeout_s=timeout_s, filters=filters, pass_fds=pass_fds)
+    try:
+        pcm = np.memmap(pcm_path, dtype="<i2", mode="r").reshape(-1, channels)
+    except ValueError:
+        pcm = np.zeros((0, channels), dtype="<i2")
+    total = len(pcm)
+    segment_s = segment_s or _segment_s
+    cuts = plan(pcm, rate, segment_s, search_s=min(5.0, segment_s / 4))
+    del pcm
+    bounds = [0, *cuts, total]
+    logger.info(f"Encoding {total / rate:.0f}s of audio in {len(bounds) - 1} segments")
+
+    paths = [os.path.join(workdir, f"segment-{n:04d}.mp3") for n in range(len(bounds) - 1)]
+    # Frames of audio before the cut each segment starts with; a whole number, so its frames line up with the join
+    preroll = [min(OVERLAP_FRAMES, bound // step) for bound in bounds[:-1]]
+    done = [0]
+    lock = threading.Lock()
+
+    def run(n: int) -> None:
+        start = bounds[n] - preroll[n] * step
+        end = min(bounds[n + 1] + OVERLAP_FRAMES * step, total)
+        _encode_segment(pcm_path, rate, channels, start, end, encoder, paths[n], timeout_s)
+        with lock:
+            done[0] += bounds[n + 1] - bounds[n]
+            report(10 + 85 * done[0] / max(total, 1))
+
+    pool = executor or _executor or ThreadPoolExecutor(1)
+    with metrics.stage("encode"):
+        futures = [pool.submit(run, n) for n in range(len(paths))]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            if pool is not executor and pool is not _executor:
+                pool.shutdown()
+
+    joined = os.path.join(workdir, "joined.mp3")
+    try:
+        with metrics.stage("join"):
+            frames = _join(paths, bounds, preroll, step, joined)
+            mp3._run_ffmpeg(
+                ["ffmpeg", "-y", "-f", "mp3", "-i", joined, "-c:a", "copy", "-fflags", "+bitexact", "-id3v2_version", "0", mp3_out],
+                timeout_s,
+            )
+            os.remove(joined)
+            _set_gapless(mp3_out, frames * step - ENCODER_DELAY - total)
+    except ValueError as e:
+        # Our own encodes shouldn't produce this, but the audio can still be encoded in one piece
+        logger.warning(f"Can't join the segments ({e}), encoding the audio in one piece instead")
+        for path in paths + [joined]:
+            if os.path.exists(path):
+                os.remove(path)
+        with metrics.stage("encode"):
+            _encode_whole(pcm_path, rate, channels, encoder, mp3_out, timeout_s)
+        cuts = []
+    os.remove(pcm_path)
+    report(99)
+    return cuts
+
+
+def _join(paths: list[str], bounds: list[int], preroll: list[int], step: int, joined: str) -> int:
+    """Write the frames of each segment between its overlaps to `joined`; returns how many there are."""
+    frames = 0
+    with open(joined, "wb") as out:
+        for n, path in enumerate(paths):
+            with open(path, "rb") as f:
+                data = f.read()
+            offsets = frame_offsets(data) + [len(data)]
+            first = preroll[n]
+            count = (bounds[n + 1] - bounds[n]) // step if n < len(paths) - 1 else len(offsets) - 1 - first
+            if first + count > len(offsets) - 1:
+                raise ValueError(f"segment {n} has {len(offsets) - 1} frames, {first + count} needed")
+            out.write(data[offsets[first]:offsets[first + count]])
+            frames += count
+    for path in paths:
+        os.remove(path)
+    return frames
+
+
+def _encode_whole(pcm_path: str, rate: int, channels: int, encoder: list[str], out: str, timeout_s) -> None:
+    # ffmpeg writes the Xing/LAME header with the delay and padding itself
+    args = [
+        "ffmpeg", "-y", "-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", pcm_path,
+        *encoder, "-id3v2_version", "0", out,
+    ]
+    mp3._run_ffmpeg(args, timeout_s)
+
+
+def configure() -> Optional[ThreadPoolExecutor]:
+    """Read SEGMENT_* from the environment; segmented encoding is off on a single core."""
+    global _executor, _min_duration_s, _segment_s
+    workers = _env_int("SEGMENT_WORKERS", os.cpu_count() or 1) or 1
+    _min_duration_s = _env_int("SEGMENT_MIN_DURATION", 600)
+    _segment_s = _env_int("SEGMENT_SECONDS", 300) or 300
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(workers, thread_name_prefix="segment") if workers > 1 and _min_duration_s else None
+    if _executor is not None:
+        logger.debug("Segmented encoding above %ss in %ss segments, %s at once", _min_duration_s, _segment_s, workers)
+    return _executor
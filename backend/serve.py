@@ -0,0 +1,160 @@
+"""
+Production server: loads the app once, then forks the workers that serve it.
+
+From the repository root (ffmpeg must be on PATH):
+
+    python -m backend.serve
+
+Settings and shared assets are loaded, and the modules other parts import
+lazily are imported, before SERVER_WORKERS processes (default 1) are forked.
+They share all of that copy-on-write and accept connections on one socket.
+With more than one worker and JOB_WORKERS=inline, jobs run in one more
+forked process (see backend.worker) rather than in every worker; that needs
+the default sqlite JOB_STORE, so JOB_STORE=memory is refused with more than one.
+
+Resumable upload sessions and admission control live in the memory of one
+worker, so with several workers an upload's chunks can reach one that
+doesn't know it, and every worker grants each client its own quota. Each
+process gets its part of the scratch space and result cache budgets, and
+finds the results the others cached in the shared CACHE_DIR.
+
+SIGTERM or Ctrl-C makes the workers fail their readiness probe, stop
+accepting connections and finish the requests and conversions they have,
+for up to SERVER_DRAIN_TIMEOUT seconds. Workers that die are replaced.
+"""
+
+import gc
+import importlib
+import os
+import signal
+import time
+from typing import Callable
+
+import uvicorn
+
+from backend import log, main as api, metrics, worker
+
+logger = log.getLogger(__name__)
+
+# Imported only where they are needed; a worker would otherwise import them on its first job
+PRELOAD = ("numpy", "mutagen.flac", "mutagen.mp4", "mutagen.oggopus")
+
+API = "api"
+JOBS = "jobs"
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+class _Server(uvicorn.Server):
+    def handle_exit(self, sig, frame) -> None:
+        api.drain()
+        super().handle_exit(sig, frame)
+
+
+def _fork(run: Callable[[], None]) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    # The child: the supervisor's signal handlers don't apply here
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        run()
+    except BaseException:
+        logger.exception(f"Worker {os.getpid()} failed")
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def main() -> None:
+    # Conversions already use every core through ffmpeg; see the module docstring before raising this
+    workers = _env_int("SERVER_WORKERS", 1) or 1
+    if workers > 1 and os.environ.get("JOB_STORE", "sqlite") == "memory":
+        # Each worker would queue to a store only it can see, and the job worker couldn't open it
+        logger.error("JOB_STORE=memory keeps jobs in one process; use SERVER_WORKERS=1 or the sqlite store")
+        raise SystemExit(1)
+
+    roles = [API] * workers
+    if workers > 1 and os.environ.get("JOB_WORKERS", "inline") != "external":
+        # Each worker would run the job queue otherwise
+        os.environ["JOB_WORKERS"] = "external"
+        roles.append(JOBS)
+
+    api.configure(processes=len(roles))
+    for name in PRELOAD:
+        importlib.import_module(name)
+
+    drain_s = _env_int("SERVER_DRAIN_TIMEOUT", 60)
+    config = uvicorn.Config(
+        api.app,
+        host=os.environ.get("HOST", "").strip() or "0.0.0.0",
+        port=_env_int("PORT", 8000),
+        log_config=None,
+        timeout_graceful_shutdown=drain_s,
+    )
+    sock = config.bind_socket()
+    if workers > 1:
+        logger.warning(
+            f"{workers} workers don't share upload sessions or admission quotas; "
+            "resumable uploads need sticky routing, and each client gets its quota once per worker. "
+            f"The scratch and cache budgets are split between the {len(roles)} processes"
+        )
+
+    age = metrics.process_age()
+    usage = metrics.memory()
+    logger.info(
+        f"Preloaded in {age or 0:.2f}s ({usage.get('rss', 0) / 2**20:.0f} MiB), "
+        f"starting {workers} workers on {config.host}:{config.port}" + (" and a job worker" if JOBS in roles else "")
+    )
+    # What was loaded so far is never freed; keep the collector from touching, and so copying, its pages
+    gc.freeze()
+
+    def run(role: str) -> None:
+        if role == JOBS:
+            worker.main()
+        else:
+            _Server(config).run(sockets=[sock])
+
+    children = {_fork(lambda role=role: run(role)): role for role in roles}
+    stopping = []
+
+    def stop(signum, frame) -> None:
+        if not stopping:
+            logger.info(f"Stopping, draining workers for up to {drain_s}s")
+            stopping.append(time.monotonic() + drain_s + 5)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            if stopping and time.monotonic() > stopping[0]:
+                logger.warning(f"Workers {sorted(children)} didn't drain in time, killing them")
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+                stopping[0] = float("inf")
+            time.sleep(0.2)
+            continue
+        role = children.pop(pid, None)
+        if role is None or stopping:
+            continue
+        logger.warning(f"{role} worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting another")
+        time.sleep(1)
+        children[_fork(lambda role=role: run(role))] = role
+    sock.close()
+    logger.info("Stopped")
+
+
+if __name__ == "__main__":
+    main()
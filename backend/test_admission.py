@@ -0,0 +1,171 @@
+"""
+Tests for per-client admission control of conversions.
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+from backend import admission
+from backend.admission import AdmissionController
+
+
+def _controller(**options):
+    options.setdefault("max_wait_s", 5)
+    return AdmissionController(options.pop("slots", 1), options.pop("queue_depth", 10), **options)
+
+
+class TestFairQueuing:
+    """Test who gets a free slot"""
+
+    def test_light_client_overtakes_a_heavy_backlog(self):
+        """Test that a client with one short file doesn't wait behind another's dozen long ones"""
+        controller = _controller()
+        order = []
+
+        async def convert(client, seconds):
+            ticket = await controller.admit(client)
+            order.append(client)
+            ticket.charge(seconds)
+            await asyncio.sleep(0.01)
+            ticket.release()
+
+        async def scenario():
+            heavy = [asyncio.ensure_future(convert("heavy", 3600)) for _ in range(4)]
+            await asyncio.sleep(0.005)
+            light = asyncio.ensure_future(convert("light", 60))
+            await asyncio.gather(*heavy, light)
+
+        asyncio.run(scenario())
+
+        # The heavy client's first file was already running; the light one is next
+        assert order[:2] == ["heavy", "light"]
+        assert controller.stats() == {"slots": 1, "running": 0, "waiting": 0, "clients": []}
+
+    def test_weights_share_slots_unevenly(self):
+        """Test that a client with twice the weight gets about twice the audio converted"""
+        controller = _controller(queue_depth=20, weights={"10.0.0.1": 2.0})
+        order = []
+
+        async def convert(client):
+            ticket = await controller.admit(client)
+            order.append(client)
+            ticket.charge(60)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        async def scenario():
+            blocker = await controller.admit("other")
+            tasks = [asyncio.ensure_future(convert(client)) for client in ("10.0.0.1", "10.0.0.2") * 6]
+            await asyncio.sleep(0.01)
+            blocker.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(scenario())
+
+        assert order[:6].count("10.0.0.1") == 4
+
+
+class TestLimits:
+    """Test refusing requests before they are read"""
+
+    def test_per_client_concurrency(self):
+        controller = _controller(slots=4, client_concurrency=1, client_queue_depth=1, retry_after_s=7)
+
+        async def scenario():
+            running = await controller.admit("a")
+            waiting = asyncio.ensure_future(controller.admit("a"))
+            await asyncio.sleep(0.01)
+            with pytest.raises(HTTPException) as rejected:
+                await controller.admit("a")
+            # Other clients still get the free slots
+            other = await controller.admit("b")
+            assert not waiting.done()
+            running.release()
+            (await waiting).release()
+            other.release()
+            return rejected.value
+
+        rejected = asyncio.run(scenario())
+        assert rejected.status_code == 429
+        assert rejected.headers["Retry-After"] == "7"
+
+    def test_quota_of_audio_minutes(self):
+        controller = _controller(minutes_per_hour=10)
+
+        async def scenario():
+            ticket = await controller.admit("a")
+            ticket.charge(8 * 60)
+            with pytest.raises(HTTPException) as too_long:
+                # Only two minutes left
+                ticket.charge(5 * 60)
+            ticket.release()
+            ticket = await controller.admit("a")
+            ticket.charge(2 * 60)
+            ticket.release()
+            with pytest.raises(HTTPException) as used_up:
+                await controller.admit("a")
+            return too_long.value, used_up.value
+
+        too_long, used_up = asyncio.run(scenario())
+        assert too_long.status_code == 429
+        assert 3590 <= int(too_long.headers["Retry-After"]) <= 3600
+        assert used_up.status_code == 429
+        assert controller.stats()["clients"][0]["minutes_last_hour"] == 10
+        with pytest.raises(HTTPException) as never:
+            controller.charge("b", 11 * 60)
+        assert never.value.headers is None
+
+    def test_full_queue_and_long_wait_are_503(self):
+        controller = _controller(queue_depth=1, max_wait_s=0.05)
+
+        async def scenario():
+            running = await controller.admit("a")
+            waiting = asyncio.ensure_future(controller.admit("b"))
+            await asyncio.sleep(0.01)
+            with pytest.raises(HTTPException) as full:
+                await controller.admit("c")
+            with pytest.raises(HTTPException) as timed_out:
+                await waiting
+            running.release()
+            return full.value, timed_out.value
+
+        full, timed_out = asyncio.run(scenario())
+        assert full.status_code == 503
+        assert timed_out.status_code == 503
+        assert controller.stats()["waiting"] == 0
+
+
+def test_clients_by_api_key_or_address(monkeypatch):
+    monkeypatch.setenv("CLIENT_WEIGHTS", "secret=3, 10.0.0.1=0.5")
+    controller = admission.configure()
+    key = admission._identity("secret")
+
+    assert key.startswith("key:") and "secret" not in key
+    assert controller.weights == {key: 3.0, "10.0.0.1": 0.5}
+    assert controller.api_keys == {key}
+    monkeypatch.setenv("CLIENT_WEIGHTS", "nobody")
+    with pytest.raises(ValueError):
+        admission.configure()
+    monkeypatch.delenv("CLIENT_WEIGHTS")
+    admission.configure()
+
+
+def test_only_configured_api_keys_identify_a_client(monkeypatch):
+    monkeypatch.setenv("CLIENT_API_KEYS", "team-a, team-b")
+    admission.configure()
+
+    def client(key):
+        headers = [(b"x-api-key", key.encode())] if key else []
+        return admission.client_of(Request({"type": "http", "headers": headers, "client": ("10.0.0.9", 4711)}))
+
+    try:
+        assert client("team-b") == admission._identity("team-b")
+        # A made-up key, even one that looks like someone's address, counts against the sender's address
+        assert client("made-up") == "10.0.0.9"
+        assert client("10.0.0.1") == "10.0.0.9"
+        assert client("") == "10.0.0.9"
+    finally:
+        monkeypatch.delenv("CLIENT_API_KEYS")
+        admission.configure()
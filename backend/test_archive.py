@@ -0,0 +1,37 @@
+"""
+Tests for the streaming ZIP writer.
+"""
+
+import io
+import zipfile
+
+from backend.archive import ZipStream
+
+
+class TestZipStream:
+    """Test that archives built piece by piece are valid"""
+
+    def test_entries_are_stored_and_readable(self):
+        archive = ZipStream()
+        out = archive.start("a.mp3", 6)
+        # Data becomes available before the entry is finished
+        out += archive.write(b"abc")
+        assert out
+        out += archive.write(b"def") + archive.finish()
+        out += archive.add("b.txt", b"hello")
+        out += archive.close()
+
+        with zipfile.ZipFile(io.BytesIO(out)) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist() == ["a.mp3", "b.txt"]
+            assert all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist())
+            assert zf.read("a.mp3") == b"abcdef"
+            assert zf.read("b.txt") == b"hello"
+
+    def test_duplicate_names_are_numbered(self):
+        archive = ZipStream()
+        out = b"".join(archive.add(name, b"x") for name in ("ep.mp3", "ep.mp3", "ep.mp3", "notes"))
+        out += archive.add("notes", b"y") + archive.close()
+
+        with zipfile.ZipFile(io.BytesIO(out)) as zf:
+            assert zf.namelist() == ["ep.mp3", "ep (2).mp3", "ep (3).mp3", "notes", "notes (2)"]
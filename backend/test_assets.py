@@ -0,0 +1,94 @@
+"""
+Tests for the tag profile registry.
+"""
+
+import io
+import json
+import os
+import shutil
+
+import pytest
+from fastapi import HTTPException
+from mutagen.id3 import ID3
+from PIL import Image
+
+from backend import assets, cover
+
+COVER_PATH = os.path.join(os.path.dirname(__file__), "..", "media", "default_cover.jpg")
+
+DEFAULTS = dict(album="Env Album", album_artist="Env Artist", genre="Podcast", title_suffix=" - Show")
+
+
+@pytest.fixture
+def media(tmp_path):
+    shutil.copy(COVER_PATH, tmp_path / "cover.jpg")
+    return tmp_path
+
+
+def _registry(media):
+    covers = cover.CoverCache(str(media / "covers"), max_px=1400, max_bytes=500 * 1024)
+    return assets.AssetRegistry(DEFAULTS, str(media / "cover.jpg"), str(media / "profiles.json"), covers)
+
+
+class TestAssetRegistry:
+    """Test loading, selecting and reloading profiles"""
+
+    def test_default_profile_from_environment(self, media):
+        profile = _registry(media).get()
+
+        assert profile.name == "default"
+        assert profile.title("Ep 1") == "Ep 1 - Show"
+        id3 = ID3(io.BytesIO(profile.id3_header("Ep 1 - Show", "Jane")))
+        assert str(id3.get("TIT2")) == "Ep 1 - Show"
+        assert str(id3.get("TPE1")) == "Jane"
+        assert str(id3.get("TALB")) == "Env Album"
+        assert id3.get("APIC:Cover").data == (media / "cover.jpg").read_bytes()
+
+    def test_named_profiles_inherit_defaults(self, media):
+        Image.new("RGBA", (20, 10), (255, 0, 0, 128)).save(media / "talks.png")
+        (media / "profiles.json").write_text(json.dumps({"talks": {"album": "Talks", "cover": "talks.png"}}))
+        registry = _registry(media)
+
+        talks = registry.get("talks")
+        assert registry.names() == ["default", "talks"]
+        assert talks.album == "Talks"
+        assert talks.genre == "Podcast"
+        # Embedded as the normalized JPEG, not the PNG on disk
+        assert talks.cover_mime == "image/jpeg"
+        assert talks.cover_data[:3] == b"\xff\xd8\xff"
+        assert talks.tags("T", "S")["cover_path"].startswith(str(media / "covers"))
+
+    def test_unknown_profile(self, media):
+        with pytest.raises(HTTPException) as exc_info:
+            _registry(media).get("nope")
+        assert exc_info.value.status_code == 422
+
+    def test_missing_cover(self, tmp_path):
+        with pytest.raises(HTTPException) as exc_info:
+            _registry(tmp_path).get()
+        assert exc_info.value.status_code == 500
+
+    def test_reloads_when_files_change(self, media):
+        registry = _registry(media)
+        first = registry.get()
+        assert registry.get() is first
+
+        (media / "profiles.json").write_text(json.dumps({"talks": {"album": "Talks"}}))
+        assert registry.get("talks").album == "Talks"
+
+        Image.new("RGB", (30, 30), "blue").save(media / "cover.jpg")
+        assert registry.get().cover_data == (media / "cover.jpg").read_bytes()
+
+    def test_broken_profiles_file_keeps_last_good_profiles(self, media):
+        (media / "profiles.json").write_text(json.dumps({"talks": {"album": "Talks"}}))
+        registry = _registry(media)
+        assert registry.get("talks").album == "Talks"
+
+        (media / "profiles.json").write_text("{not json")
+        assert registry.get("talks").album == "Talks"
+
+    def test_evicted_cover_is_restored_for_ffmpeg(self, media):
+        profile = _registry(media).get()
+        os.remove(profile.cover_path)
+
+        assert open(profile.tags("T", "S")["cover_path"], "rb").read() == profile.cover_data
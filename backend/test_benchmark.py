@@ -0,0 +1,54 @@
+"""
+Tests for the helpers of the load benchmark.
+"""
+
+import pytest
+
+from backend import benchmark
+
+
+class TestLoadBenchmarkHelpers:
+    """Test duration parsing, percentiles and the /metrics stage breakdown"""
+
+    @pytest.mark.parametrize("text,seconds", [("90", 90), ("90s", 90), ("10m", 600), ("3h", 10800), ("1.5m", 90)])
+    def test_parse_duration(self, text, seconds):
+        """Test that durations accept s/m/h suffixes"""
+        assert benchmark.parse_duration(text) == seconds
+
+    def test_percentile_is_nearest_rank(self):
+        """Test that percentiles pick an observed value"""
+        values = list(range(1, 101))
+        assert benchmark.percentile(values, 50) == 50
+        assert benchmark.percentile(values, 99) == 99
+        assert benchmark.percentile([3.0], 95) == 3.0
+        assert benchmark.percentile([], 50) is None
+
+    def test_stage_breakdown_subtracts_the_earlier_scrape(self):
+        """Test that only observations made during the run are reported"""
+        before = benchmark.parse_stage_metrics(
+            'audio_producer_stage_seconds_bucket{stage="encode",le="1"} 2\n'
+            'audio_producer_stage_seconds_bucket{stage="encode",le="+Inf"} 2\n'
+            'audio_producer_stage_seconds_sum{stage="encode"} 1.0\n'
+            'audio_producer_stage_seconds_count{stage="encode"} 2\n'
+        )
+        after = benchmark.parse_stage_metrics(
+            "# TYPE audio_producer_stage_seconds histogram\n"
+            'audio_producer_stage_seconds_bucket{stage="encode",le="1"} 3\n'
+            'audio_producer_stage_seconds_bucket{stage="encode",le="+Inf"} 6\n'
+            'audio_producer_stage_seconds_sum{stage="encode"} 9.0\n'
+            'audio_producer_stage_seconds_count{stage="encode"} 6\n'
+        )
+
+        stages = benchmark.stage_breakdown(before, after)
+        assert stages == {"encode": {"count": 4, "mean_s": 2.0, "p50_le_s": float("inf"), "p95_le_s": float("inf")}}
+
+    def test_compare_reports_relative_change(self):
+        """Test that matching scenarios are compared by format, length and concurrency"""
+        scenario = {"format": "wav", "input_seconds": 60, "concurrency": 2, "p50_s": 2.0, "throughput_rps": 1.0}
+        before = {"commit": "a", "scenarios": [scenario]}
+        after = {"commit": "b", "scenarios": [{**scenario, "p50_s": 1.5, "throughput_rps": 1.5}, {**scenario, "format": "flac"}]}
+
+        changes = benchmark.compare(before, after)
+        assert len(changes) == 1
+        assert changes[0]["p50_s"] == pytest.approx(-0.25)
+        assert changes[0]["throughput_rps"] == pytest.approx(0.5)
@@ -0,0 +1,73 @@
+"""
+Tests for the content-addressed result cache.
+"""
+
+import os
+
+from backend import cache as cache_module
+from backend.cache import ResultCache, cache_key
+
+
+def _frames(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"\xff" * size)
+    return str(path)
+
+
+class TestResultCache:
+    """Test storing, hitting and evicting encoded results"""
+
+    def test_key_depends_on_input_and_settings(self):
+        assert cache_key("abc", "-q:a 2") == cache_key("abc", "-q:a 2")
+        assert cache_key("abc", "-q:a 2") != cache_key("abd", "-q:a 2")
+        assert cache_key("abc", "-q:a 2") != cache_key("abc", "-q:a 4")
+
+    def test_put_then_hit(self, tmp_path):
+        cache = ResultCache(str(tmp_path / "cache"), max_bytes=1000)
+        frames = _frames(tmp_path, "a.mp3", 100)
+
+        assert cache.open("k1") is None
+        cache.put("k1", frames)
+        with cache.open("k1") as f:
+            assert f.read() == b"\xff" * 100
+
+        assert not os.path.exists(frames)
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = ResultCache(str(tmp_path / "cache"), max_bytes=250)
+        cache.put("old", _frames(tmp_path, "a.mp3", 100))
+        cache.put("used", _frames(tmp_path, "b.mp3", 100))
+        cache.open("old").close()  # now "used" is the least recently used
+        cache.put("new", _frames(tmp_path, "c.mp3", 100))
+
+        assert cache.open("used") is None
+        assert cache.open("old") is not None
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["bytes"] == 200
+
+    def test_entries_survive_a_restart(self, tmp_path):
+        root = str(tmp_path / "cache")
+        ResultCache(root, max_bytes=1000).put("k1", _frames(tmp_path, "a.mp3", 100))
+
+        reloaded = ResultCache(root, max_bytes=1000)
+        assert reloaded.stats()["entries"] == 1
+        assert reloaded.open("k1") is not None
+
+    def test_hits_what_another_process_put(self, tmp_path):
+        root = str(tmp_path / "cache")
+        mine, theirs = ResultCache(root, max_bytes=1000), ResultCache(root, max_bytes=1000)
+        theirs.put("k1", _frames(tmp_path, "a.mp3", 100))
+
+        with mine.open("k1") as f:
+            assert f.read() == b"\xff" * 100
+        assert mine.stats()["entries"] == 1
+        assert mine.stats()["bytes"] == 100
+
+    def test_processes_split_the_budget(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("CACHE_DIR", str(tmp_path / "cache"))
+        monkeypatch.setenv("CACHE_MAX_BYTES", "1000")
+        # Restored afterwards
+        monkeypatch.setattr(cache_module, "_cache", cache_module.get_cache())
+        assert cache_module.configure(share=4).max_bytes == 250
@@ -0,0 +1,105 @@
+"""
+Tests for cover validation, normalization and caching.
+"""
+
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from backend import cover
+
+
+def _encode(image, fmt, **kwargs):
+    out = io.BytesIO()
+    image.save(out, fmt, **kwargs)
+    return out.getvalue()
+
+
+class TestSniffFormat:
+    """Test that covers are recognized by content, not by name"""
+
+    def test_known_formats(self):
+        image = Image.new("RGB", (4, 4))
+        for fmt in ("JPEG", "PNG", "GIF", "WEBP"):
+            assert cover.sniff_format(_encode(image, fmt)) == fmt
+
+    def test_other_content(self):
+        assert cover.sniff_format(b"<svg xmlns='http://www.w3.org/2000/svg'/>") is None
+        assert cover.sniff_format(b"") is None
+
+
+class TestNormalize:
+    """Test downscaling and re-encoding"""
+
+    def test_large_png_becomes_progressive_jpeg(self):
+        png = _encode(Image.frombytes("RGB", (3000, 2000), os.urandom(3000 * 2000 * 3)), "PNG")
+
+        out = cover.normalize(png, max_px=1400, max_bytes=300 * 1024)
+
+        image = Image.open(io.BytesIO(out))
+        assert image.format == "JPEG"
+        assert image.size == (1400, 933)
+        assert image.info.get("progressive")
+        assert len(out) <= 300 * 1024
+
+    def test_transparency_is_flattened_on_white(self):
+        png = _encode(Image.new("RGBA", (10, 10), (0, 0, 0, 0)), "PNG")
+
+        image = Image.open(io.BytesIO(cover.normalize(png, max_px=1400, max_bytes=100 * 1024)))
+        assert image.mode == "RGB"
+        assert all(channel > 250 for channel in image.getpixel((5, 5)))
+
+    def test_small_jpeg_is_kept_as_is(self):
+        jpeg = _encode(Image.new("RGB", (300, 300), "red"), "JPEG")
+
+        assert cover.normalize(jpeg, max_px=1400, max_bytes=100 * 1024) is jpeg
+
+    def test_byte_budget_wins_over_resolution(self):
+        noise = _encode(Image.frombytes("RGB", (1000, 1000), os.urandom(1000 * 1000 * 3)), "PNG")
+
+        out = cover.normalize(noise, max_px=1000, max_bytes=20 * 1024)
+
+        assert len(out) <= 20 * 1024
+        assert max(Image.open(io.BytesIO(out)).size) < 1000
+
+    @pytest.mark.parametrize("data", [b"plain text", b"\x89PNG\r\n\x1a\ntruncated"])
+    def test_rejects_non_images(self, data):
+        with pytest.raises(ValueError):
+            cover.normalize(data, max_px=1400, max_bytes=100 * 1024)
+
+
+class TestCoverCache:
+    """Test that each cover is processed once"""
+
+    def test_same_content_is_processed_once(self, tmp_path):
+        covers = cover.CoverCache(str(tmp_path), max_px=100, max_bytes=50 * 1024)
+        png = _encode(Image.new("RGB", (400, 400), "green"), "PNG")
+
+        first = covers.path(png)
+        second = covers.path(png)
+
+        assert first == second
+        assert covers.processed == 1
+        assert Image.open(first).size == (100, 100)
+
+    def test_limits_are_part_of_the_key(self, tmp_path):
+        png = _encode(Image.new("RGB", (400, 400), "green"), "PNG")
+
+        small = cover.CoverCache(str(tmp_path), max_px=100, max_bytes=50 * 1024).path(png)
+        large = cover.CoverCache(str(tmp_path), max_px=200, max_bytes=50 * 1024).path(png)
+
+        assert small != large
+
+    def test_oldest_entries_are_evicted(self, tmp_path):
+        covers = cover.CoverCache(str(tmp_path), max_px=100, max_bytes=50 * 1024, max_entries=2)
+        paths = [covers.path(_encode(Image.new("RGB", (8, 8), color), "PNG")) for color in ("red", "green")]
+        os.utime(paths[0], (1000, 1000))
+        os.utime(paths[1], (2000, 2000))
+
+        covers.path(_encode(Image.new("RGB", (8, 8), "white"), "PNG"))
+
+        assert len(os.listdir(tmp_path)) == 2
+        assert not os.path.exists(paths[0])
+        assert os.path.exists(paths[1])
@@ -0,0 +1,100 @@
+"""
+Tests for byte range and conditional handling of downloads.
+"""
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.download import FileDownload, parse_range
+
+
+class TestParseRange:
+    """Test single byte range parsing"""
+
+    @pytest.mark.parametrize("header,expected", [
+        (None, None),
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+    ])
+    def test_ranges(self, header, expected):
+        assert parse_range(header, 1000) == expected
+
+    @pytest.mark.parametrize("header", ["bytes=1000-", "bytes=50-10", "bytes=-0"])
+    def test_unsatisfiable(self, header):
+        with pytest.raises(ValueError):
+            parse_range(header, 1000)
+
+
+class TestFileDownload:
+    """Test conditional and ranged responses for a file on disk"""
+
+    @pytest.fixture
+    def client(self, tmp_path):
+        path = tmp_path / "episode.mp3"
+        path.write_bytes(bytes(range(256)) * 4)
+        app = FastAPI()
+
+        @app.get("/file")
+        async def serve():
+            return FileDownload(str(path), "audio/mpeg", {"Content-Disposition": "attachment"})
+
+        return TestClient(app)
+
+    def test_headers_set_afterwards_are_sent(self, tmp_path):
+        path = tmp_path / "episode.mp3"
+        path.write_bytes(b"frames")
+        app = FastAPI()
+
+        @app.get("/file")
+        async def serve():
+            response = FileDownload(str(path), "audio/mpeg")
+            response.headers["X-Extra"] = "1"
+            return response
+
+        response = TestClient(app).get("/file")
+
+        assert response.headers["x-extra"] == "1"
+        assert response.headers["content-type"] == "audio/mpeg"
+        assert response.headers["content-length"] == "6"
+
+    def test_whole_file(self, client):
+        response = client.get("/file")
+
+        assert response.status_code == 200
+        assert response.headers["content-length"] == "1024"
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["content-disposition"] == "attachment"
+        assert response.content == bytes(range(256)) * 4
+
+    def test_range(self, client):
+        response = client.get("/file", headers={"Range": "bytes=1000-"})
+
+        assert response.status_code == 206
+        assert response.headers["content-range"] == "bytes 1000-1023/1024"
+        assert response.content == bytes(range(232, 256))
+
+    def test_unsatisfiable_range(self, client):
+        response = client.get("/file", headers={"Range": "bytes=2000-"})
+
+        assert response.status_code == 416
+        assert response.headers["content-range"] == "bytes */1024"
+
+    def test_if_none_match(self, client):
+        tag = client.get("/file").headers["etag"]
+
+        assert client.get("/file", headers={"If-None-Match": tag}).status_code == 304
+        assert client.get("/file", headers={"If-None-Match": f"W/{tag}"}).status_code == 304
+        assert client.get("/file", headers={"If-None-Match": '"other"'}).status_code == 200
+
+    def test_if_range_of_another_version(self, client):
+        tag = client.get("/file").headers["etag"]
+
+        assert client.get("/file", headers={"Range": "bytes=0-9", "If-Range": tag}).status_code == 206
+        response = client.get("/file", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+        assert response.status_code == 200
+        assert len(response.content) == 1024
@@ -0,0 +1,106 @@
+"""
+Tests for encoder profiles and the stream-copy fast path.
+"""
+
+import json
+import subprocess
+
+import pytest
+from fastapi import HTTPException
+
+from backend import encoders, mp3
+
+
+def make_mp3(path, *args):
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1", *args, str(path)],
+        check=True,
+    )
+
+
+class TestEncoderProfile:
+    """Test the ffmpeg arguments of a profile"""
+
+    def test_default_matches_the_legacy_settings(self):
+        """Test that the default profile keeps existing cache keys valid"""
+        default = encoders.EncoderRegistry(encoders.BUILTIN_ENCODERS).get()
+        assert default.args() == mp3.ENCODER_ARGS
+        assert mp3.encoder_settings(encoder=default.args()) == mp3.encoder_settings()
+
+    def test_cbr_mono_arguments(self):
+        """Test that bitrate, channels and sample rate become encoder arguments"""
+        profile = encoders.EncoderProfile("speech", bitrate=48, channels=1, sample_rate=32000)
+        assert profile.args() == ["-c:a", "libmp3lame", "-b:a", "48k", "-ac", "1", "-ar", "32000"]
+
+    def test_needs_bitrate_or_quality(self):
+        """Test that a profile with neither or both is refused"""
+        with pytest.raises(ValueError):
+            encoders.EncoderProfile("broken")
+        with pytest.raises(ValueError):
+            encoders.EncoderProfile("broken", bitrate=64, quality=2)
+
+
+class TestRegistry:
+    """Test profile lookup and configuration"""
+
+    def test_unknown_encoder_is_a_422(self):
+        """Test that an unknown name is rejected"""
+        with pytest.raises(HTTPException) as e:
+            encoders.EncoderRegistry(encoders.BUILTIN_ENCODERS).get("nope")
+        assert e.value.status_code == 422
+
+    def test_profiles_file_and_default(self, monkeypatch, tmp_path):
+        """Test that the file adds profiles and ENCODER_PROFILE picks the default"""
+        path = tmp_path / "encoders.json"
+        path.write_text(json.dumps({"tiny": {"bitrate": 32, "channels": 1}}))
+        monkeypatch.setenv("ENCODER_PROFILES_FILE", str(path))
+        monkeypatch.setenv("ENCODER_PROFILE", "tiny")
+        try:
+            registry = encoders.configure()
+            assert registry.get().name == "tiny"
+            assert "speech-mono-64k" in registry.names()
+        finally:
+            monkeypatch.delenv("ENCODER_PROFILES_FILE")
+            monkeypatch.delenv("ENCODER_PROFILE")
+            encoders.configure()
+
+    def test_undefined_default_fails_at_startup(self):
+        """Test that a misconfigured default is caught when loading, not per request"""
+        with pytest.raises(ValueError):
+            encoders.EncoderRegistry(encoders.BUILTIN_ENCODERS, default="missing")
+
+
+class TestStreamCopy:
+    """Test when an MP3 input can skip the encoder"""
+
+    def test_matching_cbr_mp3_is_copied(self, tmp_path):
+        """Test that an MP3 already at the profile's bitrate and channels is copied"""
+        path = tmp_path / "speech.mp3"
+        make_mp3(path, "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k")
+        profile = encoders.EncoderRegistry(encoders.BUILTIN_ENCODERS).get("speech-mono-64k")
+
+        assert profile.encoder_args(str(path), None) == encoders.COPY_ARGS
+        # Filters change the audio, so it has to be encoded after all
+        assert profile.encoder_args(str(path), "aresample=44100") == profile.args()
+
+    @pytest.mark.parametrize(
+        "name,args",
+        [
+            ("archive-320", ["-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k"]),
+            ("speech-mono-64k", ["-ac", "2", "-c:a", "libmp3lame", "-b:a", "64k"]),
+            ("music-v2", ["-ac", "2", "-c:a", "libmp3lame", "-q:a", "2"]),
+            # No header to tell CBR from VBR by
+            ("speech-mono-64k", ["-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k", "-write_xing", "0"]),
+        ],
+    )
+    def test_mismatching_mp3_is_encoded(self, tmp_path, name, args):
+        """Test that other bitrates, channel counts and VBR profiles re-encode"""
+        path = tmp_path / "input.mp3"
+        make_mp3(path, *args)
+        assert not encoders.EncoderRegistry(encoders.BUILTIN_ENCODERS).get(name).can_copy(str(path))
+
+    def test_non_mp3_is_encoded(self, tmp_path):
+        """Test that a WAV input is never probed as MP3"""
+        path = tmp_path / "input.wav"
+        make_mp3(path)
+        assert encoders.probe_mp3(str(path)) is None
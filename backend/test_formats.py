@@ -0,0 +1,150 @@
+"""
+Tests for the AAC and Opus outputs and their container tags.
+"""
+
+import base64
+import os
+import shutil
+import subprocess
+
+import pytest
+from fastapi import HTTPException
+from mutagen.flac import Picture
+from mutagen.id3 import ID3
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
+
+from backend import encoders, formats, mp3
+
+COVER_PATH = os.path.join(os.path.dirname(__file__), "..", "media", "default_cover.jpg")
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+@pytest.fixture
+def tags():
+    return dict(
+        title="Episode 1 - Show",
+        album="My Podcast",
+        artist="Jane",
+        album_artist="Studio",
+        year="2026",
+        genre="Podcast",
+        cover_path=COVER_PATH,
+        cover_mime="image/jpeg",
+    )
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    path = str(tmp_path / "input")
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=1", "-f", "wav", path],
+        check=True,
+    )
+    return path
+
+
+def _encode_all(tmp_path, wav_path, filters=None, encoder=None):
+    encoder = encoder or encoders.EncoderProfile("default", quality=2)
+    output_formats = formats.parse("mp3,m4a,opus")
+    paths = {f.name: str(tmp_path / f"out.{f.extension}") for f in output_formats}
+    outputs = [(f.encoder_args(encoder, encoder.args()), paths[f.name]) for f in output_formats]
+    mp3.convert_outputs(wav_path, outputs, filters=filters)
+    return output_formats, paths
+
+
+class TestParse:
+    """Test reading the formats field"""
+
+    def test_default_is_mp3(self):
+        assert [f.name for f in formats.parse(None)] == ["mp3"]
+        assert [f.name for f in formats.parse(" ")] == ["mp3"]
+
+    def test_order_kept_and_duplicates_dropped(self):
+        assert [f.name for f in formats.parse("opus, M4A,opus")] == ["opus", "m4a"]
+
+    def test_unknown_format(self):
+        with pytest.raises(HTTPException) as error:
+            formats.parse("mp3,flac")
+        assert error.value.status_code == 422
+
+
+class TestEncoderArgs:
+    """Test how an encoder profile carries over to the other codecs"""
+
+    def test_speech_profile(self):
+        profile = encoders.EncoderProfile("speech", bitrate=64, channels=1, sample_rate=32000)
+        assert formats.FORMATS["m4a"].encoder_args(profile, profile.args())[:6] == [
+            "-c:a", "aac", "-b:a", "64k", "-ac", "1",
+        ]
+        # libopus picks its own sample rate
+        assert formats.FORMATS["opus"].encoder_args(profile, profile.args()) == ["-c:a", "libopus", "-b:a", "64k", "-ac", "1"]
+
+    def test_mp3_keeps_a_stream_copy(self):
+        profile = encoders.EncoderProfile("archive", bitrate=320)
+        assert formats.FORMATS["mp3"].encoder_args(profile, encoders.COPY_ARGS) == encoders.COPY_ARGS
+
+
+@requires_ffmpeg
+class TestConvertOutputs:
+    """Test encoding several formats from one decode"""
+
+    @pytest.mark.parametrize("filters", [None, "volume=0.5"])
+    def test_every_output_is_written(self, tmp_path, wav_path, filters):
+        output_formats, paths = _encode_all(tmp_path, wav_path, filters)
+
+        assert MP4(paths["m4a"]).info.length == pytest.approx(1.0, abs=0.1)
+        assert OggOpus(paths["opus"]).info.length == pytest.approx(1.0, abs=0.1)
+        # The MP3 is left untagged for write_id3_tags
+        with open(paths["mp3"], "rb") as f:
+            assert f.read(3) != b"ID3"
+
+    def test_tags_in_each_container(self, tmp_path, wav_path, tags):
+        output_formats, paths = _encode_all(tmp_path, wav_path)
+        for output_format in output_formats:
+            output_format.write_tags(paths[output_format.name], **tags)
+        with open(COVER_PATH, "rb") as f:
+            cover_data = f.read()
+
+        id3 = ID3(paths["mp3"])
+        assert str(id3["TIT2"]) == "Episode 1 - Show"
+        assert id3.getall("APIC")[0].data == cover_data
+
+        mp4 = MP4(paths["m4a"]).tags
+        assert mp4["\xa9nam"] == ["Episode 1 - Show"]
+        assert mp4["\xa9ART"] == ["Jane"]
+        assert mp4["aART"] == ["Studio"]
+        assert bytes(mp4["covr"][0]) == cover_data
+
+        opus = OggOpus(paths["opus"])
+        assert opus["title"] == ["Episode 1 - Show"]
+        assert opus["albumartist"] == ["Studio"]
+        picture = Picture(base64.b64decode(opus["metadata_block_picture"][0]))
+        assert picture.type == 3
+        assert picture.data == cover_data
+
+    def test_mp3_tag_is_put_in_front_of_the_frames(self, tmp_path, wav_path, tags):
+        output_formats, paths = _encode_all(tmp_path, wav_path)
+        with open(paths["mp3"], "rb") as f:
+            frames = f.read()
+
+        tagged = formats.FORMATS["mp3"].tagged(paths["mp3"], **tags)
+
+        assert not os.path.exists(paths["mp3"])
+        with open(tagged, "rb") as f:
+            data = f.read()
+        header_size = mp3.id3_tag_size(data[:10])
+        # The frames are copied as they are, behind a padded tag
+        assert data[header_size:] == frames
+        assert str(ID3(tagged)["TIT2"]) == "Episode 1 - Show"
+
+    def test_input_tags_are_not_copied(self, tmp_path):
+        tagged = str(tmp_path / "tagged.wav")
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=duration=1", "-metadata", "comment=secret", tagged],
+            check=True,
+        )
+        _, paths = _encode_all(tmp_path, tagged)
+
+        assert "comment" not in (OggOpus(paths["opus"]).tags or {})
@@ -0,0 +1,173 @@
+"""
+Tests for incremental upload parsing and the spool/pipe decision.
+"""
+
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from backend import ingest
+
+
+def _multipart_request(body: bytes, boundary: str, chunk_size: int = 7) -> Request:
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    async def receive():
+        chunk = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={boundary}".encode())],
+    }
+    return Request(scope, receive)
+
+
+class TestNeedsSeekableInput:
+    """Test which uploads have to be spooled before encoding"""
+
+    def test_mp4_family_needs_seeking(self):
+        assert ingest.needs_seekable_input(b"\x00\x00\x00\x20ftypM4A ", "episode.bin")
+        assert ingest.needs_seekable_input(b"RIFF\x00\x00\x00\x00WAVE", "clip.mov")
+
+    def test_streamable_formats_do_not(self):
+        assert not ingest.needs_seekable_input(b"RIFF\x24\x00\x00\x00WAVEfmt ", "take.wav")
+        assert not ingest.needs_seekable_input(b"fLaC\x00\x00\x00\x22\x10\x00\x10\x00", "take.flac")
+        assert not ingest.needs_seekable_input(b"ID3\x04\x00\x00\x00\x00\x00\x00\xff\xfb", "take.mp3")
+
+
+class TestIterMultipart:
+    """Test that the body is parsed as it arrives"""
+
+    def test_fields_and_file_chunks(self):
+        body = (
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="audioFile"; filename="a.wav"\r\n'
+            b"Content-Type: audio/wav\r\n\r\n"
+            + b"0123456789" * 5 +
+            b"\r\n--xyz\r\n"
+            b'Content-Disposition: form-data; name="topic"\r\n\r\n'
+            b"Episode \xc3\xa9\r\n"
+            b"--xyz--\r\n"
+        )
+
+        async def collect():
+            return [event async for event in ingest.iter_multipart(_multipart_request(body, "xyz"))]
+
+        events = asyncio.run(collect())
+
+        assert events[0] == ("file", "audioFile", "a.wav")
+        data = [e[1] for e in events if e[0] == "data"]
+        assert len(data) > 1
+        assert b"".join(data) == b"0123456789" * 5
+        assert ("file_end", "audioFile") in events
+        assert events[-1] == ("field", "topic", "Episode é")
+
+
+class TestAudioSink:
+    """Test spooling and piping of the audio part"""
+
+    def _feed(self, sink, chunks):
+        async def scenario():
+            for chunk in chunks:
+                await sink.write(chunk)
+            await sink.close()
+            if sink.job is not None:
+                return await sink.job
+
+        return asyncio.run(scenario())
+
+    def test_pipes_streamable_input(self, tmp_path):
+        def start_pipe(chunks, info):
+            future = asyncio.get_running_loop().create_future()
+            loop = asyncio.get_running_loop()
+
+            def consume():
+                data = b"".join(chunks)
+                loop.call_soon_threadsafe(future.set_result, data)
+
+            threading.Thread(target=consume).start()
+            return future
+
+        sink = ingest.AudioSink(str(tmp_path / "input"), "take.wav", start_pipe, queue_size=2)
+        received = self._feed(sink, [b"RIFF", b"\x24\x00\x00\x00WAVE", b"x" * 1000, b"y" * 1000])
+
+        assert sink.piped
+        assert received == b"RIFF\x24\x00\x00\x00WAVE" + b"x" * 1000 + b"y" * 1000
+        assert not (tmp_path / "input").exists()
+
+    def test_spools_input_that_needs_seeking(self, tmp_path):
+        def start_pipe(chunks, info):
+            raise AssertionError("MP4 input must not be piped")
+
+        sink = ingest.AudioSink(str(tmp_path / "input"), "take.m4a", start_pipe)
+        self._feed(sink, [b"\x00\x00\x00\x20ftypM4A ", b"rest"])
+
+        assert not sink.piped
+        assert (tmp_path / "input").read_bytes() == b"\x00\x00\x00\x20ftypM4A rest"
+
+    def test_short_upload_is_still_written(self, tmp_path):
+        sink = ingest.AudioSink(str(tmp_path / "input"), "tiny.wav")
+        self._feed(sink, [b"abc"])
+
+        assert (tmp_path / "input").read_bytes() == b"abc"
+        assert sink.size == 3
+
+    def test_inspects_the_head_before_spooling(self, tmp_path):
+        seen = []
+
+        def inspect(head, filename):
+            seen.append((head, filename))
+            return {"format": "wav"}
+
+        sink = ingest.AudioSink(str(tmp_path / "input"), "take.wav", inspect=inspect)
+        self._feed(sink, [b"a" * 3000, b"b" * 3000])
+
+        assert seen == [(b"a" * 3000 + b"b" * 3000, "take.wav")]
+        assert sink.info == {"format": "wav"}
+        assert (tmp_path / "input").stat().st_size == 6000
+
+    def test_rejected_head_is_never_spooled(self, tmp_path):
+        def inspect(head, filename):
+            raise HTTPException(status_code=415, detail="not audio")
+
+        sink = ingest.AudioSink(str(tmp_path / "input"), "photo.wav", inspect=inspect)
+        with pytest.raises(HTTPException) as e:
+            self._feed(sink, [b"\xff\xd8\xff" + b"x" * 5000])
+
+        assert e.value.status_code == 415
+        assert not (tmp_path / "input").exists()
+
+    def test_size_limit(self, tmp_path):
+        sink = ingest.AudioSink(str(tmp_path / "input"), "long.wav", max_bytes=100)
+        with pytest.raises(HTTPException) as e:
+            self._feed(sink, [b"x" * 60, b"x" * 60])
+
+        assert e.value.status_code == 413
+
+    def test_stalled_pipe_is_aborted(self, tmp_path):
+        def start_pipe(chunks, info):
+            future = asyncio.get_running_loop().create_future()
+            loop = asyncio.get_running_loop()
+
+            def consume():
+                try:
+                    b"".join(chunks)
+                except ingest.PipeAborted as e:
+                    loop.call_soon_threadsafe(future.set_exception, e)
+
+            threading.Thread(target=consume).start()
+            return future
+
+        async def scenario():
+            sink = ingest.AudioSink(str(tmp_path / "input"), "take.wav", start_pipe, stall_s=0.05)
+            # Never closed
+            await sink.write(b"RIFF\x24\x00\x00\x00WAVE" + b"x" * 100)
+            await sink.job
+
+        with pytest.raises(ingest.PipeAborted):
+            asyncio.run(scenario())
@@ -0,0 +1,240 @@
+"""
+Tests for the job store, the in-process job runner and job workers.
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from backend import jobs
+
+
+def _wait_for(store, job_id, statuses=(jobs.DONE, jobs.FAILED), timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = store.get(job_id)
+        if job and job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} never reached {statuses}")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return jobs.MemoryJobStore()
+    return jobs.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+class TestJobStore:
+    """Test both persistence backends"""
+
+    def test_create_update_get(self, store):
+        store.create(dict(id="a", status=jobs.QUEUED, progress=0, title="T", speaker="S",
+                          filename="a.wav", error=None, created_at=1, updated_at=1))
+        store.update("a", status=jobs.RUNNING, progress=42.5)
+
+        job = store.get("a")
+        assert job["status"] == jobs.RUNNING
+        assert job["progress"] == 42.5
+        assert job["title"] == "T"
+        assert store.get("missing") is None
+
+    def test_unfinished_in_submission_order(self, store):
+        for job_id, status, created in (("b", jobs.RUNNING, 2), ("c", jobs.DONE, 3), ("a", jobs.QUEUED, 1)):
+            store.create(dict(id=job_id, status=status, progress=0, title="", speaker="",
+                              filename="", error=None, created_at=created, updated_at=created))
+
+        assert [j["id"] for j in store.unfinished()] == ["a", "b"]
+
+
+def test_sqlite_store_upgrades_old_databases(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0, "
+               "title TEXT NOT NULL, speaker TEXT NOT NULL, filename TEXT, error TEXT, "
+               "created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+    db.close()
+
+    store = jobs.SQLiteJobStore(path)
+    store.create(dict(id="a", status=jobs.QUEUED, progress=0, title="T", speaker="S", profile="talks",
+                      processing='{"loudnorm": "fast"}', input_sha256="abc",
+                      filename="a.wav", error=None, created_at=1, updated_at=1))
+    job = store.get("a")
+    assert job["profile"] == "talks"
+    assert job["processing"] == '{"loudnorm": "fast"}'
+    assert job["input_sha256"] == "abc"
+
+
+class TestJobRunner:
+    """Test running, failing and resuming jobs"""
+
+    def test_runs_job_and_reports_progress(self, store, tmp_path):
+        seen = []
+
+        def convert(job, job_dir, on_progress):
+            for percent in (10.2, 10.8, 55.0):
+                on_progress(percent)
+            seen.append(store.get(job["id"])["progress"])
+
+        runner = jobs.JobRunner(store, str(tmp_path), convert, concurrency=1)
+        runner.start()
+        job = runner.create(title="T", speaker="S", filename="a.wav")
+        runner.submit(job)
+
+        done = _wait_for(store, job["id"])
+        runner.stop()
+        assert done["status"] == jobs.DONE
+        assert done["progress"] == 100
+        assert seen == [55.0]
+
+    def test_failure_is_recorded(self, store, tmp_path):
+        def convert(job, job_dir, on_progress):
+            raise HTTPException(status_code=400, detail="FFmpeg failed: bad input")
+
+        runner = jobs.JobRunner(store, str(tmp_path), convert, concurrency=1)
+        runner.start()
+        job = runner.create(title="T", speaker="S", filename="a.wav")
+        runner.submit(job)
+
+        failed = _wait_for(store, job["id"])
+        runner.stop()
+        assert failed["status"] == jobs.FAILED
+        assert failed["error"] == "FFmpeg failed: bad input"
+
+    def test_unfinished_jobs_resume_after_restart(self, tmp_path):
+        path = str(tmp_path / "jobs.sqlite3")
+        blocked = threading.Event()
+
+        first = jobs.JobRunner(jobs.SQLiteJobStore(path), str(tmp_path), lambda *a: blocked.wait(), concurrency=1)
+        job = first.create(title="T", speaker="S", filename="a.wav")
+        # Never started: as if the process died with the job still queued
+        first.store.create(job)
+
+        second = jobs.JobRunner(jobs.SQLiteJobStore(path), str(tmp_path), lambda *a: None, concurrency=1)
+        second.start()
+        done = _wait_for(second.store, job["id"])
+        second.stop()
+        assert done["status"] == jobs.DONE
+
+
+def _queued(store, job_id, created):
+    store.create(dict(id=job_id, status=jobs.QUEUED, progress=0, title="", speaker="",
+                      filename="", error=None, created_at=created, updated_at=created))
+
+
+class TestLeases:
+    """Test handing jobs to workers"""
+
+    def test_claims_oldest_first_and_only_once(self, store):
+        _queued(store, "b", 2)
+        _queued(store, "a", 1)
+
+        first = store.claim("w1", 60, 3)
+        second = store.claim("w2", 60, 3)
+
+        assert (first["id"], first["worker"], first["attempts"]) == ("a", "w1", 1)
+        assert (second["id"], second["worker"]) == ("b", "w2")
+        assert store.claim("w3", 60, 3) is None
+
+    def test_expired_lease_is_claimed_again(self, store):
+        _queued(store, "a", 1)
+        store.claim("dead", 0, 3)
+        time.sleep(0.01)
+
+        job = store.claim("alive", 60, 3)
+
+        assert (job["id"], job["worker"], job["attempts"]) == ("a", "alive", 2)
+        assert not store.renew("a", "dead", 60)
+        assert not store.finish("a", "dead", status=jobs.DONE)
+        assert store.renew("a", "alive", 60)
+        assert store.finish("a", "alive", status=jobs.DONE, progress=100)
+        assert store.get("a")["status"] == jobs.DONE
+        assert store.get("a")["worker"] is None
+
+    def test_gives_up_after_max_attempts(self, store):
+        _queued(store, "a", 1)
+        store.claim("w1", 0, 2)
+        store.claim("w2", 0, 2)
+        time.sleep(0.01)
+
+        assert store.claim("w3", 60, 2) is None
+        job = store.get("a")
+        assert job["status"] == jobs.FAILED
+        assert "2 attempts" in job["error"]
+
+
+def test_workers_sharing_a_database_never_claim_the_same_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    setup = jobs.SQLiteJobStore(path)
+    for n in range(40):
+        _queued(setup, f"job{n:02d}", n)
+    claimed = []
+
+    def claim_all(name):
+        # Its own connection, as another process would have
+        store = jobs.SQLiteJobStore(path)
+        while (job := store.claim(name, 60, 3)) is not None:
+            claimed.append(job["id"])
+
+    threads = [threading.Thread(target=claim_all, args=(f"w{n}",)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == [f"job{n:02d}" for n in range(40)]
+
+
+class TestJobWorker:
+    """Test a worker process's side of the queue"""
+
+    def test_runs_jobs_queued_by_the_api(self, tmp_path):
+        path = str(tmp_path / "jobs.sqlite3")
+        api = jobs.JobRunner(jobs.SQLiteJobStore(path), str(tmp_path), None, concurrency=1, dispatch=False)
+        api.start()
+        job = api.create(title="T", speaker="S", filename="a.wav")
+        api.submit(job)
+        assert api.store.get(job["id"])["status"] == jobs.QUEUED
+
+        ran = []
+        worker = jobs.JobWorker(jobs.SQLiteJobStore(path), str(tmp_path), lambda j, d, p: ran.append(d), concurrency=2, poll_s=0.01)
+        worker.start()
+        done = _wait_for(api.store, job["id"])
+        worker.stop()
+
+        assert done["status"] == jobs.DONE
+        assert ran == [api.job_dir(job["id"])]
+
+    def test_takes_over_the_job_of_a_dead_worker(self, tmp_path):
+        store = jobs.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+        _queued(store, "a", 1)
+        store.claim("crashed", 0.05, 3)
+
+        worker = jobs.JobWorker(store, str(tmp_path), lambda *a: None, concurrency=1, poll_s=0.01)
+        worker.start()
+        done = _wait_for(store, "a")
+        worker.stop()
+
+        assert done["status"] == jobs.DONE
+        assert done["attempts"] == 2
+
+    def test_heartbeat_keeps_a_long_job(self, tmp_path):
+        store = jobs.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+        _queued(store, "a", 1)
+        release = threading.Event()
+
+        worker = jobs.JobWorker(store, str(tmp_path), lambda *a: release.wait(), concurrency=1, lease_s=0.15, poll_s=0.01)
+        worker.start()
+        # Several leases long; a second worker finds nothing to take over
+        time.sleep(0.5)
+        assert store.claim("other", 60, 3) is None
+        release.set()
+        done = _wait_for(store, "a")
+        worker.stop()
+
+        assert done["status"] == jobs.DONE
+        assert done["attempts"] == 1
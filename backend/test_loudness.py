@@ -0,0 +1,154 @@
+"""
+Tests for loudness normalization, silence trimming and the analysis cache.
+"""
+
+import math
+import struct
+import wave
+
+import pytest
+from fastapi import HTTPException
+
+from backend import loudness, mp3
+
+ANALYSIS_LOG = """
+Input #0, wav, from 'input':
+  Duration: 00:00:04.00, bitrate: 705 kb/s
+[silencedetect @ 0x1] silence_start: 0
+[silencedetect @ 0x1] silence_end: 1.000068 | silence_duration: 1.000068
+[silencedetect @ 0x1] silence_start: 3.000113
+[Parsed_loudnorm_1 @ 0x2]
+{
+	"input_i" : "-33.01",
+	"input_tp" : "-32.18",
+	"input_lra" : "3.30",
+	"input_thresh" : "-43.01",
+	"output_i" : "-16.52",
+	"output_tp" : "-15.69",
+	"output_lra" : "3.30",
+	"output_thresh" : "-26.51",
+	"normalization_type" : "dynamic",
+	"target_offset" : "-0.52"
+}
+"""
+
+
+def write_padded_wav(path, silence_s=1.0, tone_s=2.0, sample_rate=44100):
+    tone = b"".join(
+        struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))) for i in range(int(tone_s * sample_rate))
+    )
+    silence = b"\0\0" * int(silence_s * sample_rate)
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(silence + tone + silence)
+
+
+@pytest.fixture
+def analysis_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("ANALYSIS_CACHE_DIR", str(tmp_path / "analysis"))
+    return loudness.configure()
+
+
+class TestProcessing:
+    """Test how request options turn into filters"""
+
+    def test_defaults_do_nothing(self, monkeypatch):
+        """Test that without options there are no filters and the cache key is unchanged"""
+        monkeypatch.delenv("LOUDNORM", raising=False)
+        processing = loudness.from_form({})
+        assert processing.filters() is None
+        assert processing.settings() == ""
+        assert mp3.encoder_settings(processing=processing.settings()) == mp3.encoder_settings()
+
+    def test_environment_default_mode(self, monkeypatch):
+        """Test that LOUDNORM picks the mode when the request doesn't"""
+        monkeypatch.setenv("LOUDNORM", "fast")
+        assert loudness.from_form({}).loudnorm == "fast"
+        assert loudness.from_form({"loudnorm": "off"}).loudnorm == "off"
+
+    @pytest.mark.parametrize("form", [{"loudnorm": "loud"}, {"trimSilence": "maybe"}])
+    def test_invalid_options_are_rejected(self, form):
+        """Test that unknown values are a 422"""
+        with pytest.raises(HTTPException) as e:
+            loudness.from_form(form)
+        assert e.value.status_code == 422
+
+    def test_fast_mode_is_single_pass(self):
+        """Test that fast loudnorm needs no analysis and resamples back from 192 kHz"""
+        processing = loudness.Processing("fast")
+        assert not processing.needs_analysis
+        assert processing.filters() == "loudnorm=I=-16:TP=-1.5:LRA=11,aresample=44100"
+
+    def test_keeps_the_input_rate_where_mp3_has_it(self):
+        """Test that a 48 kHz input isn't resampled to 44.1 kHz on the way out"""
+        processing = loudness.Processing("fast")
+        assert processing.filters(sample_rate=48000).endswith(",aresample=48000")
+        assert processing.filters(sample_rate=96000).endswith(",aresample=44100")
+
+    def test_limiter_alone_is_oversampled(self):
+        """Test that the limiter works on an oversampled signal without loudnorm"""
+        chain = loudness.Processing(limiter=True).filters()
+        assert chain == "aresample=192000,alimiter=limit=0.8414:level=disabled,aresample=44100"
+
+    def test_accurate_mode_uses_the_measurement(self):
+        """Test that two-pass loudnorm and trimming use the analysis results"""
+        processing = loudness.Processing("accurate", trim_silence=True)
+        chain = processing.filters(loudness.parse_analysis(ANALYSIS_LOG))
+        assert chain.startswith("atrim=start=1.000:end=3.000,asetpts=PTS-STARTPTS,loudnorm=")
+        assert "measured_I=-33.01" in chain
+        assert "offset=-0.52:linear=true" in chain
+
+    def test_options_round_trip(self):
+        """Test that stored options select the same processing again"""
+        processing = loudness.Processing("accurate", trim_silence=True, limiter=True)
+        assert loudness.from_form(processing.options()).settings() == processing.settings()
+
+
+class TestParseAnalysis:
+    """Test reading silencedetect and loudnorm output"""
+
+    def test_speech_boundaries(self):
+        """Test that leading and trailing silence are found"""
+        analysis = loudness.parse_analysis(ANALYSIS_LOG)
+        assert analysis["speech_start"] == pytest.approx(1.0, abs=0.001)
+        assert analysis["speech_end"] == pytest.approx(3.0, abs=0.001)
+        assert analysis["loudness"]["input_i"] == "-33.01"
+
+    def test_silent_input_is_left_alone(self):
+        """Test that an all-silent input isn't trimmed to nothing or measured"""
+        output = (
+            "  Duration: 00:00:02.00, bitrate: 705 kb/s\n"
+            "silence_start: 0\nsilence_end: 2 | silence_duration: 2\n"
+            '{"input_i" : "-inf", "input_tp" : "-inf", "input_lra" : "0.00", '
+            '"input_thresh" : "-70.00", "target_offset" : "inf"}'
+        )
+        analysis = loudness.parse_analysis(output)
+        assert analysis == {"speech_start": 0.0, "speech_end": None, "loudness": None}
+
+
+class TestMeasure:
+    """Test the analysis pass against ffmpeg"""
+
+    def test_measurement_is_cached_by_input_hash(self, analysis_cache, monkeypatch, tmp_path):
+        """Test that a second request for the same input skips the analysis pass"""
+        audio = tmp_path / "padded.wav"
+        write_padded_wav(audio)
+        processing = loudness.Processing("accurate", trim_silence=True)
+
+        first = loudness.measure(str(audio), "abc", processing)
+        assert first["speech_start"] == pytest.approx(1.0, abs=0.05)
+        assert first["speech_end"] == pytest.approx(3.0, abs=0.05)
+        assert first["loudness"] is not None
+
+        def fail(*args, **kwargs):
+            raise AssertionError("analyzed twice")
+
+        monkeypatch.setattr(mp3, "measure", fail)
+        assert loudness.measure(str(audio), "abc", processing) == first
+
+    def test_no_analysis_when_not_needed(self, analysis_cache, monkeypatch, tmp_path):
+        """Test that fast loudnorm and the limiter don't decode the input twice"""
+        monkeypatch.setattr(mp3, "measure", lambda *args, **kwargs: pytest.fail("analyzed"))
+        assert loudness.measure(str(tmp_path / "missing"), "abc", loudness.Processing("fast", limiter=True)) is None
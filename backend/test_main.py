@@ -4,16 +4,34 @@ Tests verify that audio conversion, metadata embedding, and file handling work c
 """
 
 import pytest
+import base64
+import hashlib
 import io
+import os
+import subprocess
 import tempfile
+import time
 import wave
+import zipfile
 import struct
 
+from fastapi import HTTPException
 from starlette.testclient import TestClient
 from mutagen.id3 import ID3
 from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
 
+import main
 from main import app
+from backend import admission, assets, cache, cover, encoders, jobs, loudness, metrics, mp3 as mp3_module, peaks, pool, probe, results, scratch, segmented, uploads
+
+
+@pytest.fixture(scope="module", autouse=True)
+def started_app():
+    """The app as a server process has it once its startup ran"""
+    main.configure()
+    main.start()
 
 
 @pytest.fixture
@@ -406,5 +424,1250 @@ class TestAudioQuality:
         assert mp3.info.bitrate < 320000  # Less than 320 kbps
 
 
+@pytest.fixture
+def app_env(monkeypatch, tmp_path):
+    """Environment the endpoints read their album defaults from"""
+    monkeypatch.setenv("CACHE_DIR", str(tmp_path / "cache"))
+    cache.configure()
+    monkeypatch.setenv("ALBUM", "Env Album")
+    monkeypatch.setenv("ALBUM_ARTIST", "Env Artist")
+    monkeypatch.setenv("GENRE", "Podcast")
+    monkeypatch.setenv("TITLE_SUFFIX", " - Show")
+    # The default cover is looked up relative to the repository root
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), ".."))
+    monkeypatch.setenv("PROFILES_FILE", str(tmp_path / "profiles.json"))
+    monkeypatch.setenv("COVER_CACHE_DIR", str(tmp_path / "covers"))
+    cover.configure()
+    assets.configure()
+    monkeypatch.setenv("ANALYSIS_CACHE_DIR", str(tmp_path / "analysis"))
+    loudness.configure()
+    probe.configure()
+    encoders.configure()
+    monkeypatch.setenv("SCRATCH_DIR", str(tmp_path / "fast"))
+    monkeypatch.setenv("SCRATCH_SPILL_DIR", str(tmp_path / "disk"))
+    scratch.configure()
+    uploads.configure()
+    monkeypatch.setenv("RESULTS_DIR", str(tmp_path / "results"))
+    results.configure()
+
+
+class TestStreamingResponse:
+    """Test the RESPONSE_MODE=stream path"""
+
+    def test_streamed_mp3_is_tagged(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that the streamed response carries the ID3 header and audio"""
+        monkeypatch.setenv("RESPONSE_MODE", "stream")
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Streamed", "speaker": "Jane"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "audio/mpeg"
+        assert "Streamed - Show.mp3" in response.headers["content-disposition"]
+        tags = ID3(io.BytesIO(response.content))
+        assert str(tags.get("TIT2")) == "Streamed - Show"
+        assert str(tags.get("TPE1")) == "Jane"
+        assert tags.get("APIC:Cover") is not None
+        assert MP3(io.BytesIO(response.content)).info.length > 0
+
+    def test_undecodable_upload_fails_before_streaming(self, client, app_env, monkeypatch):
+        """Test that undecodable input still produces an error status in stream mode"""
+        monkeypatch.setenv("RESPONSE_MODE", "stream")
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Broken"},
+            files={"audioFile": ("test.wav", io.BytesIO(b"not audio" * 100), "audio/wav")},
+        )
+
+        # Refused by the probe, before ffmpeg is started
+        assert response.status_code == 415
+
+
+class TestStreamingIngest:
+    """Test that uploads reach ffmpeg without being spooled first"""
+
+    @pytest.mark.parametrize("ingest_mode", ["pipe", "spool"])
+    def test_fields_after_the_file_are_used(self, client, app_env, monkeypatch, test_audio_file, ingest_mode):
+        """Test that topic/speaker sent after the audio still end up in the tags"""
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        response = client.post(
+            "/api/convert",
+            files=[
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("topic", (None, "Late Fields")),
+                ("speaker", (None, "Jane")),
+            ],
+        )
+
+        assert response.status_code == 200
+        tags = ID3(io.BytesIO(response.content))
+        assert str(tags.get("TIT2")) == "Late Fields - Show"
+        assert str(tags.get("TPE1")) == "Jane"
+        assert tags.get("APIC:Cover") is not None
+        assert MP3(io.BytesIO(response.content)).info.length > 0.9
+
+    def test_mp4_input_falls_back_to_spooling(self, client, app_env, tmp_path, test_audio_file):
+        """Test that an M4A with its index at the end still converts"""
+        wav = tmp_path / "in.wav"
+        wav.write_bytes(test_audio_file.read())
+        m4a = tmp_path / "in.m4a"
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", str(wav), "-c:a", "aac", str(m4a)],
+            check=True,
+        )
+
+        with open(m4a, "rb") as f:
+            response = client.post(
+                "/api/convert",
+                data={"topic": "From M4A"},
+                files={"audioFile": ("in.m4a", f, "audio/mp4")},
+            )
+
+        assert response.status_code == 200
+        assert str(ID3(io.BytesIO(response.content)).get("TPE1")) == "Unknown"
+
+    def test_undecodable_piped_upload_is_rejected(self, client, app_env):
+        """Test that ffmpeg failing on piped input returns 400"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Broken"},
+            files={"audioFile": ("test.wav", io.BytesIO(b"not audio" * 10000), "audio/wav")},
+        )
+
+        assert response.status_code == 400
+
+    def test_second_audio_file_is_rejected(self, client, app_env, test_audio_file):
+        """Test that a second audio part is refused rather than replacing the first one's encode"""
+        audio = test_audio_file.read()
+        response = client.post(
+            "/api/convert",
+            files=[
+                ("topic", (None, "Twice")),
+                ("audioFile", ("a.wav", audio, "audio/wav")),
+                ("audioFile", ("b.wav", audio, "audio/wav")),
+            ],
+        )
+
+        assert response.status_code == 422
+        assert pool.get_pool().pending == 0
+
+    def test_missing_topic_with_piped_upload(self, client, app_env, test_audio_file):
+        """Test that a missing topic is still reported as 422"""
+        response = client.post(
+            "/api/convert",
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 422
+
+
+class TestResultCache:
+    """Test that re-submitted audio skips the encode"""
+
+    @pytest.mark.parametrize("ingest_mode,response_mode", [("pipe", "buffered"), ("spool", "buffered"), ("spool", "stream")])
+    def test_resubmission_only_rebuilds_tags(self, client, app_env, monkeypatch, test_audio_file, ingest_mode, response_mode):
+        """Test that a second upload of the same audio is a cache hit with fresh tags"""
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        monkeypatch.setenv("RESPONSE_MODE", response_mode)
+        audio = test_audio_file.read()
+
+        responses = [
+            client.post(
+                "/api/convert",
+                data={"topic": topic},
+                files={"audioFile": ("test.wav", io.BytesIO(audio), "audio/wav")},
+            )
+            for topic in ("Typo", "Fixed")
+        ]
+
+        assert [r.status_code for r in responses] == [200, 200]
+        first, second = (ID3(io.BytesIO(r.content)) for r in responses)
+        assert str(first.get("TIT2")) == "Typo - Show"
+        assert str(second.get("TIT2")) == "Fixed - Show"
+        # Identical audio frames after the tags
+        assert responses[0].content[first.size:] == responses[1].content[second.size:]
+        stats = client.get("/api/cache").json()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["entries"] == 1
+
+
+class TestStoredResults:
+    """Test resuming a converted download from the result store"""
+
+    def _convert(self, client, test_audio_file, **data):
+        return client.post(
+            "/api/convert",
+            data={"topic": "Resumed", **data},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+    def test_resume_and_revalidate(self, client, app_env, test_audio_file):
+        response = self._convert(client, test_audio_file)
+
+        assert response.status_code == 200
+        assert response.headers["content-length"] == str(len(response.content))
+        location = response.headers["content-location"]
+        assert location.startswith("/api/results/")
+
+        rest = client.get(location, headers={"Range": "bytes=100-", "If-Range": response.headers["etag"]})
+        assert rest.status_code == 206
+        assert response.content[:100] + rest.content == response.content
+        assert "Resumed - Show.mp3" in rest.headers["content-disposition"]
+        assert client.get(location, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+    def test_zip_of_several_formats(self, client, app_env, test_audio_file):
+        response = self._convert(client, test_audio_file, formats="mp3,opus")
+
+        stored = client.get(response.headers["content-location"])
+        assert stored.headers["content-type"] == "application/zip"
+        assert stored.content == response.content
+
+    def test_without_retention(self, client, app_env, monkeypatch, test_audio_file):
+        monkeypatch.setenv("RESULTS_RETENTION", "0")
+        results.configure()
+
+        response = self._convert(client, test_audio_file)
+
+        assert response.status_code == 200
+        assert "content-location" not in response.headers
+        assert os.listdir(results.get_store().root) == []
+        assert client.get("/api/results/" + "0" * 32).status_code == 404
+
+
+class TestTagProfiles:
+    """Test choosing a cover/album profile from the form"""
+
+    @pytest.fixture
+    def talks(self, app_env, tmp_path):
+        (tmp_path / "profiles.json").write_text('{"talks": {"album": "Talks", "title_suffix": " (Talk)"}}')
+
+    def test_profiles_are_listed(self, client, talks):
+        assert client.get("/api/profiles").json() == [
+            {"name": "default", "album": "Env Album"},
+            {"name": "talks", "album": "Talks"},
+        ]
+
+    @pytest.mark.parametrize("ingest_mode", ["pipe", "spool"])
+    def test_selected_profile_is_used(self, client, talks, monkeypatch, test_audio_file, ingest_mode):
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Keynote", "profile": "talks"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        id3 = ID3(io.BytesIO(response.content))
+        assert str(id3.get("TIT2")) == "Keynote (Talk)"
+        assert str(id3.get("TALB")) == "Talks"
+        assert str(id3.get("TPE2")) == "Env Artist"
+
+    def test_unknown_profile_is_rejected(self, client, talks, test_audio_file):
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Keynote", "profile": "nope"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 422
+
+
+class TestCoverUpload:
+    """Test that uploaded covers are normalized before embedding"""
+
+    def _big_png(self):
+        from PIL import Image
+        # Noise doesn't compress, so this is well over the byte budget as PNG
+        image = Image.frombytes("RGB", (2000, 1500), os.urandom(2000 * 1500 * 3))
+        out = io.BytesIO()
+        image.save(out, "PNG")
+        return out.getvalue()
+
+    @pytest.mark.parametrize("endpoint", ["/api/convert", "/api/convert/batch"])
+    def test_cover_is_downscaled_jpeg(self, client, app_env, monkeypatch, test_audio_file, endpoint):
+        from PIL import Image
+        monkeypatch.setenv("COVER_MAX_PX", "500")
+        monkeypatch.setenv("COVER_MAX_BYTES", "100000")
+        cover.configure()
+        png = self._big_png()
+
+        response = client.post(
+            endpoint,
+            data={"topic": "Covered"},
+            files=[
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("cover", ("cover.png", io.BytesIO(png), "image/png")),
+            ],
+        )
+
+        assert response.status_code == 200
+        content = response.content
+        if endpoint.endswith("batch"):
+            with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                content = zf.read("Covered - Show.mp3")
+        apic = ID3(io.BytesIO(content)).get("APIC:Cover")
+        assert apic.mime == "image/jpeg"
+        assert len(apic.data) <= 100000
+        image = Image.open(io.BytesIO(apic.data))
+        assert image.format == "JPEG"
+        assert max(image.size) == 500
+        assert image.info.get("progressive")
+
+    def test_not_an_image(self, client, app_env, test_audio_file):
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Covered"},
+            files=[
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("cover", ("cover.png", io.BytesIO(b"<svg></svg>"), "image/png")),
+            ],
+        )
+
+        assert response.status_code == 400
+        assert "Unsupported cover image" in response.json()["detail"]
+
+
+class TestBatchConversion:
+    """Test /api/convert/batch"""
+
+    def _post(self, client, files, topics, speakers=()):
+        return client.post(
+            "/api/convert/batch",
+            data={"topic": list(topics), "speaker": list(speakers)},
+            files=[("audioFile", (name, io.BytesIO(data), "audio/wav")) for name, data in files],
+        )
+
+    def test_zip_of_tagged_mp3s(self, client, app_env, test_audio_file):
+        """Test that every file comes back tagged in one stored ZIP"""
+        audio = test_audio_file.read()
+        response = self._post(
+            client,
+            [("one.wav", audio), ("two.wav", audio), ("three.wav", audio)],
+            ["Part 1", "Part 2", "Part 2"],
+            ["Alice", "Bob", ""],
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        assert 'filename="Env Album.zip"' in response.headers["content-disposition"]
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            assert zf.testzip() is None
+            assert sorted(zf.namelist()) == ["Part 1 - Show.mp3", "Part 2 - Show (2).mp3", "Part 2 - Show.mp3"]
+            assert all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist())
+            tags = {}
+            for name in zf.namelist():
+                id3 = ID3(io.BytesIO(zf.read(name)))
+                tags[str(id3.get("TIT2")), str(id3.get("TPE1"))] = id3
+                assert MP3(io.BytesIO(zf.read(name))).info.length > 0.5
+
+        assert set(tags) == {("Part 1 - Show", "Alice"), ("Part 2 - Show", "Bob"), ("Part 2 - Show", "Unknown")}
+        for id3 in tags.values():
+            assert str(id3.get("TALB")) == "Env Album"
+            assert str(id3.get("TCON")) == "Podcast"
+            assert id3.getall("APIC")
+
+    def test_single_speaker_applies_to_all(self, client, app_env, test_audio_file):
+        audio = test_audio_file.read()
+        response = self._post(client, [("a.wav", audio), ("b.wav", audio)], ["A", "B"], ["Host"])
+
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            assert {str(ID3(io.BytesIO(zf.read(n))).get("TPE1")) for n in zf.namelist()} == {"Host"}
+
+    def test_failed_entry_is_reported_in_the_archive(self, client, app_env, test_audio_file):
+        """Test that one undecodable file doesn't sink the rest of the batch"""
+        response = self._post(client, [("good.wav", test_audio_file.read()), ("bad.wav", b"not audio" * 100)], ["Good", "Bad"])
+
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            assert sorted(zf.namelist()) == ["Bad - Show.mp3.error.txt", "Good - Show.mp3"]
+            assert b"bad.wav" in zf.read("Bad - Show.mp3.error.txt")
+
+    def test_topic_count_must_match(self, client, app_env, test_audio_file):
+        audio = test_audio_file.read()
+        response = self._post(client, [("a.wav", audio), ("b.wav", audio)], ["Only one"])
+
+        assert response.status_code == 422
+        assert "2 audio files but 1 topics" in response.json()["detail"]
+
+    def test_too_many_files(self, client, app_env, monkeypatch, test_audio_file):
+        monkeypatch.setenv("BATCH_MAX_FILES", "1")
+        audio = test_audio_file.read()
+        response = self._post(client, [("a.wav", audio), ("b.wav", audio)], ["A", "B"])
+
+        assert response.status_code == 413
+
+
+def _wait_for_job(client, status_url):
+    for _ in range(500):
+        status = client.get(status_url).json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+class TestJobApi:
+    """Test submitting a job, polling it and downloading the result"""
+
+    @pytest.fixture
+    def job_env(self, app_env, monkeypatch, tmp_path):
+        monkeypatch.setenv("JOBS_DIR", str(tmp_path / "jobs"))
+        jobs.configure(main._run_job)
+        yield
+        jobs.get_runner().stop()
+
+    def test_submit_poll_download(self, client, job_env, test_audio_file):
+        """Test the whole job lifecycle including a ranged download"""
+        response = client.post(
+            "/api/jobs",
+            data={"topic": "Long Episode", "speaker": "Jane"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+        assert response.status_code == 202
+        submitted = response.json()
+        assert submitted["status"] == "queued"
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["status"] == "done"
+        assert status["progress"] == 100
+
+        result = client.get(status["result_url"])
+        assert result.status_code == 200
+        assert result.headers["accept-ranges"] == "bytes"
+        assert "Long Episode - Show.mp3" in result.headers["content-disposition"]
+        tags = ID3(io.BytesIO(result.content))
+        assert str(tags.get("TIT2")) == "Long Episode - Show"
+        assert str(tags.get("TPE1")) == "Jane"
+
+        partial = client.get(status["result_url"], headers={"Range": "bytes=10-19"})
+        assert partial.status_code == 206
+        assert partial.headers["content-range"] == f"bytes 10-19/{len(result.content)}"
+        assert partial.content == result.content[10:20]
+
+    def test_undecodable_upload_is_refused(self, client, job_env, tmp_path):
+        """Test that an undecodable upload never becomes a job"""
+        response = client.post(
+            "/api/jobs",
+            data={"topic": "Broken"},
+            files={"audioFile": ("test.wav", io.BytesIO(b"not audio" * 100), "audio/wav")},
+        )
+
+        assert response.status_code == 415
+        assert [path for path in (tmp_path / "jobs").iterdir() if path.is_dir()] == []
+
+    def test_failed_job_reports_error(self, client, job_env, monkeypatch, test_audio_file):
+        """Test that an encode failing in the background ends up as a failed job"""
+        def fail(*args, **kwargs):
+            raise HTTPException(status_code=400, detail="FFmpeg failed: broken stream")
+
+        monkeypatch.setattr(mp3_module, "convert_outputs", fail)
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Broken"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["status"] == "failed"
+        assert "FFmpeg failed" in status["error"]
+        assert client.get(f"/api/jobs/{submitted['id']}/result").status_code == 409
+
+    def test_unknown_job(self, client, job_env):
+        assert client.get("/api/jobs/nope").status_code == 404
+
+    def test_one_artifact_per_format(self, client, job_env, test_audio_file):
+        """Test that a job with several formats has a result for each"""
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Formats", "formats": "mp3,opus"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["status"] == "done"
+        assert set(status["results"]) == {"mp3", "opus"}
+
+        opus = client.get(status["results"]["opus"])
+        assert opus.status_code == 200
+        assert opus.headers["content-type"] == "audio/ogg"
+        assert "Formats - Show.opus" in opus.headers["content-disposition"]
+        assert OggOpus(io.BytesIO(opus.content))["title"] == ["Formats - Show"]
+        assert str(ID3(io.BytesIO(client.get(status["result_url"]).content))["TIT2"]) == "Formats - Show"
+        assert client.get(status["result_url"] + "?format=m4a").status_code == 404
+
+    def test_peaks_and_preview(self, client, job_env, test_audio_file):
+        """Test the waveform and preview clip that come out of the job's encode"""
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Waveform"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+        assert client.get(f"/api/jobs/{submitted['id']}/peaks").status_code in (404, 409)
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["peaks_levels"] == list(peaks.LEVELS)
+
+        response = client.get(status["peaks_url"], params={"samples_per_pixel": 32})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        samples_per_pixel, pairs = peaks.decode(response.content)
+        assert samples_per_pixel == 32
+        assert len(pairs) > 0
+        assert client.get(status["peaks_url"], params={"samples_per_pixel": 100}).status_code == 404
+
+        preview = client.get(status["preview_url"])
+        assert preview.status_code == 200
+        assert preview.headers["content-type"] == "audio/mpeg"
+        assert 0 < len(preview.content) < len(client.get(status["result_url"]).content)
+
+    def test_preview_can_be_turned_off(self, client, job_env, monkeypatch, test_audio_file):
+        monkeypatch.setenv("PREVIEW_SECONDS", "0")
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Quiet", "loudnorm": "fast"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["status"] == "done"
+        assert "preview_url" not in status
+        assert client.get(f"/api/jobs/{submitted['id']}/preview").status_code == 404
+        assert client.get(status["peaks_url"]).status_code == 200
+
+
+class TestExternalWorkers:
+    """Test the API queueing jobs for a worker process"""
+
+    def test_job_waits_for_a_worker(self, client, app_env, monkeypatch, tmp_path, test_audio_file):
+        monkeypatch.setenv("JOBS_DIR", str(tmp_path / "jobs"))
+        monkeypatch.setenv("JOB_WORKERS", "external")
+        jobs.configure(main._run_job)
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Remote"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+        time.sleep(0.1)
+        assert client.get(submitted["status_url"]).json()["status"] == "queued"
+
+        worker = jobs.configure_worker(main._run_job)
+        worker.start()
+        try:
+            status = _wait_for_job(client, submitted["status_url"])
+        finally:
+            worker.stop()
+        assert status["status"] == "done"
+        assert str(ID3(io.BytesIO(client.get(status["result_url"]).content)).get("TIT2")) == "Remote - Show"
+
+
+class TestSegmentedEncoding:
+    """Test that long inputs encoded in segments come out like single encodes"""
+
+    @pytest.fixture
+    def segmenting(self, app_env, monkeypatch, tmp_path):
+        # Every input counts as long here
+        monkeypatch.setenv("SEGMENT_WORKERS", "2")
+        monkeypatch.setenv("SEGMENT_MIN_DURATION", "1")
+        monkeypatch.setenv("SEGMENT_SECONDS", "1")
+        segmented.configure()
+        monkeypatch.setenv("JOBS_DIR", str(tmp_path / "jobs"))
+        jobs.configure(main._run_job)
+        yield
+        jobs.get_runner().stop()
+        monkeypatch.undo()
+        segmented.configure()
+
+    def test_spooled_conversion(self, client, segmenting, monkeypatch, test_audio_file):
+        monkeypatch.setenv("INGEST_MODE", "spool")
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Segmented", "speaker": "Jane"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        tags = ID3(io.BytesIO(response.content))
+        assert str(tags.get("TIT2")) == "Segmented - Show"
+        assert MP3(io.BytesIO(response.content)).info.length == pytest.approx(1.0, abs=0.1)
+
+    def test_job_keeps_peaks_and_preview(self, client, segmenting, test_audio_file):
+        submitted = client.post(
+            "/api/jobs",
+            data={"topic": "Segmented Job"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        ).json()
+
+        status = _wait_for_job(client, submitted["status_url"])
+        assert status["status"] == "done"
+        result = client.get(status["result_url"])
+        assert str(ID3(io.BytesIO(result.content)).get("TIT2")) == "Segmented Job - Show"
+        assert client.get(status["peaks_url"]).status_code == 200
+        assert client.get(status["preview_url"]).status_code == 200
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])
+
+
+class TestMetrics:
+    """Test the /metrics endpoint and Server-Timing header"""
+
+    def test_conversion_is_measured(self, client, app_env, test_audio_file):
+        """Test that a conversion shows up in the stage histogram and the Server-Timing header"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Measured"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+        assert response.status_code == 200
+        assert "upload;dur=" in response.headers["server-timing"]
+        assert "encode;dur=" in response.headers["server-timing"]
+
+        metrics_response = client.get("/metrics")
+        assert metrics_response.status_code == 200
+        assert metrics_response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = metrics_response.text
+        assert 'audio_producer_stage_seconds_count{stage="upload"}' in text
+        assert 'audio_producer_stage_seconds_count{stage="encode"}' in text
+        assert "audio_producer_conversions_in_flight 0" in text
+
+    def test_ffmpeg_failures_are_counted(self, client, app_env):
+        """Test that a failed encode is counted by exit code"""
+        before = sum(metrics.FFMPEG_FAILURES._values.values())
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Broken"},
+            files={"audioFile": ("test.wav", io.BytesIO(b"not audio" * 100), "audio/wav")},
+        )
+        assert response.status_code == 400
+        assert sum(metrics.FFMPEG_FAILURES._values.values()) == before + 1
+
+
+class TestLoudnessProcessing:
+    """Test per-request loudness normalization and silence trimming"""
+
+    @pytest.mark.parametrize("ingest_mode,response_mode", [("pipe", "buffered"), ("spool", "stream")])
+    def test_trimmed_and_normalized(self, client, app_env, monkeypatch, tmp_path, ingest_mode, response_mode):
+        """Test that leading/trailing silence is removed and the result still tagged"""
+        from backend.test_loudness import write_padded_wav
+
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        monkeypatch.setenv("RESPONSE_MODE", response_mode)
+        audio = tmp_path / "padded.wav"
+        write_padded_wav(audio)
+        with open(audio, "rb") as f:
+            response = client.post(
+                "/api/convert",
+                files=[
+                    ("loudnorm", (None, "accurate")),
+                    ("trimSilence", (None, "true")),
+                    ("limiter", (None, "true")),
+                    ("audioFile", ("padded.wav", f, "audio/wav")),
+                    ("topic", (None, "Trimmed")),
+                ],
+            )
+
+        assert response.status_code == 200
+        assert str(ID3(io.BytesIO(response.content)).get("TIT2")) == "Trimmed - Show"
+        # Streamed MP3s have no Xing header to read the length from, decode instead
+        decoded = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", "44100", "pipe:1"],
+            input=response.content,
+            capture_output=True,
+            check=True,
+        ).stdout
+        assert len(decoded) / (2 * 44100) == pytest.approx(2.0, abs=0.15)
+
+    def test_fast_mode_with_a_piped_upload(self, client, app_env, test_audio_file):
+        """Test that single-pass loudnorm works while the upload is piped"""
+        response = client.post(
+            "/api/convert",
+            files=[
+                ("loudnorm", (None, "fast")),
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("topic", (None, "Fast")),
+            ],
+        )
+
+        assert response.status_code == 200
+        assert MP3(io.BytesIO(response.content)).info.sample_rate == 44100
+
+    def test_processing_after_a_piped_file_is_rejected(self, client, app_env, test_audio_file):
+        """Test that options arriving after ffmpeg already started are not silently ignored"""
+        response = client.post(
+            "/api/convert",
+            files=[
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("topic", (None, "Late")),
+                ("loudnorm", (None, "fast")),
+            ],
+        )
+
+        assert response.status_code == 422
+        assert "before the audio file" in response.json()["detail"]
+
+    def test_unknown_mode(self, client, app_env, test_audio_file):
+        """Test that an unknown loudnorm mode is a 422"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Loud", "loudnorm": "louder"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 422
+
+
+class TestEncoderProfiles:
+    """Test per-request encoder profiles"""
+
+    def test_lists_encoders(self, client, app_env):
+        """Test that the built-in encoders are offered with the default marked"""
+        response = client.get("/api/encoders")
+
+        assert response.status_code == 200
+        by_name = {e["name"]: e for e in response.json()}
+        assert {"default", "speech-mono-64k", "music-v2", "archive-320"} <= set(by_name)
+        assert by_name["default"]["default"] is True
+        assert by_name["speech-mono-64k"]["bitrate"] == 64
+
+    @pytest.mark.parametrize("ingest_mode", ["pipe", "spool"])
+    def test_speech_profile(self, client, app_env, monkeypatch, test_audio_file, ingest_mode):
+        """Test that the chosen profile decides bitrate and channels"""
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Speech", "encoder": "speech-mono-64k"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        info = MP3(io.BytesIO(response.content)).info
+        assert info.channels == 1
+        assert info.bitrate == pytest.approx(64000, rel=0.01)
+
+    def test_matching_mp3_is_only_retagged(self, client, app_env, monkeypatch, tmp_path):
+        """Test that an MP3 input already matching the profile is stream-copied"""
+        from backend.test_encoders import make_mp3
+
+        source = tmp_path / "episode.mp3"
+        make_mp3(source, "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k")
+        runs = []
+        run_ffmpeg = mp3_module._run_ffmpeg
+        monkeypatch.setattr(mp3_module, "_run_ffmpeg", lambda args, *rest: runs.append(args) or run_ffmpeg(args, *rest))
+
+        with open(source, "rb") as f:
+            response = client.post(
+                "/api/convert",
+                files=[
+                    ("encoder", (None, "speech-mono-64k")),
+                    ("audioFile", ("episode.mp3", f, "audio/mpeg")),
+                    ("topic", (None, "Copied")),
+                ],
+            )
+
+        assert response.status_code == 200
+        assert str(ID3(io.BytesIO(response.content)).get("TIT2")) == "Copied - Show"
+        assert MP3(io.BytesIO(response.content)).info.bitrate == pytest.approx(64000, rel=0.01)
+        assert any("copy" in args and "libmp3lame" not in args for args in runs)
+
+    def test_unknown_encoder(self, client, app_env, test_audio_file):
+        """Test that an unknown encoder is a 422"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Nope", "encoder": "nope"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 422
+
+
+class TestScratchSpace:
+    """Test that conversions run in budgeted scratch directories"""
+
+    def test_conversion_leaves_nothing_behind(self, client, app_env, tmp_path, test_audio_file):
+        """Test that the work directory is removed and its bytes returned"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Scratch"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        space = scratch.get_space()
+        assert space.reserved == 0
+        assert os.listdir(space.roots[scratch.FAST]) == []
+
+    def test_rejects_when_budget_used_up(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that a request waits for scratch space and then gets 503"""
+        monkeypatch.setenv("SCRATCH_MAX_BYTES", str(10 * 1024 * 1024))
+        monkeypatch.setenv("SCRATCH_WAIT", "0")
+        space = scratch.configure()
+        held = space.try_acquire(5 * 1024 * 1024)
+
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Busy"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+        space.release(held)
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Free"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+        assert response.status_code == 200
+
+    def test_rejects_upload_larger_than_budget(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that an upload that could never fit is a 413"""
+        monkeypatch.setenv("SCRATCH_MAX_BYTES", "1000")
+        scratch.configure()
+
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Huge"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 413
+
+
+class TestStartup:
+    """Test the process lifecycle around the app"""
+
+    def test_import_has_no_side_effects(self):
+        """Test that importing the app neither configures it nor loads numpy"""
+        code = "import sys, backend.main as m; from backend import jobs; print(m._configured, jobs.get_runner(), 'numpy' in sys.modules)"
+        out = subprocess.run(
+            ["python", "-c", code], cwd=os.path.join(os.path.dirname(__file__), ".."), capture_output=True, text=True, check=True
+        )
+        assert out.stdout.split() == ["False", "None", "False"]
+
+    def test_readiness(self, client, monkeypatch):
+        """Test that readiness fails without FFmpeg and while shutting down"""
+        response = client.get("/api/ready")
+        assert response.status_code == 200
+        assert response.json()["ffmpeg"]
+
+        monkeypatch.setattr(main, "_draining", True)
+        assert client.get("/api/ready").status_code == 503
+        monkeypatch.setattr(main, "_draining", False)
+        monkeypatch.setattr(main, "_ffmpeg_version", None)
+        assert client.get("/api/ready").status_code == 503
+
+    def test_lifespan_reports_startup(self, monkeypatch, tmp_path):
+        """Test that a served app records its startup time and memory"""
+        monkeypatch.setenv("JOBS_DIR", str(tmp_path / "jobs"))
+        # Shutting down drains; restored afterwards
+        monkeypatch.setattr(main, "_draining", False)
+        with TestClient(app) as served:
+            text = served.get("/metrics").text
+        jobs.configure(main._run_job)
+
+        assert "audio_producer_startup_seconds " in text
+        assert 'audio_producer_memory_bytes{kind="rss"}' in text
+
+
+class TestAdmission:
+    """Test per-client quotas in front of the conversion endpoints"""
+
+    @pytest.fixture
+    def quota(self, app_env, monkeypatch):
+        monkeypatch.setenv("CLIENT_MINUTES_PER_HOUR", "1")
+        monkeypatch.setenv("CLIENT_API_KEYS", "team-a,team-b")
+        admission.configure()
+        yield admission.get_controller()
+        monkeypatch.undo()
+        admission.configure()
+
+    def test_client_over_quota_is_refused_before_upload(self, client, quota, monkeypatch, test_audio_file):
+        """Test that a client that used up its audio minutes gets 429 without its upload being read"""
+        received = []
+        monkeypatch.setattr(main, "_receive_form", lambda *args: received.append(args))
+        quota.charge(admission._identity("team-a"), 60)
+
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Too Much"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+            headers={"X-API-Key": "team-a"},
+        )
+
+        assert response.status_code == 429
+        assert 3590 <= int(response.headers["Retry-After"]) <= 3600
+        assert received == []
+        assert metrics.ADMISSION_REJECTIONS.value(reason="quota") >= 1
+
+    def test_clients_have_their_own_quota(self, client, quota, test_audio_file):
+        """Test that one client's used-up quota doesn't stop another"""
+        quota.charge(admission._identity("team-a"), 60)
+
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Keyed"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+            headers={"X-API-Key": "team-b"},
+        )
+
+        assert response.status_code == 200
+        stats = client.get("/api/admission").json()
+        assert stats["running"] == 0
+        clients = {entry["client"]: entry for entry in stats["clients"]}
+        assert clients[admission._identity("team-a")]["minutes_last_hour"] == 1
+        assert clients[admission._identity("team-b")]["minutes_last_hour"] == 0
+
+
+class TestInputProbing:
+    """Test rejecting uploads from what their first bytes and headers say"""
+
+    @pytest.fixture(autouse=True)
+    def limits(self, monkeypatch):
+        yield
+        monkeypatch.undo()
+        probe.configure()
+
+    def test_image_is_refused(self, client, app_env, test_cover_image):
+        """Test that an image sent as the audio file is a 415"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Picture"},
+            files={"audioFile": ("cover.wav", test_cover_image, "audio/wav")},
+        )
+
+        assert response.status_code == 415
+        assert "JPEG" in response.json()["detail"]
+
+    def test_too_long_from_the_header(self, client, app_env, monkeypatch):
+        """Test that a WAV header announcing more than INPUT_MAX_DURATION is a 422"""
+        monkeypatch.setenv("INPUT_MAX_DURATION", "3600")
+        probe.configure()
+        # 16-bit mono at 44.1kHz announcing two hours, of which only the start is sent
+        data_size = 2 * 3600 * 44100 * 2
+        header = (
+            b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, 44100, 88200, 2, 16)
+            + b"data" + struct.pack("<I", data_size)
+        )
+
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Marathon"},
+            files={"audioFile": ("long.wav", io.BytesIO(header + b"\0" * 8192), "audio/wav")},
+        )
+
+        assert response.status_code == 422
+        assert "120 minutes" in response.json()["detail"]
+
+    def test_piped_encode_timeout_follows_the_header(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that a piped upload's FFmpeg timeout is scaled to the duration in its WAV header"""
+        monkeypatch.setenv("CONVERT_MIN_SPEED", "0.01")
+        probe.configure()
+        timeouts = []
+        original = mp3_module.convert_pipe
+        monkeypatch.setattr(
+            mp3_module, "convert_pipe", lambda *args, **options: timeouts.append(options["timeout_s"]) or original(*args, **options)
+        )
+
+        response = client.post(
+            "/api/convert",
+            files=[("topic", (None, "Timed")), ("audioFile", ("test.wav", test_audio_file, "audio/wav"))],
+        )
+
+        assert response.status_code == 200
+        assert timeouts == [60 + 100]
+
+    def test_announced_upload_over_the_limit(self, client, app_env, monkeypatch):
+        """Test that a resumable upload larger than INPUT_MAX_BYTES is refused when created"""
+        monkeypatch.setenv("INPUT_MAX_BYTES", "1000")
+        probe.configure()
+
+        response = client.post("/api/uploads", json={"filename": "test.wav", "size": 5000})
+
+        assert response.status_code == 413
+
+
+class TestChunkedUpload:
+    """Test resumable uploads through /api/uploads"""
+
+    def _start(self, client, data, **options):
+        response = client.post("/api/uploads", json={"filename": "test.wav", "size": len(data), **options})
+        assert response.status_code == 201
+        return response.json()
+
+    def _send(self, client, upload, data, offset, size, checksum=None):
+        headers = {"Upload-Offset": str(offset)}
+        if checksum is not None:
+            headers["Upload-Checksum"] = checksum
+        return client.patch(upload["upload_url"], content=data[offset:offset + size], headers=headers)
+
+    def test_out_of_order_chunks_convert(self, client, app_env, monkeypatch, test_audio_file):
+        """Test chunks sent out of order, resumed from the missing ranges and completed"""
+        monkeypatch.setenv("UPLOAD_STALL", "1")
+        uploads.configure()
+        data = test_audio_file.read()
+        upload = self._start(client, data)
+        half = len(data) // 2
+
+        response = self._send(client, upload, data, half, len(data))
+        assert response.status_code == 200
+        assert response.json()["offset"] == 0
+        status = client.get(upload["upload_url"]).json()
+        assert status["missing"] == [[0, half]]
+
+        start, end = status["missing"][0]
+        digest = base64.b64encode(hashlib.sha256(data[start:end]).digest()).decode()
+        response = self._send(client, upload, data, start, end - start, checksum=f"sha256 {digest}")
+        assert response.json()["offset"] == len(data)
+        assert response.headers["Upload-Offset"] == str(len(data))
+
+        response = client.post(upload["complete_url"], data={"topic": "Chunked", "speaker": "Someone"})
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "audio/mpeg"
+        with tempfile.NamedTemporaryFile(suffix=".mp3") as f:
+            f.write(response.content)
+            f.flush()
+            tags = ID3(f.name)
+            assert tags["TIT2"].text[0] == "Chunked - Show"
+            assert tags["TPE1"].text[0] == "Someone"
+            assert MP3(f.name).info.length > 0.9
+        assert client.get(upload["upload_url"]).status_code == 404
+        assert scratch.get_space().reserved == 0
+
+    def test_encode_starts_before_complete(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that the contiguous prefix is encoded while the upload is in progress"""
+        started = []
+        original = main._encode_prefix
+        monkeypatch.setattr(
+            main, "_encode_prefix", lambda session, options: started.append((session.offset, options["timeout_s"])) or original(session, options)
+        )
+        data = test_audio_file.read()
+        upload = self._start(client, data, encoder="speech-mono-64k")
+
+        self._send(client, upload, data, 0, 4096)
+        self._send(client, upload, data, 4096, len(data))
+        response = client.post(upload["complete_url"], data={"topic": "Early"})
+
+        assert response.status_code == 200
+        # A minute plus the second of audio at twice real time
+        assert started == [(4096, 61)]
+        with tempfile.NamedTemporaryFile(suffix=".mp3") as f:
+            f.write(response.content)
+            f.flush()
+            assert MP3(f.name).info.channels == 1
+
+    def test_stalled_upload_is_encoded_from_the_file(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that an early encode given up on a stalled upload falls back to encoding the whole file"""
+        monkeypatch.setenv("UPLOAD_STALL", "1")
+        uploads.configure()
+        data = test_audio_file.read()
+        upload = self._start(client, data)
+
+        self._send(client, upload, data, 0, 4096)
+        time.sleep(1.5)
+        self._send(client, upload, data, 4096, len(data))
+        response = client.post(upload["complete_url"], data={"topic": "Stalled"})
+
+        assert response.status_code == 200
+        with tempfile.NamedTemporaryFile(suffix=".mp3") as f:
+            f.write(response.content)
+            f.flush()
+            assert MP3(f.name).info.length > 0.9
+
+    def test_checksum_mismatch(self, client, app_env, test_audio_file):
+        """Test that a corrupted chunk is rejected and stays missing"""
+        data = test_audio_file.read()
+        upload = self._start(client, data)
+        digest = base64.b64encode(hashlib.sha256(b"other").digest()).decode()
+
+        response = self._send(client, upload, data, 0, 1000, checksum=f"sha256 {digest}")
+
+        assert response.status_code == 400
+        assert client.get(upload["upload_url"]).json()["missing"] == [[0, len(data)]]
+        assert client.delete(upload["upload_url"]).status_code == 204
+
+    def test_incomplete_upload_cannot_complete(self, client, app_env, test_audio_file):
+        """Test that completing with ranges missing is a 409"""
+        data = test_audio_file.read()
+        upload = self._start(client, data)
+        self._send(client, upload, data, 0, 1000)
+
+        response = client.post(upload["complete_url"], data={"topic": "Early"})
+
+        assert response.status_code == 409
+        assert response.headers["Upload-Offset"] == "1000"
+        client.delete(upload["upload_url"])
+
+    def test_chunk_too_large(self, client, app_env, monkeypatch, test_audio_file):
+        """Test that chunks over UPLOAD_MAX_CHUNK_BYTES are a 413"""
+        monkeypatch.setenv("UPLOAD_MAX_CHUNK_BYTES", "1000")
+        uploads.configure()
+        data = test_audio_file.read()
+        upload = self._start(client, data)
+        assert upload["chunk_size"] == 1000
+
+        assert self._send(client, upload, data, 0, 1001).status_code == 413
+        client.delete(upload["upload_url"])
+
+    def test_other_formats(self, client, app_env, test_audio_file):
+        """Test that an upload can be delivered as another format"""
+        data = test_audio_file.read()
+        upload = self._start(client, data, formats="opus")
+        self._send(client, upload, data, 0, len(data))
+
+        response = client.post(upload["complete_url"], data={"topic": "Opus"})
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "audio/ogg"
+        assert OggOpus(io.BytesIO(response.content))["title"] == ["Opus - Show"]
+
+    def test_unknown_upload(self, client, app_env):
+        assert client.patch("/api/uploads/nope", content=b"x", headers={"Upload-Offset": "0"}).status_code == 404
+        assert client.post("/api/uploads/nope/complete", data={"topic": "x"}).status_code == 404
+
+    def test_unknown_encoder(self, client, app_env):
+        response = client.post("/api/uploads", json={"filename": "test.wav", "size": 10, "encoder": "nope"})
+        assert response.status_code == 422
+
+
+class TestOutputFormats:
+    """Test delivering an episode in several formats"""
+
+    @pytest.mark.parametrize("ingest_mode", ["pipe", "spool"])
+    def test_zip_of_every_format(self, client, app_env, monkeypatch, test_audio_file, ingest_mode):
+        """Test that all formats come back tagged in one ZIP"""
+        monkeypatch.setenv("INGEST_MODE", ingest_mode)
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Everywhere", "speaker": "Jane", "formats": "mp3,m4a,opus"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/zip"
+        assert "Everywhere - Show.zip" in response.headers["content-disposition"]
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            assert archive.namelist() == ["Everywhere - Show.mp3", "Everywhere - Show.m4a", "Everywhere - Show.opus"]
+            assert str(ID3(io.BytesIO(archive.read("Everywhere - Show.mp3")))["TPE1"]) == "Jane"
+            assert MP4(io.BytesIO(archive.read("Everywhere - Show.m4a")))["\xa9ART"] == ["Jane"]
+            assert OggOpus(io.BytesIO(archive.read("Everywhere - Show.opus")))["artist"] == ["Jane"]
+
+    def test_single_other_format(self, client, app_env, test_audio_file):
+        """Test that one non-MP3 format is returned as the file itself"""
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Apple", "formats": "m4a"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "audio/mp4"
+        assert "Apple - Show.m4a" in response.headers["content-disposition"]
+        assert MP4(io.BytesIO(response.content))["\xa9nam"] == ["Apple - Show"]
+
+    def test_formats_after_a_piped_file_are_rejected(self, client, app_env, test_audio_file):
+        """Test that the formats must be known before the audio is piped"""
+        response = client.post(
+            "/api/convert",
+            files=[
+                ("topic", (None, "Late")),
+                ("audioFile", ("test.wav", test_audio_file, "audio/wav")),
+                ("formats", (None, "mp3,opus")),
+            ],
+        )
+
+        assert response.status_code == 422
+
+    def test_unknown_format(self, client, app_env, test_audio_file):
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Nope", "formats": "wma"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+
+        assert response.status_code == 422
+
+
+class TestRetag:
+    """Test replacing the tags of an existing MP3 through /api/retag"""
+
+    def _converted(self, client, test_audio_file):
+        response = client.post(
+            "/api/convert",
+            data={"topic": "Tpyo", "speaker": "Jane"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+        assert response.status_code == 200
+        return response.content
+
+    def _audio(self, data):
+        return data[mp3_module.id3_tag_size(data[:10]):]
+
+    def test_uploaded_mp3(self, client, app_env, test_audio_file):
+        """Test that only the tag of an uploaded MP3 changes"""
+        original = self._converted(client, test_audio_file)
+        in_place = metrics.RETAGS.value(result="in_place")
+
+        response = client.post(
+            "/api/retag",
+            data={"topic": "Typo", "speaker": "Jane"},
+            files={"audioFile": ("episode.mp3", io.BytesIO(original), "audio/mpeg")},
+        )
+
+        assert response.status_code == 200
+        assert "Typo - Show.mp3" in response.headers["content-disposition"]
+        assert len(response.content) == len(original)
+        assert metrics.RETAGS.value(result="in_place") == in_place + 1
+        assert self._audio(response.content) == self._audio(original)
+        tags = ID3(io.BytesIO(response.content))
+        assert str(tags["TIT2"]) == "Typo - Show"
+        assert str(tags["TALB"]) == "Env Album"
+        assert scratch.get_space().reserved == 0
+
+    def test_job_result(self, client, app_env, monkeypatch, tmp_path, test_audio_file):
+        """Test retagging a finished job's result where it is stored"""
+        monkeypatch.setenv("JOBS_DIR", str(tmp_path / "jobs"))
+        jobs.configure(main._run_job)
+        try:
+            submitted = client.post(
+                "/api/jobs",
+                data={"topic": "Tpyo", "speaker": "Jane"},
+                files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+            ).json()
+            status = _wait_for_job(client, submitted["status_url"])
+            original = client.get(status["result_url"]).content
+            # As a download in progress has it open
+            reading = open(os.path.join(jobs.get_runner().job_dir(submitted["id"]), "result.mp3"), "rb")
+
+            response = client.post("/api/retag", data={"topic": "Typo", "job": submitted["id"]})
+
+            assert response.status_code == 200
+            assert str(ID3(io.BytesIO(response.content))["TPE1"]) == "Jane"
+            with reading:
+                assert reading.read() == original
+            stored = client.get(status["result_url"])
+            assert stored.content == response.content
+            assert self._audio(stored.content) == self._audio(original)
+            assert "Typo - Show.mp3" in stored.headers["content-disposition"]
+        finally:
+            jobs.get_runner().stop()
+
+    def test_not_an_mp3(self, client, app_env, test_audio_file):
+        response = client.post(
+            "/api/retag",
+            data={"topic": "Wave"},
+            files={"audioFile": ("test.wav", test_audio_file, "audio/wav")},
+        )
+        assert response.status_code == 400
+        assert scratch.get_space().reserved == 0
+
+    def test_needs_a_file_or_job(self, client, app_env):
+        response = client.post("/api/retag", data={"topic": "Nothing"})
+        assert response.status_code == 422
+        assert "audioFile or job" in response.json()["detail"]
@@ -0,0 +1,110 @@
+"""
+Tests for the Prometheus metrics and the Server-Timing middleware.
+"""
+
+import asyncio
+
+from backend import metrics
+
+
+class TestRegistry:
+    """Test the text exposition format"""
+
+    def test_counter_renders_labels(self):
+        """Test that labelled counter samples carry escaped label values"""
+        counter = metrics.Counter("test_labelled_total", "A test counter", ("code",))
+        counter.inc(code=1)
+        counter.inc(2, code='a"b')
+
+        text = metrics.render()
+        assert "# TYPE test_labelled_total counter" in text
+        assert 'test_labelled_total{code="1"} 1' in text
+        assert 'test_labelled_total{code="a\\"b"} 2' in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test that each bucket counts every observation at or below its bound"""
+        histogram = metrics.Histogram("test_seconds", "A test histogram", ("stage",), buckets=(0.1, 1))
+        histogram.observe(0.05, stage="x")
+        histogram.observe(0.5, stage="x")
+        histogram.observe(5, stage="x")
+
+        text = metrics.render()
+        assert 'test_seconds_bucket{stage="x",le="0.1"} 1' in text
+        assert 'test_seconds_bucket{stage="x",le="1"} 2' in text
+        assert 'test_seconds_bucket{stage="x",le="+Inf"} 3' in text
+        assert 'test_seconds_sum{stage="x"} 5.55' in text
+        assert 'test_seconds_count{stage="x"} 3' in text
+        assert histogram.count(stage="x") == 3
+
+    def test_stage_records_into_the_request_timings(self):
+        """Test that a stage both feeds the histogram and the current request's timings"""
+        before = metrics.STAGE_SECONDS.count(stage="unit")
+        timings = {}
+        token = metrics._timings.set(timings)
+        try:
+            with metrics.stage("unit"):
+                pass
+        finally:
+            metrics._timings.reset(token)
+
+        assert metrics.STAGE_SECONDS.count(stage="unit") == before + 1
+        assert "unit" in timings
+
+    def test_process_age_and_memory(self):
+        """Test the startup and memory figures read from /proc"""
+        age = metrics.process_age()
+        usage = metrics.record_memory()
+        if age is None:
+            return
+
+        assert 0 <= age < 3600
+        assert usage["rss"] >= usage["shared"] > 0
+        assert f'audio_producer_memory_bytes{{kind="rss"}} {usage["rss"]}' in metrics.render()
+
+
+class TestMiddleware:
+    """Test byte counting and the Server-Timing header"""
+
+    def _call(self, app, path="/api/thing", body=b"hello"):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(metrics.MetricsMiddleware(app)({"type": "http", "path": path}, receive, send))
+        return messages
+
+    def test_adds_server_timing_for_recorded_stages(self):
+        """Test that stages finished before the response start end up in the header"""
+
+        async def app(scope, receive, send):
+            await receive()
+            metrics.observe_stage("upload", 0.25)
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"abc"})
+
+        before_in = metrics.REQUEST_BYTES.value()
+        before_out = metrics.RESPONSE_BYTES.value()
+        before_send = metrics.STAGE_SECONDS.count(stage="send")
+        messages = self._call(app)
+
+        assert (b"server-timing", b"upload;dur=250.0") in messages[0]["headers"]
+        assert metrics.REQUEST_BYTES.value() == before_in + 5
+        assert metrics.RESPONSE_BYTES.value() == before_out + 3
+        assert metrics.STAGE_SECONDS.count(stage="send") == before_send + 1
+
+    def test_leaves_other_paths_alone(self):
+        """Test that only API requests are measured"""
+
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"abc"})
+
+        before_out = metrics.RESPONSE_BYTES.value()
+        messages = self._call(app, path="/metrics")
+
+        assert messages[0]["headers"] == []
+        assert metrics.RESPONSE_BYTES.value() == before_out
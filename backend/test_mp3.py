@@ -0,0 +1,287 @@
+"""
+Tests for the FFmpeg conversion and ID3 tagging helpers.
+"""
+
+import io
+import os
+import shutil
+import struct
+import time
+import wave
+
+import pytest
+from fastapi import HTTPException
+from mutagen.id3 import COMM, ID3
+from mutagen.mp3 import MP3
+
+from backend import mp3
+
+COVER_PATH = os.path.join(os.path.dirname(__file__), "..", "media", "default_cover.jpg")
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+@pytest.fixture
+def tags():
+    return dict(
+        title="Episode 1 - Show",
+        album="My Podcast",
+        artist="Jane",
+        album_artist="Studio",
+        year="2026",
+        genre="Podcast",
+        cover_path=COVER_PATH,
+        cover_mime="image/jpeg",
+    )
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    path = str(tmp_path / "input")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(b"".join(struct.pack("<h", (i % 100) * 300) for i in range(44100)))
+    return path
+
+
+class TestFfmpegTagArgs:
+    """Test the ffmpeg arguments used for single-pass tagging"""
+
+    def test_maps_all_frames_and_cover(self, tags):
+        args = mp3.ffmpeg_tag_args(**tags)
+
+        assert args[:2] == ["-i", COVER_PATH]
+        assert args[args.index("-id3v2_version") + 1] == "3"
+        assert "title=Episode 1 - Show" in args
+        assert "album_artist=Studio" in args
+        assert "date=2026" in args
+        assert "comment=Cover (front)" in args
+
+    def test_skips_empty_optional_values(self, tags):
+        tags.update(year=None, genre="")
+        args = mp3.ffmpeg_tag_args(**tags)
+
+        assert not any(a.startswith("date=") or a.startswith("genre=") for a in args)
+
+
+class TestId3HeaderFromFrames:
+    """Test merging pre-serialized shared frames with per-episode ones"""
+
+    def test_same_frames_as_building_the_whole_tag(self, tags):
+        with open(COVER_PATH, "rb") as f:
+            cover_data = f.read()
+        static = mp3.static_id3_frames(
+            album=tags["album"], album_artist=tags["album_artist"], genre=tags["genre"],
+            cover_data=cover_data, cover_mime="image/jpeg",
+        )
+        header = mp3.id3_header_from_frames(static, title=tags["title"], artist=tags["artist"], year=tags["year"])
+
+        merged = ID3(io.BytesIO(header))
+        whole = ID3(io.BytesIO(mp3.build_id3_header(**tags)))
+        assert merged.version[:2] == (2, 3)
+        assert merged.size == len(header)
+        assert sorted(merged.keys()) == sorted(whole.keys())
+        assert all(merged[key] == whole[key] for key in whole.keys())
+
+
+@requires_ffmpeg
+class TestConvertAndTag:
+    """Test that both tagging modes produce the same ID3 frames"""
+
+    @pytest.mark.parametrize("mode", ["ffmpeg", "mutagen"])
+    def test_tags_written(self, monkeypatch, tmp_path, wav_path, tags, mode):
+        monkeypatch.setenv("TAG_MODE", mode)
+        out = str(tmp_path / "output.mp3")
+
+        mp3.convert_and_tag(wav_path, out, **tags)
+
+        id3 = ID3(out)
+        assert id3.version[:2] == (2, 3)
+        assert str(id3.get("TIT2")) == "Episode 1 - Show"
+        assert str(id3.get("TALB")) == "My Podcast"
+        assert str(id3.get("TPE1")) == "Jane"
+        assert str(id3.get("TPE2")) == "Studio"
+        assert str(id3.get("TDRC")) == "2026"
+        assert str(id3.get("TCON")) == "Podcast"
+        cover = id3.get("APIC:Cover")
+        assert cover is not None
+        assert cover.type == 3
+        assert cover.mime == "image/jpeg"
+        with open(COVER_PATH, "rb") as f:
+            assert cover.data == f.read()
+
+
+@requires_ffmpeg
+class TestStreamMp3:
+    """Test encoding straight to a pipe"""
+
+    def test_header_plus_frames_is_a_tagged_mp3(self, tmp_path, wav_path, tags):
+        header = mp3.build_id3_header(**tags)
+        frames = b"".join(mp3.stream_mp3(wav_path, str(tmp_path), chunk_size=4096))
+
+        assert header[:3] == b"ID3"
+        assert frames[:3] != b"ID3"
+        out = tmp_path / "joined.mp3"
+        out.write_bytes(header + frames)
+        assert MP3(str(out)).info.length > 0
+        assert str(ID3(str(out)).get("TIT2")) == "Episode 1 - Show"
+
+    def test_undecodable_input_raises(self, tmp_path):
+        bogus = tmp_path / "input"
+        bogus.write_bytes(b"not audio at all" * 100)
+
+        with pytest.raises(HTTPException) as exc_info:
+            next(mp3.stream_mp3(str(bogus), str(tmp_path)))
+        assert exc_info.value.status_code == 400
+
+    def test_closing_early_kills_ffmpeg(self, monkeypatch, tmp_path, wav_path):
+        started = []
+        real_popen = mp3.subprocess.Popen
+
+        def recording_popen(*args, **kwargs):
+            started.append(real_popen(*args, **kwargs))
+            return started[-1]
+
+        monkeypatch.setattr(mp3.subprocess, "Popen", recording_popen)
+        frames = mp3.stream_mp3(wav_path, str(tmp_path), chunk_size=512)
+        next(frames)
+        frames.close()
+
+        assert started[0].poll() is not None
+
+    def test_slow_consumer_doesnt_count_against_the_timeout(self, tmp_path):
+        # A minute of audio: more MP3 than the pipe buffer, so ffmpeg waits for the reader
+        path = str(tmp_path / "long")
+        with wave.open(path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(b"".join(struct.pack("<h", (i % 100) * 300) for i in range(100)) * 441 * 60)
+        received = []
+        for chunk in mp3.stream_mp3(path, str(tmp_path), timeout_s=1):
+            received.append(chunk)
+            if len(received) <= 3:
+                time.sleep(0.5)
+
+        assert b"".join(received) == b"".join(mp3.stream_mp3(path, str(tmp_path)))
+
+
+@requires_ffmpeg
+class TestConvertPipe:
+    """Test encoding input fed to ffmpeg's stdin"""
+
+    def test_encodes_chunks(self, tmp_path, wav_path):
+        out = str(tmp_path / "out.mp3")
+        with open(wav_path, "rb") as f:
+            data = f.read()
+
+        mp3.convert_pipe(iter([data[:1000], data[1000:]]), out, str(tmp_path))
+
+        assert MP3(out).info.length == pytest.approx(1.0, abs=0.1)
+
+    def test_times_out_once_the_input_is_complete(self, tmp_path, wav_path):
+        # -re reads the input in real time, so one second of audio takes a second
+        process = mp3.warm.EncoderProcess(
+            ["ffmpeg", "-y", "-re", "-i", "pipe:0", "-f", "null"], "-", str(tmp_path / "ffmpeg.log")
+        )
+        with open(wav_path, "rb") as f:
+            chunks = iter([f.read()])
+
+        with pytest.raises(HTTPException) as exc_info:
+            mp3._feed(process, chunks, "-", timeout_s=0.2)
+        assert exc_info.value.status_code == 504
+        assert process.proc.poll() is not None
+
+
+@requires_ffmpeg
+class TestProgress:
+    """Test percent-done reporting from ffmpeg -progress output"""
+
+    def test_reports_increasing_percentages(self, tmp_path):
+        path = str(tmp_path / "long.wav")
+        with wave.open(path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(8000)
+            w.writeframes(b"".join(struct.pack("<h", (i % 50) * 500) for i in range(8000 * 30)))
+        seen = []
+
+        mp3.convert_to_mp3(path, str(tmp_path / "out.mp3"), on_progress=seen.append)
+
+        assert seen
+        assert seen == sorted(seen)
+        assert all(0 <= p < 100 for p in seen)
+
+
+@requires_ffmpeg
+class TestRetag:
+    """Test replacing the ID3 tag without touching the audio frames"""
+
+    @pytest.fixture
+    def tagged(self, tmp_path, wav_path, tags):
+        path = str(tmp_path / "tagged.mp3")
+        mp3.convert_to_mp3(wav_path, path, ["-vn", "-id3v2_version", "0"])
+        mp3.write_id3_tags(path, **tags)
+        return path
+
+    def _audio(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        return data[mp3.id3_tag_size(data[:10]):]
+
+    def test_written_tags_have_padding(self, tagged):
+        id3 = ID3(tagged)
+        assert id3.size - 10 >= mp3.ID3_PADDING
+
+    def test_in_place(self, tagged, tags):
+        audio = self._audio(tagged)
+        size = os.path.getsize(tagged)
+        tags.update(title="Episode 1 (fixed) - Show", artist="Jane Doe")
+
+        assert mp3.retag(tagged, **tags) == (b"", 0)
+
+        assert os.path.getsize(tagged) == size
+        assert self._audio(tagged) == audio
+        id3 = ID3(tagged)
+        assert str(id3["TIT2"]) == "Episode 1 (fixed) - Show"
+        assert str(id3["TPE1"]) == "Jane Doe"
+
+    def test_other_frames_are_kept(self, tagged, tags):
+        id3 = ID3(tagged)
+        id3.add(COMM(encoding=3, lang="eng", desc="", text="Keep me"))
+        id3.save(tagged, v2_version=3, padding=lambda info: mp3.ID3_PADDING)
+
+        mp3.retag(tagged, **tags)
+
+        assert str(ID3(tagged).getall("COMM")[0]) == "Keep me"
+
+    def test_too_large_for_the_padding(self, tmp_path, wav_path, tags):
+        # FFmpeg leaves next to no padding
+        path = str(tmp_path / "ffmpeg.mp3")
+        mp3.convert_and_tag(wav_path, path, **tags)
+        audio = self._audio(path)
+        tags.update(title="A much longer title " * 10)
+
+        header, audio_start = mp3.retag(path, **tags)
+
+        with open(path, "rb") as f:
+            assert header and audio_start == mp3.id3_tag_size(f.read(10))
+        streamed = b"".join(mp3.stream_with_header(path, header, audio_start, chunk_size=1000))
+        mp3.rewrite_with_header(path, header, audio_start)
+        with open(path, "rb") as f:
+            assert f.read() == streamed
+        assert self._audio(path) == audio
+        assert str(ID3(path)["TIT2"]) == tags["title"]
+        # The rewritten tag has room for the next one
+        assert mp3.retag(path, **tags) == (b"", 0)
+
+    def test_untagged_file(self, tmp_path, wav_path, tags):
+        path = str(tmp_path / "bare.mp3")
+        mp3.convert_to_mp3(wav_path, path, ["-vn", "-id3v2_version", "0"])
+
+        header, audio_start = mp3.retag(path, **tags)
+
+        assert audio_start == 0
+        assert ID3(io.BytesIO(header))["TIT2"] == ID3(io.BytesIO(mp3.build_id3_header(**tags)))["TIT2"]
@@ -0,0 +1,87 @@
+"""
+Tests for waveform peaks and the PCM tap they are computed from.
+"""
+
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from backend import encoders, mp3, peaks
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+def _naive(samples: np.ndarray, samples_per_pixel: int) -> np.ndarray:
+    pairs = []
+    for start in range(0, len(samples), samples_per_pixel):
+        bucket = samples[start:start + samples_per_pixel]
+        pairs += [bucket.min() >> 8, bucket.max() >> 8]
+    return np.array(pairs, dtype=np.int8)
+
+
+class TestPeaksBuilder:
+    """Test the min/max reduction at every zoom level"""
+
+    def test_matches_a_plain_loop(self):
+        samples = np.random.default_rng(1).integers(-32768, 32768, 10_001, dtype=np.int16)
+        builder = peaks.PeaksBuilder()
+        data = samples.astype("<i2").tobytes()
+        # Pieces that split buckets and samples
+        for start in range(0, len(data), 777):
+            builder.feed(data[start:start + 777])
+
+        levels = builder.finish()
+
+        assert list(levels) == list(peaks.LEVELS)
+        for samples_per_pixel, pairs in levels.items():
+            assert np.array_equal(pairs, _naive(samples, samples_per_pixel))
+
+    def test_no_audio(self):
+        levels = peaks.PeaksBuilder().finish()
+        assert all(len(pairs) == 0 for pairs in levels.values())
+
+
+class TestFileFormat:
+    """Test the audiowaveform .dat files"""
+
+    def test_round_trip(self, tmp_path):
+        pairs = np.array([-3, 5, -128, 127], dtype=np.int8)
+        peaks.save({512: pairs}, str(tmp_path))
+
+        data = (tmp_path / "peaks-512.dat").read_bytes()
+
+        assert len(data) == 20 + 4
+        samples_per_pixel, decoded = peaks.decode(data)
+        assert samples_per_pixel == 512
+        assert np.array_equal(decoded, pairs)
+
+
+@requires_ffmpeg
+class TestPeaksTap:
+    """Test peaks tapped from an encode"""
+
+    def test_same_run_as_the_encode(self, tmp_path):
+        wav = str(tmp_path / "input.wav")
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=2", "-f", "wav", wav],
+            check=True,
+        )
+        out = str(tmp_path / "out.mp3")
+        tap = peaks.PeaksTap()
+        tap.start()
+        try:
+            mp3.convert_outputs(wav, [(encoders.EncoderProfile("default", quality=2).args(), out), tap.output()], pass_fds=tap.pass_fds)
+        finally:
+            tap.close()
+        levels = tap.finish()
+
+        # Two seconds at 8 kHz
+        assert len(levels[2048]) == 2 * 8
+        assert len(levels[32]) == 2 * 500
+        # A sine at ffmpeg's default 1/8 amplitude
+        assert 10 <= levels[32][1::2].max() <= 20
+        assert -20 <= levels[32][0::2].min() <= -10
+        assert os.path.getsize(out) > 0
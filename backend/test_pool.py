@@ -0,0 +1,138 @@
+"""
+Tests for the bounded conversion worker pool.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from backend.pool import ConversionPool
+
+
+class TestConversionPool:
+    """Test that blocking work is offloaded and bounded"""
+
+    def test_runs_blocking_work_off_the_event_loop(self):
+        """Test that the event loop keeps running while a job blocks"""
+        pool = ConversionPool(workers=1, queue_depth=0)
+        release = threading.Event()
+
+        async def scenario():
+            job = asyncio.ensure_future(pool.run(release.wait, 5))
+            await asyncio.sleep(0.01)
+            # The loop is still responsive while the worker thread blocks
+            assert not job.done()
+            release.set()
+            return await job
+
+        assert asyncio.run(scenario()) is True
+        assert pool.pending == 0
+        pool.shutdown()
+
+    def test_rejects_with_503_when_queue_full(self):
+        """Test that requests beyond workers + queue depth get 503 with Retry-After"""
+        pool = ConversionPool(workers=1, queue_depth=1, retry_after_s=7)
+        release = threading.Event()
+
+        async def scenario():
+            jobs = [asyncio.ensure_future(pool.run(release.wait, 5)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            with pytest.raises(HTTPException) as exc_info:
+                await pool.run(release.wait, 5)
+            release.set()
+            await asyncio.gather(*jobs)
+            return exc_info.value
+
+        error = asyncio.run(scenario())
+        assert error.status_code == 503
+        assert error.headers["Retry-After"] == "7"
+        assert pool.pending == 0
+        pool.shutdown()
+
+    def test_bulk_work_waits_for_an_idle_worker(self):
+        """Test that execute_when_idle neither takes a queue slot nor fails with 503"""
+        pool = ConversionPool(workers=1, queue_depth=1)
+        release = threading.Event()
+
+        async def scenario():
+            busy = asyncio.ensure_future(pool.run(release.wait, 5))
+            await asyncio.sleep(0.01)
+            bulk = asyncio.ensure_future(pool.execute_when_idle(lambda: "bulk", poll_s=0.01))
+            await asyncio.sleep(0.05)
+            # Still waiting, so the queue slot is free for an interactive request
+            assert not bulk.done()
+            assert pool.pending == 1
+            release.set()
+            await busy
+            return await asyncio.wrap_future(await bulk)
+
+        assert asyncio.run(scenario()) == "bulk"
+        pool.shutdown()
+
+    def test_exceptions_propagate_and_free_the_slot(self):
+        """Test that a failing job re-raises and does not leak a slot"""
+        pool = ConversionPool(workers=1, queue_depth=0)
+
+        def boom():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            asyncio.run(pool.run(boom))
+        assert pool.pending == 0
+        pool.shutdown()
+
+
+class TestConversionPoolStream:
+    """Test driving a generator on the pool"""
+
+    def test_streams_items_and_frees_the_slot(self):
+        """Test that all items arrive in order and the slot is released at the end"""
+        pool = ConversionPool(workers=1, queue_depth=0)
+
+        async def scenario():
+            chunks = await pool.stream(lambda: iter([b"a", b"b", b"c"]))
+            return [chunk async for chunk in chunks]
+
+        assert asyncio.run(scenario()) == [b"a", b"b", b"c"]
+        time.sleep(0.05)
+        assert pool.pending == 0
+        pool.shutdown()
+
+    def test_setup_errors_raise_before_streaming(self):
+        """Test that an error before the first item is raised by stream() itself"""
+        pool = ConversionPool(workers=1, queue_depth=0)
+
+        def failing():
+            raise HTTPException(status_code=400, detail="bad input")
+            yield b""
+
+        with pytest.raises(HTTPException):
+            asyncio.run(pool.stream(failing))
+        pool.shutdown()
+
+    def test_stopping_early_closes_the_generator(self):
+        """Test that a consumer going away closes the producing generator"""
+        pool = ConversionPool(workers=1, queue_depth=0)
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield b"x"
+            finally:
+                closed.set()
+
+        async def scenario():
+            chunks = await pool.stream(endless, buffer=2)
+            async for _ in chunks:
+                break
+            await chunks.aclose()
+
+        asyncio.run(scenario())
+        assert closed.wait(2)
+        time.sleep(0.05)
+        assert pool.pending == 0
+        pool.shutdown()
@@ -0,0 +1,122 @@
+"""
+Tests for sniffing and probing uploads before they are converted.
+"""
+
+import io
+import shutil
+import subprocess
+import wave
+
+import pytest
+from fastapi import HTTPException
+
+from backend import loudness, mp3, probe
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+def _wav(seconds: float, sample_rate: int = 48000, channels: int = 2) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(b"\0" * int(seconds * sample_rate) * 2 * channels)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def limits(monkeypatch, tmp_path):
+    monkeypatch.setenv("INPUT_MAX_DURATION", "60")
+    monkeypatch.setenv("INPUT_MAX_BYTES", "1000")
+    monkeypatch.setenv("ANALYSIS_CACHE_DIR", str(tmp_path / "analysis"))
+    probe.configure()
+    loudness.configure()
+    yield
+    monkeypatch.undo()
+    probe.configure()
+
+
+class TestSniff:
+    """Test what is learned from the first bytes alone"""
+
+    def test_wav_header(self):
+        info = probe.sniff(_wav(2.5)[:4096], "take.wav")
+        assert info == {"format": "wav", "channels": 2, "sample_rate": 48000, "duration": 2.5}
+
+    @pytest.mark.parametrize("head,name", [
+        (b"\xff\xd8\xff\xe0\x00\x10JFIF", "JPEG"),
+        (b"\x89PNG\r\n\x1a\n\x00\x00", "PNG"),
+        (b"%PDF-1.7\n", "PDF"),
+        (b"<!doctype html><html>", "HTML"),
+    ])
+    def test_not_audio(self, head, name):
+        with pytest.raises(HTTPException) as e:
+            probe.sniff(head, "episode.wav")
+        assert e.value.status_code == 415
+        assert name in e.value.detail
+
+    @pytest.mark.parametrize("head,expected", [
+        (b"ID3\x04\x00\x00\x00\x00\x00\x00", "mp3"),
+        (b"\xff\xfb\x90\x64\x00\x00", "mpeg"),
+        (b"OggS\x00\x02\x00\x00", "ogg"),
+        (b"\x00\x00\x00\x20ftypM4A ", "mp4"),
+        (b"FORM\x00\x00\x00\x00AIFF", "aiff"),
+        (b"\x00\x01\x02\x03", None),
+    ])
+    def test_formats(self, head, expected):
+        assert probe.sniff(head)["format"] == expected
+
+    def test_too_long_from_the_header(self, limits):
+        # The header announces a length far beyond what was uploaded
+        head = bytearray(_wav(0.1))
+        head[40:44] = (48000 * 4 * 3600).to_bytes(4, "little")
+        with pytest.raises(HTTPException) as e:
+            probe.sniff(bytes(head), "long.wav")
+        assert e.value.status_code == 422
+        assert "60 minutes" in e.value.detail
+
+    def test_size(self, limits):
+        probe.check_size(1000)
+        with pytest.raises(HTTPException) as e:
+            probe.check_size(1001)
+        assert e.value.status_code == 413
+
+
+@requires_ffmpeg
+class TestProbeFile:
+    """Test the ffmpeg probe of a received input"""
+
+    def test_flac_header_matches_ffmpeg(self, tmp_path):
+        path = str(tmp_path / "take.flac")
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=sample_rate=22050:duration=3", "-ac", "1", path],
+            check=True,
+        )
+        with open(path, "rb") as f:
+            sniffed = probe.sniff(f.read(4096))
+
+        probed = probe.probe_file(path)
+        assert (sniffed["format"], sniffed["sample_rate"], sniffed["channels"]) == ("flac", 22050, 1)
+        assert sniffed["duration"] == pytest.approx(3.0)
+        assert probed["codec"] == "flac"
+        assert probed["duration"] == pytest.approx(3.0, abs=0.05)
+
+    def test_cached_by_content_hash(self, limits, tmp_path, monkeypatch):
+        path = tmp_path / "take.wav"
+        path.write_bytes(_wav(1))
+        first = probe.probe_file(str(path), "abc")
+
+        monkeypatch.setattr(mp3, "probe", lambda *args: pytest.fail("probed twice"))
+        assert probe.probe_file(str(path), "abc") == first
+
+    def test_no_audio(self, tmp_path):
+        path = tmp_path / "notes.wav"
+        path.write_bytes(b"not audio" * 100)
+        with pytest.raises(HTTPException) as e:
+            probe.probe_file(str(path))
+        assert e.value.status_code == 415
+
+    def test_timeout_scales_with_duration(self):
+        assert probe.timeout_for(None) == 60
+        assert probe.timeout_for({"duration": 3 * 3600}) == 60 + 3 * 3600 // 2
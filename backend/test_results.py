@@ -0,0 +1,71 @@
+"""
+Tests for keeping finished outputs for resumed downloads.
+"""
+
+import os
+import time
+
+import pytest
+
+from backend import results
+
+
+@pytest.fixture
+def store(tmp_path):
+    return results.ResultStore(str(tmp_path / "results"), retention_s=60)
+
+
+def _add(store, data: bytes = b"episode") -> str:
+    result_id, partial = store.create()
+    with open(partial, "wb") as f:
+        f.write(data)
+    store.commit(result_id, "audio/mpeg", {"Content-Disposition": 'attachment; filename="a.mp3"'})
+    return result_id
+
+
+def _age(store, result_id: str, seconds: float) -> None:
+    then = time.time() - seconds
+    directory = os.path.join(store.root, result_id)
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name), (then, then))
+    os.utime(directory, (then, then))
+
+
+class TestResultStore:
+    """Test storing, finding and evicting results"""
+
+    def test_committed_result_is_found(self, store):
+        result_id = _add(store)
+
+        result = store.get(result_id)
+
+        assert result["media_type"] == "audio/mpeg"
+        assert result["headers"]["Content-Disposition"] == 'attachment; filename="a.mp3"'
+        with open(result["path"], "rb") as f:
+            assert f.read() == b"episode"
+
+    def test_uncommitted_result_is_not_found(self, store):
+        result_id, _ = store.create()
+        assert store.get(result_id) is None
+
+    @pytest.mark.parametrize("result_id", ["nope", "../results", ""])
+    def test_unknown_ids(self, store, result_id):
+        assert store.get(result_id) is None
+
+    def test_expired_results_are_swept(self, store):
+        old, fresh = _add(store), _add(store)
+        _age(store, old, 120)
+
+        assert store.get(old) is None
+        assert store.sweep() == 1
+
+        assert not os.path.exists(os.path.join(store.root, old))
+        assert store.get(fresh) is not None
+
+    def test_without_retention_only_orphans_are_swept(self, tmp_path):
+        store = results.ResultStore(str(tmp_path / "results"), retention_s=0)
+        sending, crashed = _add(store), _add(store)
+        _age(store, crashed, 2 * 3600)
+
+        assert store.sweep() == 1
+        assert os.path.exists(os.path.join(store.root, sending))
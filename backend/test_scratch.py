@@ -0,0 +1,148 @@
+"""
+Tests for the managed scratch space.
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from backend import scratch
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def space(tmp_path):
+    return scratch.ScratchSpace(
+        str(tmp_path / "fast"),
+        str(tmp_path / "disk"),
+        spill_bytes=1 * MB,
+        fast_max_bytes=4 * MB,
+        max_bytes=10 * MB,
+        wait_s=1,
+        poll_s=0.01,
+    )
+
+
+def _dead_pid() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+class TestPlacement:
+    """Test that small uploads go to the fast root and large ones spill"""
+
+    def test_small_upload_on_fast_root(self, space):
+        path = space.try_acquire(100_000)
+
+        assert os.path.dirname(path) == space.roots[scratch.FAST]
+        assert space.reserved_on(scratch.FAST) == 200_000
+
+    def test_large_upload_spills_to_disk(self, space):
+        path = space.try_acquire(2 * MB)
+
+        assert os.path.dirname(path) == space.roots[scratch.DISK]
+
+    def test_unknown_size_spills_to_disk(self, space):
+        path = space.try_acquire(None)
+
+        assert os.path.dirname(path) == space.roots[scratch.DISK]
+
+    def test_spills_once_fast_root_is_full(self, space):
+        placed = [os.path.dirname(space.try_acquire(MB)) for _ in range(3)]
+
+        assert placed == [space.roots[scratch.FAST], space.roots[scratch.FAST], space.roots[scratch.DISK]]
+
+    def test_release_removes_and_returns_bytes(self, space):
+        path = space.try_acquire(MB)
+        with open(os.path.join(path, "input"), "wb") as f:
+            f.write(b"x" * 1000)
+
+        space.release(path)
+
+        assert not os.path.exists(path)
+        assert space.reserved == 0
+
+
+class TestBudget:
+    """Test backpressure once the byte budget is handed out"""
+
+    def test_none_when_full(self, space):
+        assert space.try_acquire(4 * MB) is not None
+        assert space.try_acquire(2 * MB) is None
+
+    def test_too_large_for_budget(self, space):
+        with pytest.raises(HTTPException) as exc_info:
+            space.try_acquire(6 * MB)
+        assert exc_info.value.status_code == 413
+
+    def test_waits_for_space(self, space):
+        held = space.try_acquire(4 * MB)
+        threading.Timer(0.1, space.release, (held,)).start()
+
+        path = asyncio.run(space.acquire(4 * MB))
+
+        assert os.path.isdir(path)
+
+    def test_503_after_waiting(self, space):
+        space.wait_s = 0.05
+        space.try_acquire(4 * MB)
+
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(space.acquire(4 * MB))
+        assert exc_info.value.status_code == 503
+        assert "Retry-After" in exc_info.value.headers
+
+    def test_no_budget(self, space):
+        space.max_bytes = 0
+
+        assert all(space.try_acquire(4 * MB) for _ in range(5))
+
+
+class TestSweep:
+    """Test that directories of crashed workers are removed"""
+
+    def test_removes_directories_of_dead_processes(self, space):
+        orphan = os.path.join(space.roots[scratch.DISK], f"job-{_dead_pid()}-{'0' * 32}")
+        os.mkdir(orphan)
+        with open(os.path.join(orphan, "input"), "wb") as f:
+            f.write(b"x" * 5000)
+
+        assert space.sweep() == 5000
+        assert not os.path.exists(orphan)
+
+    def test_keeps_live_directories(self, space):
+        mine = space.try_acquire(1000)
+        other = os.path.join(space.roots[scratch.FAST], f"job-{os.getppid()}-{'1' * 32}")
+        unrelated = os.path.join(space.roots[scratch.FAST], "something-else")
+        os.mkdir(other)
+        os.mkdir(unrelated)
+
+        space.sweep()
+
+        assert os.path.isdir(mine) and os.path.isdir(other) and os.path.isdir(unrelated)
+
+    def test_removes_own_forgotten_directories(self, space):
+        forgotten = os.path.join(space.roots[scratch.FAST], f"job-{os.getpid()}-{'2' * 32}")
+        os.mkdir(forgotten)
+        os.utime(forgotten, (0, 0))
+
+        space.sweep()
+
+        assert not os.path.exists(forgotten)
+
+    def test_removes_directories_past_max_age(self, space):
+        space.orphan_age_s = 10
+        stale = space.try_acquire(1000)
+        os.utime(stale, (0, 0))
+
+        space.sweep()
+
+        assert not os.path.exists(stale)
+        assert space.reserved == 0
@@ -0,0 +1,140 @@
+"""
+Tests for encoding long inputs in segments and joining them gaplessly.
+"""
+
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from backend import encoders, mp3, segmented
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+class TestPlan:
+    """Test where the audio is cut"""
+
+    def test_cuts_land_in_pauses_on_frame_boundaries(self):
+        rate = 44100
+        pcm = np.full((20 * rate, 2), 8000, dtype=np.int16)
+        # Silence around 9.5s, inside the search window of the 10s target
+        pcm[int(9.4 * rate):int(9.6 * rate)] = 0
+
+        cuts = segmented.plan(pcm, rate, 10, search_s=2)
+
+        assert len(cuts) == 1
+        assert cuts[0] % 1152 == 0
+        assert 9.4 <= cuts[0] / rate <= 9.6
+
+    def test_depends_only_on_the_audio(self):
+        pcm = np.random.default_rng(3).integers(-3000, 3000, (60 * 22050, 1), dtype=np.int16)
+
+        cuts = segmented.plan(pcm, 22050, 10, search_s=2)
+
+        assert cuts == segmented.plan(pcm.copy(), 22050, 10, search_s=2)
+        assert all(cut % 576 == 0 for cut in cuts)
+        assert cuts == sorted(set(cuts))
+        assert len(cuts) == 5
+
+    def test_short_audio_is_not_cut(self):
+        assert segmented.plan(np.zeros((44100, 2), dtype=np.int16), 44100, 10) == []
+
+
+@requires_ffmpeg
+class TestEncode:
+    """Test a segmented encode against the audio it came from"""
+
+    SECONDS = 12
+
+    @pytest.fixture
+    def wav(self, tmp_path):
+        path = str(tmp_path / "input.wav")
+        # A tone that pauses every three seconds
+        subprocess.run(
+            [
+                "ffmpeg", "-y", "-v", "error", "-f", "lavfi",
+                "-i", f"sine=frequency=440:sample_rate=44100:duration={self.SECONDS}",
+                "-af", "volume='if(lt(mod(t,3),0.5),0,1)':eval=frame", "-ac", "2", path,
+            ],
+            check=True,
+        )
+        return path
+
+    def _encode(self, wav, tmp_path, workers):
+        out = str(tmp_path / f"out-{workers}.mp3")
+        encoder = encoders.EncoderProfile("default", quality=2).args()
+        with ThreadPoolExecutor(workers) as executor:
+            cuts = segmented.encode(wav, out, str(tmp_path), mp3.probe(wav), encoder, segment_s=2, executor=executor)
+        return cuts, out
+
+    def test_gapless_and_sample_exact(self, wav, tmp_path):
+        cuts, out = self._encode(wav, tmp_path, 3)
+
+        assert len(cuts) >= 4
+        decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", out, "-f", "s16le", "-"], capture_output=True, check=True)
+        assert decoded.stderr == b""
+        # The LAME tag's delay and padding trim the joined stream to the input's length
+        assert len(decoded.stdout) == self.SECONDS * 44100 * 2 * 2
+
+        original = subprocess.run(["ffmpeg", "-v", "error", "-i", wav, "-f", "s16le", "-"], capture_output=True, check=True)
+        a = np.frombuffer(original.stdout, "<i2").astype(float)
+        b = np.frombuffer(decoded.stdout, "<i2").astype(float)
+        # No click or shift at the joins: the error stays at the codec's level throughout
+        assert 10 * np.log10((a ** 2).sum() / ((a - b) ** 2).sum()) > 40
+
+    def test_same_bytes_for_any_number_of_workers(self, wav, tmp_path):
+        cuts, out = self._encode(wav, tmp_path, 1)
+        parallel_cuts, parallel_out = self._encode(wav, tmp_path, 4)
+
+        assert cuts == parallel_cuts
+        with open(out, "rb") as f, open(parallel_out, "rb") as g:
+            assert f.read() == g.read()
+
+    def test_frames_are_parsed(self, wav, tmp_path):
+        _, out = self._encode(wav, tmp_path, 2)
+        with open(out, "rb") as f:
+            data = f.read()
+
+        offsets = segmented.frame_offsets(data)
+
+        # 12s of 1152-sample frames plus the Xing frame, delay and padding
+        assert len(offsets) == 1 + -(-(self.SECONDS * 44100 + segmented.ENCODER_DELAY) // 1152) + 1
+        with pytest.raises(ValueError):
+            segmented.frame_offsets(b"\0" * 8)
+        # Free format (no length in the header) and an invalid bitrate
+        for header in (b"\xff\xfb\x00\x00", b"\xff\xfb\xf0\x00"):
+            with pytest.raises(ValueError):
+                segmented.frame_offsets(header * 4)
+
+    def test_unjoinable_segments_fall_back_to_one_encode(self, wav, tmp_path, monkeypatch):
+        def no_frames(data):
+            raise ValueError("no MP3 frame at byte 0")
+
+        monkeypatch.setattr(segmented, "frame_offsets", no_frames)
+        cuts, out = self._encode(wav, tmp_path, 2)
+
+        assert cuts == []
+        decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", out, "-f", "s16le", "-"], capture_output=True, check=True)
+        assert len(decoded.stdout) == self.SECONDS * 44100 * 2 * 2
+        assert sorted(os.listdir(tmp_path)) == sorted(["input.wav", os.path.basename(out)])
+
+    def test_short_segment_falls_back_to_one_encode(self, wav, tmp_path, monkeypatch):
+        encode_segment = segmented._encode_segment
+
+        def truncated(pcm_path, rate, channels, start, end, encoder, out, timeout_s):
+            encode_segment(pcm_path, rate, channels, start, end, encoder, out, timeout_s)
+            if start == 0:
+                # Lose the first segment's last frames
+                with open(out, "r+b") as f:
+                    f.truncate(os.path.getsize(out) // 2)
+
+        monkeypatch.setattr(segmented, "_encode_segment", truncated)
+        cuts, out = self._encode(wav, tmp_path, 2)
+
+        assert cuts == []
+        decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", out, "-f", "s16le", "-"], capture_output=True, check=True)
+        assert len(decoded.stdout) == self.SECONDS * 44100 * 2 * 2
@@ -0,0 +1,96 @@
+"""
+Tests for the forking production server.
+"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _ready(port: int, timeout_s: float = 20) -> dict:
+    deadline = time.monotonic() + timeout_s
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/ready", timeout=2) as response:
+                return json.load(response)
+        except OSError:
+            assert time.monotonic() < deadline, "server never became ready"
+            time.sleep(0.1)
+
+
+@pytest.fixture
+def server_env(tmp_path):
+    env = dict(
+        os.environ, HOST="127.0.0.1", PORT=str(_free_port()), SERVER_WORKERS="2", SERVER_DRAIN_TIMEOUT="5",
+        JOBS_DIR=str(tmp_path / "jobs"), RESULTS_DIR=str(tmp_path / "results"),
+    )
+    env.pop("JOB_STORE", None)
+    # A file rather than a pipe, which would fill up and block the workers' logging
+    with open(tmp_path / "serve.log", "w+") as log:
+        yield env, log
+
+
+@pytest.fixture
+def server(server_env):
+    env, log = server_env
+    proc = subprocess.Popen([sys.executable, "-m", "backend.serve"], cwd=ROOT, env=env, stderr=log)
+    yield proc, int(env["PORT"]), log
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+@requires_ffmpeg
+class TestServe:
+    """Test the supervisor and its workers"""
+
+    def test_replaces_dead_workers_and_stops_cleanly(self, server):
+        proc, port, log = server
+        first = _ready(port)["pid"]
+
+        os.kill(first, signal.SIGKILL)
+        # Both the surviving worker and its replacement answer
+        pids = set()
+        deadline = time.monotonic() + 20
+        while len(pids) < 2:
+            assert time.monotonic() < deadline, f"only {pids} answered"
+            pids.add(_ready(port)["pid"])
+        assert first not in pids
+
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=15) == 0
+        log.seek(0)
+        log = log.read()
+        assert "Preloaded in" in log
+        # The two API workers and the replacement
+        assert log.count("ready after") == 3
+        assert "starting another" in log
+
+    def test_refuses_several_workers_with_the_memory_job_store(self, server_env):
+        env, log = server_env
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "backend.serve"], cwd=ROOT, env=dict(env, JOB_STORE="memory"), stderr=log
+        )
+        assert proc.wait(timeout=15) == 1
+        log.seek(0)
+        log = log.read()
+        assert "JOB_STORE=memory keeps jobs in one process" in log
+        assert "starting another" not in log
@@ -0,0 +1,178 @@
+"""
+Tests for resumable chunked uploads.
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+
+from backend import ingest, scratch, uploads
+
+
+@pytest.fixture
+def space(monkeypatch, tmp_path):
+    monkeypatch.setenv("SCRATCH_DIR", str(tmp_path / "fast"))
+    monkeypatch.setenv("SCRATCH_SPILL_DIR", str(tmp_path / "disk"))
+    return scratch.configure()
+
+
+@pytest.fixture
+def registry(space):
+    return uploads.UploadRegistry(expire_s=3600, max_chunk_bytes=1024, chunk_bytes=512, stall_s=1)
+
+
+def _create(registry, data: bytes, filename: str = "talk.wav") -> uploads.UploadSession:
+    return asyncio.run(registry.create(filename, len(data), {}))
+
+
+DATA = os.urandom(3000)
+
+
+class TestChecksumHeader:
+    """Test parsing Upload-Checksum"""
+
+    def test_sha256(self):
+        digest = hashlib.sha256(b"abc").digest()
+        assert uploads.parse_checksum("sha256 " + base64.b64encode(digest).decode()) == digest
+
+    @pytest.mark.parametrize("header", ["md5 AAAA", "sha256 not-base64!"])
+    def test_rejected(self, header):
+        with pytest.raises(HTTPException) as error:
+            uploads.parse_checksum(header)
+        assert error.value.status_code == 400
+
+
+class TestUploadSession:
+    """Test writing chunks in any order"""
+
+    def test_out_of_order_chunks(self, registry):
+        session = _create(registry, DATA)
+
+        session.write(2000, DATA[2000:])
+        assert session.offset == 0
+        assert session.missing() == [[0, 2000]]
+        session.write(0, DATA[:1000])
+        assert session.offset == 1000
+        assert session.missing() == [[1000, 2000]]
+        session.write(1000, DATA[1000:2000])
+
+        assert session.complete
+        assert session.missing() == []
+        assert session.sha256.hexdigest() == hashlib.sha256(DATA).hexdigest()
+        with open(session.path, "rb") as f:
+            assert f.read() == DATA
+
+    def test_repeated_chunk_is_harmless(self, registry):
+        session = _create(registry, DATA)
+        session.write(0, DATA[:1000])
+        session.write(0, DATA[:1000])
+        session.write(500, DATA[500:3000])
+
+        assert session.complete
+        assert session.sha256.hexdigest() == hashlib.sha256(DATA).hexdigest()
+
+    def test_checksum_mismatch(self, registry):
+        session = _create(registry, DATA)
+
+        with pytest.raises(HTTPException) as error:
+            session.write(0, DATA[:1000], hashlib.sha256(b"something else").digest())
+
+        assert error.value.status_code == 400
+        assert session.missing() == [[0, 3000]]
+        assert session.write(0, DATA[:1000], hashlib.sha256(DATA[:1000]).digest()) == 1000
+
+    def test_chunk_outside_the_file(self, registry):
+        session = _create(registry, DATA)
+        with pytest.raises(HTTPException) as error:
+            session.write(2500, DATA[:1000])
+        assert error.value.status_code == 400
+
+    def test_prefix_is_read_as_it_arrives(self, registry):
+        session = _create(registry, DATA)
+        session.write(0, DATA[:1000])
+        received = []
+
+        def consume():
+            for chunk in session.read_prefix(stall_s=5, chunk_size=700):
+                received.append(chunk)
+
+        reader = threading.Thread(target=consume)
+        reader.start()
+        time.sleep(0.05)
+        assert b"".join(received) == DATA[:1000]
+        session.write(2000, DATA[2000:])
+        session.write(1000, DATA[1000:2000])
+        reader.join(timeout=5)
+
+        assert b"".join(received) == DATA
+
+    def test_stalled_prefix_aborts(self, registry):
+        session = _create(registry, DATA)
+        session.write(0, DATA[:1000])
+
+        with pytest.raises(ingest.PipeAborted):
+            list(session.read_prefix(stall_s=0.05))
+
+
+class TestUploadRegistry:
+    """Test the lifetime of upload sessions"""
+
+    def test_scratch_space_is_reserved_and_released(self, registry, space):
+        session = _create(registry, DATA)
+        assert space.reserved == 2 * len(DATA)
+
+        registry.discard(session.id)
+
+        assert space.reserved == 0
+        assert not os.path.exists(session.dir)
+        with pytest.raises(HTTPException) as error:
+            registry.get(session.id)
+        assert error.value.status_code == 404
+
+    def test_detached_session_accepts_no_chunks(self, registry):
+        session = _create(registry, DATA)
+        registry.detach(session.id)
+
+        with pytest.raises(HTTPException) as error:
+            session.write(0, DATA[:1000])
+
+        assert error.value.status_code == 409
+        session.release()
+
+    def test_release_waits_for_the_encode(self, registry, space):
+        session = _create(registry, DATA)
+        session.write(0, DATA[:1000])
+        started = threading.Event()
+        result = {}
+
+        def encode():
+            started.set()
+            try:
+                list(session.read_prefix(stall_s=5))
+            except ingest.PipeAborted:
+                result["aborted"] = os.path.exists(session.path)
+
+        with ThreadPoolExecutor(1) as executor:
+            session.encode = executor.submit(encode)
+            started.wait()
+            registry.discard(session.id)
+
+        assert result == {"aborted": True}
+        assert space.reserved == 0
+
+    def test_idle_sessions_expire(self, space):
+        registry = uploads.UploadRegistry(expire_s=0.05, max_chunk_bytes=1024, chunk_bytes=512, stall_s=1)
+        session = _create(registry, DATA)
+        time.sleep(0.1)
+
+        with pytest.raises(HTTPException):
+            registry.get(session.id)
+        assert len(registry) == 0
+        assert space.reserved == 0
@@ -0,0 +1,181 @@
+"""
+Tests for the pool of pre-started FFmpeg encoders.
+"""
+
+import os
+import shutil
+import struct
+import time
+import wave
+
+import pytest
+
+from backend import mp3, warm
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+ARGS = mp3._pipe_args(None, None)
+
+
+def wait_for(condition, timeout_s=5.0):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    path = str(tmp_path / "input")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(b"".join(struct.pack("<h", (i % 100) * 300) for i in range(44100)))
+    return path
+
+
+@pytest.fixture
+def use_pool(monkeypatch):
+    created = []
+
+    def use(**kwargs):
+        created.append(warm.WarmPool(**kwargs))
+        monkeypatch.setattr(warm, "_pool", created[-1])
+        return created[-1]
+
+    yield use
+    for pool in created:
+        pool.shutdown()
+
+
+@requires_ffmpeg
+class TestWarmPool:
+    """Test that encoders are started ahead of time and replaced"""
+
+    def test_first_request_misses_then_warms(self):
+        pool = warm.WarmPool(size=2)
+        try:
+            assert pool.take(ARGS) is None
+            wait_for(lambda: pool.idle() == 2)
+            process = pool.take(ARGS)
+            assert process is not None and process.proc.poll() is None
+            assert process.proc.args == [*ARGS, process.output]
+            # The taken one is replaced
+            wait_for(lambda: pool.idle() == 2)
+            process.kill()
+        finally:
+            pool.shutdown()
+
+    def test_prewarm_starts_processes_up_front(self):
+        pool = warm.WarmPool(size=1)
+        try:
+            pool.prewarm(ARGS)
+            wait_for(lambda: pool.idle() == 1)
+        finally:
+            pool.shutdown()
+
+    def test_dead_processes_are_not_handed_out(self):
+        pool = warm.WarmPool(size=1, check_interval_s=60)
+        try:
+            pool.prewarm(ARGS)
+            wait_for(lambda: pool.idle() == 1)
+            dead = pool._idle[tuple(ARGS)][0]
+            dead.proc.kill()
+            dead.proc.wait()
+
+            assert pool.take(ARGS) is None
+            wait_for(lambda: pool.idle() == 1)
+            assert pool._idle[tuple(ARGS)][0] is not dead
+        finally:
+            pool.shutdown()
+
+    def test_idle_processes_are_recycled_after_max_age(self):
+        pool = warm.WarmPool(size=1, max_age_s=0.2, check_interval_s=0.05)
+        try:
+            pool.prewarm(ARGS)
+            wait_for(lambda: pool.idle() == 1)
+            first = pool._idle[tuple(ARGS)][0]
+            wait_for(lambda: pool.idle() == 1 and pool._idle[tuple(ARGS)][0] is not first)
+            assert first.proc.poll() is not None
+        finally:
+            pool.shutdown()
+
+    def test_least_recently_used_arguments_are_dropped(self):
+        pool = warm.WarmPool(size=1, max_keys=1)
+        other = mp3._pipe_args(None, ["-c:a", "libmp3lame", "-b:a", "64k"])
+        try:
+            pool.prewarm(ARGS)
+            wait_for(lambda: pool.idle() == 1)
+            process = pool._idle[tuple(ARGS)][0]
+            pool.prewarm(other)
+
+            assert list(pool._idle) == [tuple(other)]
+            assert process.proc.poll() is not None
+        finally:
+            pool.shutdown()
+
+    def test_shutdown_kills_idle_processes(self):
+        pool = warm.WarmPool(size=2)
+        pool.prewarm(ARGS)
+        wait_for(lambda: pool.idle() == 2)
+        processes = list(pool._idle[tuple(ARGS)])
+        pool.shutdown()
+
+        assert all(p.proc.poll() is not None for p in processes)
+        assert not os.path.exists(pool.root)
+
+    def test_disabled(self):
+        pool = warm.WarmPool(size=0)
+        pool.prewarm(ARGS)
+        assert pool.take(ARGS) is None
+        assert pool.idle() == 0
+        pool.shutdown()
+
+
+@requires_ffmpeg
+class TestWarmEncoding:
+    """Test that conversions use warm encoders and produce the same file"""
+
+    def test_same_frames_as_a_fresh_ffmpeg(self, use_pool, tmp_path, wav_path):
+        use_pool(size=0)
+        cold = str(tmp_path / "cold.mp3")
+        mp3.convert_untagged(wav_path, cold)
+
+        pool = use_pool(size=1)
+        pool.prewarm(ARGS)
+        wait_for(lambda: pool.idle() == 1)
+        hot = str(tmp_path / "hot.mp3")
+        mp3.convert_untagged(wav_path, hot)
+
+        with open(cold, "rb") as a, open(hot, "rb") as b:
+            assert a.read() == b.read()
+
+    def test_pipe_uses_warm_encoder(self, use_pool, tmp_path, wav_path):
+        pool = use_pool(size=1)
+        pool.prewarm(ARGS)
+        wait_for(lambda: pool.idle() == 1)
+        process = pool._idle[tuple(ARGS)][0]
+        out = str(tmp_path / "out.mp3")
+
+        with open(wav_path, "rb") as f:
+            mp3.convert_pipe(iter([f.read()]), out, str(tmp_path))
+
+        assert process.proc.returncode == 0
+        assert os.path.getsize(out) > 0
+        assert not os.path.exists(process.output)
+
+    def test_falls_back_to_a_fresh_ffmpeg(self, use_pool, monkeypatch, tmp_path, wav_path):
+        pool = use_pool(size=0)
+        broken = warm.EncoderProcess(
+            ["ffmpeg", "-y", "-f", "u8", "-i", "pipe:0", "-c:a", "no-such-codec"],
+            str(tmp_path / "broken.mp3"),
+            str(tmp_path / "broken.log"),
+        )
+        monkeypatch.setattr(pool, "take", lambda args: broken)
+        out = str(tmp_path / "out.mp3")
+
+        mp3.convert_untagged(wav_path, out)
+
+        assert broken.proc.returncode != 0
+        assert os.path.getsize(out) > 0
@@ -0,0 +1,261 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Iterator, Optional
+
+from fastapi import HTTPException
+
+from backend import ingest, log, scratch
+
+logger = log.getLogger(__name__)
+
+CHECKSUM_ALGORITHM = "sha256"
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+def parse_checksum(header: str) -> bytes:
+    """The digest from an `Upload-Checksum: sha256 <base64>` header."""
+    algorithm, _, encoded = header.strip().partition(" ")
+    if algorithm.lower() != CHECKSUM_ALGORITHM:
+        raise HTTPException(status_code=400, detail=f"Unsupported checksum algorithm: {algorithm}")
+    try:
+        return base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed Upload-Checksum header")
+
+
+class UploadSession:
+    """A file uploaded in chunks, written straight into its scratch directory.
+
+    Chunks may arrive in any order and more than once; `offset` is how much
+    of the file has been received without gaps. The SHA-256 of the file is
+    computed over that prefix as it grows, and read_prefix() lets an encoder
+    consume it while later chunks are still on their way.
+    """
+
+    def __init__(self, upload_id: str, workdir: str, filename: str, size: int, fields: dict):
+        self.id = upload_id
+        self.dir = workdir
+        self.path = os.path.join(workdir, "input")
+        self.filename = filename
+        self.size = size
+        self.fields = fields
+        self.sha256 = hashlib.sha256()
+        self.touched = time.monotonic()
+        # Options for an encode started on the prefix, None when it has to wait for the whole file
+        self.pipe_options: Optional[dict] = None
+        # What probe.sniff() made of the first bytes, once they have arrived
+        self.info: Optional[dict] = None
+        self.encode: Optional[Future] = None
+        self._ranges: list[list[int]] = []
+        self._offset = 0
+        self._hashed = 0
+        self._sealed = False
+        self._closed = False
+        self._writers = 0
+        self._cond = threading.Condition()
+        self._hash_lock = threading.Lock()
+        with open(self.path, "wb") as f:
+            f.truncate(size)
+        self._fd = os.open(self.path, os.O_RDWR)
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @property
+    def complete(self) -> bool:
+        return self._offset == self.size
+
+    def missing(self) -> list[list[int]]:
+        """[start, end) ranges not received yet."""
+        with self._cond:
+            gaps, position = [], 0
+            for start, end in self._ranges:
+                if start > position:
+                    gaps.append([position, start])
+                position = max(position, end)
+            if position < self.size:
+                gaps.append([position, self.size])
+            return gaps
+
+    def _add_range(self, start: int, end: int) -> None:
+        # Called with the condition held; keeps the ranges sorted and merged
+        merged = []
+        for r in sorted(self._ranges + [[start, end]]):
+            if merged and r[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], r[1])
+            else:
+                merged.append(r)
+        self._ranges = merged
+        if merged[0][0] == 0:
+            self._offset = merged[0][1]
+
+    def _hash_prefix(self, step: int = 1024 * 1024) -> None:
+        # Reading back what was just written comes from the page cache
+        with self._hash_lock:
+            while self._hashed < self._offset:
+                data = os.pread(self._fd, min(step, self._offset - self._hashed), self._hashed)
+                self.sha256.update(data)
+                self._hashed += len(data)
+
+    def write(self, offset: int, data: bytes, checksum: Optional[bytes] = None) -> int:
+        """Store a chunk at `offset`, checking it against `checksum` first. Blocks; returns the new offset."""
+        if offset < 0 or offset + len(data) > self.size:
+            raise HTTPException(status_code=400, detail=f"Chunk at {offset} of {len(data)} bytes is outside the {self.size} byte upload")
+        if checksum is not None and hashlib.sha256(data).digest() != checksum:
+            raise HTTPException(status_code=400, detail="Chunk checksum mismatch")
+        with self._cond:
+            if self._sealed:
+                raise HTTPException(status_code=409, detail="Upload is no longer accepting chunks")
+            # Keeps the file open until this write is done, see release()
+            self._writers += 1
+        try:
+            written = 0
+            while written < len(data):
+                written += os.pwrite(self._fd, data[written:], offset + written)
+            with self._cond:
+                if data:
+                    self._add_range(offset, offset + len(data))
+                self.touched = time.monotonic()
+                self._cond.notify_all()
+            self._hash_prefix()
+            return self._offset
+        finally:
+            with self._cond:
+                self._writers -= 1
+                self._cond.notify_all()
+
+    def head(self, size: int) -> bytes:
+        return os.pread(self._fd, min(size, self._offset), 0)
+
+    def read_prefix(self, stall_s: float, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+        """Yield the file in order as its prefix arrives.
+
+        Raises ingest.PipeAborted when the upload is discarded, or when no
+        chunk extends the prefix for `stall_s`.
+        """
+        position = 0
+        while position < self.size:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self._closed or self._offset > position, timeout=stall_s):
+                    logger.debug("Upload %s stalled at %s bytes", self.id, position)
+                    raise ingest.PipeAborted()
+                if self._closed:
+                    raise ingest.PipeAborted()
+                available = self._offset - position
+            data = os.pread(self._fd, min(chunk_size, available), position)
+            position += len(data)
+            yield data
+
+    def seal(self) -> None:
+        """Accept no more chunks; an encode reading the prefix carries on."""
+        # Under the condition, so no write is between its check and counting itself as a writer
+        with self._cond:
+            self._sealed = True
+
+    def abort(self) -> None:
+        with self._cond:
+            self._sealed = self._closed = True
+            self._cond.notify_all()
+
+    def release(self) -> None:
+        """Stop any encode and give the scratch directory back once it is done with it."""
+        self.abort()
+
+        def cleanup(_future=None):
+            with self._cond:
+                self._cond.wait_for(lambda: self._writers == 0)
+            os.close(self._fd)
+            scratch.get_space().release(self.dir)
+
+        if self.encode is not None and not self.encode.done():
+            self.encode.add_done_callback(cleanup)
+        else:
+            cleanup()
+
+
+class UploadRegistry:
+    """Upload sessions in progress; idle ones are dropped after `expire_s`."""
+
+    def __init__(self, expire_s: float, max_chunk_bytes: int, chunk_bytes: int, stall_s: float):
+        self.expire_s = expire_s
+        self.max_chunk_bytes = max_chunk_bytes
+        self.chunk_bytes = min(chunk_bytes, max_chunk_bytes)
+        self.stall_s = stall_s
+        self._sessions: dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [s for s in self._sessions.values() if now - s.touched > self.expire_s]
+            for session in expired:
+                del self._sessions[session.id]
+        for session in expired:
+            logger.info(f"Upload {session.id} expired after {self.expire_s:g}s without a chunk")
+            session.release()
+
+    async def create(self, filename: str, size: int, fields: dict) -> UploadSession:
+        self._expire()
+        workdir = await scratch.get_space().acquire(size)
+        try:
+            session = UploadSession(uuid.uuid4().hex, workdir, filename, size, fields)
+        except BaseException:
+            scratch.get_space().release(workdir)
+            raise
+        with self._lock:
+            self._sessions[session.id] = session
+        logger.debug("Upload %s started: %r, %s bytes", session.id, filename, size)
+        return session
+
+    def get(self, upload_id: str) -> UploadSession:
+        self._expire()
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return session
+
+    def detach(self, upload_id: str) -> UploadSession:
+        """Take a session out of the registry, e.g. to convert it; the caller releases it."""
+        with self._lock:
+            session = self._sessions.pop(upload_id, None)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        session.seal()
+        return session
+
+    def discard(self, upload_id: str) -> None:
+        self.detach(upload_id).release()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+_registry: Optional[UploadRegistry] = None
+
+
+def configure() -> UploadRegistry:
+    global _registry
+    _registry = UploadRegistry(
+        expire_s=_env_int("UPLOAD_EXPIRE", 3600) or 3600,
+        max_chunk_bytes=_env_int("UPLOAD_MAX_CHUNK_BYTES", 16 * 1024 * 1024) or 16 * 1024 * 1024,
+        chunk_bytes=_env_int("UPLOAD_CHUNK_BYTES", 8 * 1024 * 1024) or 8 * 1024 * 1024,
+        stall_s=_env_int("UPLOAD_STALL", 60) or 60,
+    )
+    return _registry
+
+
+def get_registry() -> UploadRegistry:
+    if _registry is None:
+        return configure()
+    return _registry
@@ -0,0 +1,219 @@
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Optional
+
+from backend import log, metrics
+
+logger = log.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name, "").strip()
+    return max(0, int(value)) if value else default
+
+
+class EncoderProcess:
+    """One ffmpeg run reading its input from stdin and writing `output`.
+
+    Started ahead of time, ffmpeg has already been exec'd and initialized and
+    just waits for the first bytes of input.
+    """
+
+    def __init__(self, args: list[str], output: str, stderr_path: str):
+        self.args = args
+        self.output = output
+        self.stderr_path = stderr_path
+        with open(stderr_path, "wb") as stderr:
+            self.proc = subprocess.Popen([*args, output], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        self.started = time.monotonic()
+
+    def healthy(self, max_age_s: float) -> bool:
+        return self.proc.poll() is None and time.monotonic() - self.started < max_age_s
+
+    def kill(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        if self.proc.stdin:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def stderr(self) -> str:
+        with open(self.stderr_path, "rb") as f:
+            return f.read()[-4000:].decode("utf-8", errors="replace")
+
+    def remove_files(self) -> None:
+        for path in (self.output, self.stderr_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class WarmPool:
+    """Idle ffmpeg processes, `size` per argument list, started before anyone needs them.
+
+    An ffmpeg process converts exactly one input, so every process is
+    replaced after its job. Idle ones are replaced when they die or get older
+    than `max_age_s`. Argument lists are warmed once they have been asked for
+    (or passed to prewarm()), at most `max_keys` of them, least recently used
+    first out.
+    """
+
+    def __init__(self, size: int, max_age_s: float = 300, max_keys: int = 8, check_interval_s: Optional[float] = None):
+        self.size = size
+        self.max_age_s = max_age_s
+        self.max_keys = max_keys
+        self.check_interval_s = check_interval_s or min(30.0, max_age_s / 2)
+        self.root = tempfile.mkdtemp(prefix="audio-producer-warm-")
+        self._idle: "OrderedDict[tuple, deque]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="warm-encoders", daemon=True)
+        if self.enabled:
+            self._thread.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def idle(self) -> int:
+        with self._lock:
+            return sum(len(processes) for processes in self._idle.values())
+
+    def _start(self, args: list[str]) -> EncoderProcess:
+        name = uuid.uuid4().hex
+        return EncoderProcess(args, os.path.join(self.root, f"{name}.mp3"), os.path.join(self.root, f"{name}.log"))
+
+    def _discard(self, processes) -> None:
+        for process in processes:
+            process.kill()
+            process.remove_files()
+
+    def _track(self, key: tuple) -> None:
+        # Called with the lock held
+        if key in self._idle:
+            self._idle.move_to_end(key)
+            return
+        self._idle[key] = deque()
+        while len(self._idle) > self.max_keys:
+            _, evicted = self._idle.popitem(last=False)
+            self._discard(evicted)
+
+    def prewarm(self, args: list[str]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._track(tuple(args))
+        self._wake.set()
+
+    def take(self, args: list[str]) -> Optional[EncoderProcess]:
+        """A started ffmpeg running `args` + its output path, or None if none is ready."""
+        if not self.enabled:
+            return None
+        key = tuple(args)
+        stale = []
+        process = None
+        with self._lock:
+            self._track(key)
+            processes = self._idle[key]
+            while processes:
+                candidate = processes.popleft()
+                if candidate.healthy(self.max_age_s):
+                    process = candidate
+                    break
+                stale.append(candidate)
+        self._discard(stale)
+        # Replace what was taken or found dead
+        self._wake.set()
+        metrics.WARM_ENCODERS.inc(result="hit" if process else "miss")
+        return process
+
+    def _refill(self) -> None:
+        with self._lock:
+            wanted = {}
+            stale = []
+            for key, processes in self._idle.items():
+                for process in list(processes):
+                    if not process.healthy(self.max_age_s):
+                        processes.remove(process)
+                        stale.append(process)
+                if len(processes) < self.size:
+                    wanted[key] = self.size - len(processes)
+        self._discard(stale)
+        if stale:
+            logger.debug("Replacing %s idle encoders that died or expired", len(stale))
+
+        for key, count in wanted.items():
+            started = []
+            try:
+                for _ in range(count):
+                    started.append(self._start(list(key)))
+            except OSError as e:
+                logger.warning(f"Could not start a warm encoder: {e}")
+            with self._lock:
+                processes = self._idle.get(key)
+                if processes is None or self._closed:
+                    # Evicted or shut down meanwhile
+                    self._discard(started)
+                    continue
+                processes.extend(started)
+
+    def _run(self) -> None:
+        while not self._closed:
+            try:
+                self._refill()
+            except Exception:
+                logger.exception("Refilling warm encoders failed")
+            self._wake.wait(self.check_interval_s)
+            self._wake.clear()
+
+    def shutdown(self) -> None:
+        self._closed = True
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+        with self._lock:
+            processes = [p for idle in self._idle.values() for p in idle]
+            self._idle.clear()
+        self._discard(processes)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+_pool: Optional[WarmPool] = None
+
+
+def configure() -> WarmPool:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+    _pool = WarmPool(
+        size=_env_int("ENCODER_WARM", 0),
+        max_age_s=_env_int("ENCODER_WARM_MAX_AGE", 300) or 300,
+    )
+    logger.debug("Warm encoders: %s per encoder, replaced after %ss idle", _pool.size, _pool.max_age_s)
+    return _pool
+
+
+def get_pool() -> WarmPool:
+    if _pool is None:
+        return configure()
+    return _pool
+
+
+def _shutdown() -> None:
+    if _pool is not None:
+        _pool.shutdown()
+
+
+atexit.register(_shutdown)
@@ -0,0 +1,34 @@
+"""
+Runs queued conversion jobs outside the API process.
+
+Start the API with JOB_WORKERS=external so it only queues jobs, then any
+number of these next to it, sharing its JOBS_DIR (from the repository root,
+ffmpeg must be on PATH):
+
+    python -m backend.worker
+
+SIGTERM or Ctrl-C stops taking jobs and waits for the running ones.
+"""
+
+import signal
+import threading
+
+from backend import jobs, log, main as api
+
+logger = log.getLogger(__name__)
+
+
+def main() -> None:
+    api.configure()
+    worker = jobs.configure_worker(api._run_job)
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    worker.start()
+    stop.wait()
+    logger.info(f"Worker {worker.name} stopping, finishing its running jobs")
+    worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,346 @@
 const { createApp } = Vue;
 
+const POLL_INTERVAL_MS = 1000;
+// Larger files are sent in chunks that can be retried and resumed
+const CHUNKED_UPLOAD_BYTES = 64 * 1024 * 1024;
+const PARALLEL_CHUNKS = 3;
+const CHUNK_RETRIES = 5;
+
 createApp({
     data() {
         return {
             audioFile: null,
+            episodes: [],
+            coverFile: null,
             topic: '',
             speaker: '',
+            profiles: [],
+            profile: 'default',
+            encoders: [],
+            encoder: '',
+            loudnorm: 'off',
+            trimSilence: false,
+            limiter: false,
+            formats: ['mp3'],
             loading: false,
+            progress: null,
+            preview: null,
             status: '',
             statusType: ''
         };
     },
+    async mounted() {
+        try {
+            const response = await fetch('/api/profiles');
+            if (response.ok) this.profiles = await response.json();
+        } catch {
+            // Without the list only the default profile is offered
+        }
+        try {
+            const response = await fetch('/api/encoders');
+            if (response.ok) this.encoders = await response.json();
+        } catch {
+            // Without the list the server's default encoder is used
+        }
+    },
     methods: {
         onAudioChange(event) {
-            this.audioFile = event.target.files[0];
+            const files = Array.from(event.target.files);
+            this.audioFile = files[0] || null;
+            // Each file of a batch gets its own topic, prefilled from the file name
+            this.episodes = files.map(file => ({
+                file,
+                topic: file.name.replace(/\.[^.]+$/, ''),
+                speaker: ''
+            }));
+        },
+        onCoverChange(event) {
+            this.coverFile = event.target.files[0] || null;
+        },
+        appendProcessing(formData) {
+            // Must precede the audio: the server starts encoding while it uploads
+            if (this.encoder) formData.append('encoder', this.encoder);
+            formData.append('loudnorm', this.loudnorm);
+            formData.append('trimSilence', this.trimSilence);
+            formData.append('limiter', this.limiter);
         },
         async convertAudio() {
             if (!this.audioFile) {
                 this.showStatus('Please select an audio file', 'error');
                 return;
             }
+            if (this.episodes.length > 1) {
+                return this.convertBatch();
+            }
+            if (!this.formats.length) {
+                this.showStatus('Please select at least one format', 'error');
+                return;
+            }
+
+            if (this.audioFile.size > CHUNKED_UPLOAD_BYTES) {
+                return this.convertChunked();
+            }
 
             this.loading = true;
-            this.showStatus('Converting audio...', 'loading');
+            this.progress = null;
+            this.preview = null;
+            this.showStatus('Uploading audio...', 'loading');
 
             const formData = new FormData();
-            formData.append('audioFile', this.audioFile);
             formData.append('topic', this.topic);
             if (this.speaker) formData.append('speaker', this.speaker);
+            formData.append('profile', this.profile);
+            this.appendProcessing(formData);
+            formData.append('formats', this.formats.join(','));
+            if (this.coverFile) formData.append('cover', this.coverFile);
+            formData.append('audioFile', this.audioFile);
 
             try {
-                await fetch('/api/convert', {
+                const response = await fetch('/api/jobs', {
                     method: 'POST',
                     body: formData
-                }).then( async (response) => {
-                    if (!response.ok) {
-                        const error = response.json();
-                        throw new Error(error.detail || 'Conversion failed');
-                    }
+                });
+                if (!response.ok) {
+                    throw new Error(await this.errorDetail(response, 'Upload failed'));
+                }
 
-                    const blob = await response.blob();
-                    const url = window.URL.createObjectURL(blob);
-                    const downloadTitle = (this.topic || '').replace(/[^a-zA-Z0-9\s]+/g, '').trim();
-                    const a = document.createElement('a');
+                const job = await this.waitForJob(await response.json());
+                this.showPreview(job);
 
+                // Let the browser download the finished files directly, one per format
+                for (const url of Object.values(job.results || { mp3: job.result_url })) {
+                    const a = document.createElement('a');
                     a.href = url;
-                    a.download = `${downloadTitle || 'output'}.mp3`;
                     document.body.appendChild(a);
                     a.click();
                     document.body.removeChild(a);
-                    window.URL.revokeObjectURL(url);
+                }
 
-                    this.showStatus('✓ Conversion successful! Download started.', 'success');
-                    this.loading = false;
+                this.showStatus('✓ Conversion successful! Download started.', 'success');
+            } catch (error) {
+                this.showStatus(`Error: ${error.message}`, 'error');
+            } finally {
+                this.loading = false;
+                this.progress = null;
+            }
+        },
+        async convertBatch() {
+            this.loading = true;
+            this.progress = null;
+            this.showStatus(`Uploading and converting ${this.episodes.length} files...`, 'loading');
+
+            const formData = new FormData();
+            formData.append('profile', this.profile);
+            this.appendProcessing(formData);
+            if (this.coverFile) formData.append('cover', this.coverFile);
+            for (const episode of this.episodes) {
+                formData.append('topic', episode.topic);
+                formData.append('speaker', episode.speaker || this.speaker);
+                formData.append('audioFile', episode.file);
+            }
+
+            try {
+                const response = await fetch('/api/convert/batch', {
+                    method: 'POST',
+                    body: formData
                 });
+                if (!response.ok) {
+                    throw new Error(await this.errorDetail(response, 'Batch conversion failed'));
+                }
+
+                const disposition = response.headers.get('Content-Disposition') || '';
+                const match = disposition.match(/filename="([^"]+)"/);
+                const url = URL.createObjectURL(await response.blob());
+                const a = document.createElement('a');
+                a.href = url;
+                a.download = match ? match[1] : 'episodes.zip';
+                document.body.appendChild(a);
+                a.click();
+                document.body.removeChild(a);
+                URL.revokeObjectURL(url);
+
+                this.showStatus(`✓ Converted ${this.episodes.length} files! Download started.`, 'success');
+            } catch (error) {
+                this.showStatus(`Error: ${error.message}`, 'error');
+            } finally {
+                this.loading = false;
+            }
+        },
+        async convertChunked() {
+            this.loading = true;
+            this.progress = 0;
+            this.showStatus('Uploading audio... 0%', 'loading');
+
+            try {
+                const upload = await this.uploadChunks(this.audioFile);
+
+                this.showStatus('Converting audio...', 'loading');
+                const formData = new FormData();
+                formData.append('topic', this.topic);
+                if (this.speaker) formData.append('speaker', this.speaker);
+                formData.append('profile', this.profile);
+                if (this.coverFile) formData.append('cover', this.coverFile);
+                const response = await fetch(upload.complete_url, { method: 'POST', body: formData });
+                if (!response.ok) {
+                    throw new Error(await this.errorDetail(response, 'Conversion failed'));
+                }
 
+                const disposition = response.headers.get('Content-Disposition') || '';
+                const match = disposition.match(/filename="([^"]+)"/);
+                const url = URL.createObjectURL(await response.blob());
+                const a = document.createElement('a');
+                a.href = url;
+                a.download = match ? match[1] : 'episode.mp3';
+                document.body.appendChild(a);
+                a.click();
+                document.body.removeChild(a);
+                URL.revokeObjectURL(url);
+
+                this.showStatus('✓ Conversion successful! Download started.', 'success');
             } catch (error) {
                 this.showStatus(`Error: ${error.message}`, 'error');
             } finally {
                 this.loading = false;
+                this.progress = null;
+            }
+        },
+        async uploadChunks(file) {
+            const options = {
+                filename: file.name,
+                size: file.size,
+                loudnorm: this.loudnorm,
+                trimSilence: this.trimSilence,
+                limiter: this.limiter,
+                formats: this.formats.join(',')
+            };
+            if (this.encoder) options.encoder = this.encoder;
+            const response = await fetch('/api/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(options)
+            });
+            if (!response.ok) {
+                throw new Error(await this.errorDetail(response, 'Upload failed'));
+            }
+            let upload = await response.json();
+
+            // Send what the server is missing, a few chunks at a time; a chunk
+            // that failed for good is simply still missing on the next round
+            for (let round = 0; upload.missing.length && round < CHUNK_RETRIES; round++) {
+                const ranges = [];
+                for (const [start, end] of upload.missing) {
+                    for (let offset = start; offset < end; offset += upload.chunk_size) {
+                        ranges.push([offset, Math.min(offset + upload.chunk_size, end)]);
+                    }
+                }
+                let sent = file.size - upload.missing.reduce((total, [start, end]) => total + end - start, 0);
+                const worker = async () => {
+                    while (ranges.length) {
+                        const [start, end] = ranges.shift();
+                        if (await this.sendChunk(upload.upload_url, file.slice(start, end), start)) {
+                            sent += end - start;
+                            this.progress = 100 * sent / file.size;
+                            this.showStatus(`Uploading audio... ${Math.floor(this.progress)}%`, 'loading');
+                        }
+                    }
+                };
+                await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+                const status = await fetch(upload.upload_url);
+                if (!status.ok) {
+                    throw new Error(await this.errorDetail(status, 'Lost track of the upload'));
+                }
+                upload = await status.json();
+            }
+            if (upload.missing.length) {
+                throw new Error('Upload failed, please try again');
+            }
+            return upload;
+        },
+        async sendChunk(url, blob, offset) {
+            const data = await blob.arrayBuffer();
+            const headers = { 'Upload-Offset': String(offset) };
+            // crypto.subtle only exists on secure origins; the server checks the chunk when it gets one
+            if (window.crypto && crypto.subtle) {
+                const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', data));
+                headers['Upload-Checksum'] = 'sha256 ' + btoa(String.fromCharCode(...digest));
+            }
+            for (let attempt = 0; attempt < CHUNK_RETRIES; attempt++) {
+                try {
+                    const response = await fetch(url, { method: 'PATCH', headers, body: data });
+                    if (response.ok) return true;
+                    if (response.status === 404) {
+                        throw new Error('The upload expired, please try again');
+                    }
+                } catch (error) {
+                    if (error.message.startsWith('The upload expired')) throw error;
+                    // A network error, retry below
+                }
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+            }
+            return false;
+        },
+        async waitForJob(job) {
+            while (job.status === 'queued' || job.status === 'running') {
+                this.progress = job.progress;
+                this.showStatus(
+                    job.status === 'queued' ? 'Waiting for a free converter...' : `Converting audio... ${Math.floor(job.progress)}%`,
+                    'loading'
+                );
+                await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL_MS));
+
+                const response = await fetch(job.status_url);
+                if (!response.ok) {
+                    throw new Error(await this.errorDetail(response, 'Lost track of the conversion'));
+                }
+                job = await response.json();
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error || 'Conversion failed');
+            }
+            return job;
+        },
+        async showPreview(job) {
+            if (!job.peaks_url) return;
+            this.preview = job.preview_url || '';
+            try {
+                const response = await fetch(job.peaks_url);
+                if (!response.ok) return;
+                // audiowaveform .dat, version 1, 8-bit: a 20 byte header, then min/max pairs
+                const pairs = new Int8Array(await response.arrayBuffer(), 20);
+                await this.$nextTick();
+                this.drawWaveform(this.$refs.waveform, pairs);
+            } catch {
+                // The download matters, the picture doesn't
+            }
+        },
+        drawWaveform(canvas, pairs) {
+            if (!canvas) return;
+            const context = canvas.getContext('2d');
+            const { width, height } = canvas;
+            const buckets = pairs.length / 2;
+            context.clearRect(0, 0, width, height);
+            context.fillStyle = '#667eea';
+            for (let x = 0; x < width; x++) {
+                // Each column shows the extremes of the buckets that fall into it
+                const first = Math.floor(x * buckets / width);
+                const last = Math.max(first + 1, Math.floor((x + 1) * buckets / width));
+                let min = 0, max = 0;
+                for (let i = first; i < last && i < buckets; i++) {
+                    min = Math.min(min, pairs[2 * i]);
+                    max = Math.max(max, pairs[2 * i + 1]);
+                }
+                const top = height / 2 - (max / 128) * height / 2;
+                const bottom = height / 2 - (min / 128) * height / 2;
+                context.fillRect(x, top, 1, Math.max(1, bottom - top));
+            }
+        },
+        async errorDetail(response, fallback) {
+            try {
+                const error = await response.json();
+                return error.detail || fallback;
+            } catch {
+                return fallback;
             }
         },
         showStatus(message, type) {